@@ -1,111 +1,320 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import logging
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query, Request
+from fastapi.concurrency import run_in_threadpool
 import os
-from minio import Minio
 from minio.error import S3Error
-from fastapi.responses import StreamingResponse
-import io
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 import asyncio
+import time
 from concurrent.futures import ThreadPoolExecutor
-import re
-from pymongo import MongoClient
 
 # pipeline configuration
 from config import PIPELINE_CONFIGS, BUCKET_CONFIGS
+from job_queue import LEASE_SECONDS, open_job_queue
+from router import PipelineRouter, pipeline_name
+from prescan_cache import PrescanCache
+from dispatcher import Dispatcher, claim_queued_jobs, dispatch_jobs, without_precompressed_copies
+from idempotency import IDEMPOTENCY_CLAIM_SECONDS, open_idempotency_store
+from scheduler import FLOW_WORKERS, FairScheduler
+from flow_worker import DEPLOYMENT_WORKERS, PROCESS_WORKERS, WarmProcessPool, flow_path
+from load_shedding import DeferredStore, LoadShedder
+from backfill import BACKFILL_MODES, BackfillRunner, BackfillStore
+from summaries import SummaryReader, parse_kinds, parse_timestamp
+from downloads import (
+    GET_OBJECT_MODE, RangeNotSatisfiable, accepted_encodings, compress_stream, encoded_etag, etag_matches, is_compressible,
+    object_headers, parse_range, precompressed_object, presigned_object_url, public_minio_client, stream_encoding, stream_object,
+)
+# pooled clients shared with the flows running in this process
+from etl_shared import minio_client, mongo_collection, record_saved_listeners
+from etl_shared.metrics import REGISTRY
 
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
+QUEUE_WORKERS = int(os.getenv("ETL_QUEUE_WORKERS", "4"))
+QUEUE_POLL_INTERVAL = float(os.getenv("ETL_QUEUE_POLL_INTERVAL", "1.0"))
+# debounce window for upload storms, events queued within it are routed and submitted as one batch (0 disables)
+DISPATCH_COALESCE_MS = float(os.getenv("DISPATCH_COALESCE_MS", "0"))
+DISPATCH_COALESCE_MAX_EVENTS = int(os.getenv("DISPATCH_COALESCE_MAX_EVENTS", "100"))
 
-from pymongo import MongoClient
-mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/")
-db = mongo_client["loganalysis"]
-collection = db["prescan"]
+QUEUE_WAIT = REGISTRY.histogram("etl_queue_wait_seconds", "Time an event spent in the durable queue before dispatch")
+EVENTS_RECEIVED = REGISTRY.counter("etl_events_received_total", "Bucket notifications accepted by /trigger-etl")
+DISPATCH_FAILURES = REGISTRY.counter("etl_dispatch_failures_total", "Queued events whose dispatch raised or had a failed run")
+COALESCED_EVENTS = REGISTRY.histogram("etl_coalesced_events", "Queued events dispatched together per coalescing window", buckets=(1, 2, 5, 10, 25, 50, 100, 250))
 
-executor = ThreadPoolExecutor()
+job_queue = open_job_queue()
+# ids of the jobs this process is dispatching, their leases are renewed until they are acked or failed
+running_jobs = set()
+# validated at import, a bad config fails startup instead of events
+router = PipelineRouter(PIPELINE_CONFIGS, BUCKET_CONFIGS)
+job_available = asyncio.Event()
+# only one worker collects a coalescing window at a time, so a storm ends up in one batch
+coalesce_lock = asyncio.Lock()
 
-async def run_flow(func, *args):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, func, *args)
+@asynccontextmanager
+async def lifespan(app):
+    recovered = job_queue.recover()
+    if recovered:
+        logging.info(f"[ QUEUE ] requeued {recovered} job(s) left running by the previous process")
+    released = idempotency.recover()
+    if released:
+        logging.info(f"[ IDEMPOTENCY ] released {released} claim(s) of runs the previous process did not finish")
+    if process_pool is not None:
+        process_pool.start()
+    workers = [asyncio.create_task(queue_worker(i)) for i in range(QUEUE_WORKERS)]
+    workers.append(asyncio.create_task(lease_keeper()))
+    workers.append(asyncio.create_task(shedder.replay(dispatcher)))
+    backfills.resume()
+    yield
+    await backfills.shutdown()
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    if process_pool is not None:
+        process_pool.shutdown(wait=False, cancel_futures=True)
 
-async def filter_runs(object_name):
-    #check the mongo db record for the log, this was generated during prescan
-    query = {"name": os.path.splitext(object_name)[0]}
-    prescan_metadata = collection.find_one(query, sort=[("saved_timestamp", -1)])
-    matching_pipelines = []
+app = FastAPI(lifespan=lifespan)
+presign_client = public_minio_client()
 
-    # Iterate over pipeline configs and collect all matching pipelines
-    for config in PIPELINE_CONFIGS:
+collection = mongo_collection("loganalysis", "prescan")
+prescan_cache = PrescanCache(collection)
+record_saved_listeners.append(prescan_cache.invalidate)
 
-        try:
-            logging.warning(f"[ START CHECKS ] Starting run criteria checks for flow: ({config.prefect_flow.__name__})")
+executor = ThreadPoolExecutor(max_workers=FLOW_WORKERS)
+# warm worker processes for pipelines that opted into the process executor
+process_flow_paths = sorted({
+    flow_path(path) for config in PIPELINE_CONFIGS if config.executor == "process"
+    for path in (config.prefect_flow, config.batch_flow) if path
+})
+process_pool = WarmProcessPool(process_flow_paths) if process_flow_paths else None
+executors = {"thread": (executor, FLOW_WORKERS)}
+if process_pool is not None:
+    executors["process"] = (process_pool, PROCESS_WORKERS)
+if any(config.executor == "deployment" for config in PIPELINE_CONFIGS):
+    # threads only wait on flow runs executing elsewhere
+    executors["deployment"] = (ThreadPoolExecutor(max_workers=DEPLOYMENT_WORKERS, thread_name_prefix="deployment"), DEPLOYMENT_WORKERS)
+scheduler = FairScheduler(executors)
+
+idempotency = open_idempotency_store()
+shedder = LoadShedder(DeferredStore(), job_queue.depth, scheduler)
+dispatcher = Dispatcher(router, prescan_cache, minio_client, scheduler, idempotency, shedder)
+backfills = BackfillRunner(BackfillStore(), dispatcher, minio_client)
+summary_reader = SummaryReader(minio_client, mongo_collection("loganalysis", "summary_index"))
 
-            fatal_fault = prescan_metadata.get("fatal_fault_code") if prescan_metadata else None
+REGISTRY.gauge("etl_queue_depth", "Events waiting in the durable queue", callback=lambda: {(): job_queue.depth()})
+REGISTRY.gauge("etl_lane_queued", "Runs waiting for a worker slot", ("lane",), callback=lambda: {(lane,): stats.queued for lane, stats in scheduler.stats.items()})
+REGISTRY.gauge("etl_lane_running", "Runs in progress", ("lane",), callback=lambda: {(lane,): stats.running for lane, stats in scheduler.stats.items()})
+REGISTRY.gauge("etl_prescan_cache_lookups", "Prescan cache lookups since startup", ("result",), callback=lambda: {("hit",): prescan_cache.hits, ("miss",): prescan_cache.misses})
+REGISTRY.gauge("etl_deferred_runs", "Runs of deferrable pipelines waiting for load to subside", callback=lambda: {(): shedder.store.count()})
+REGISTRY.gauge("etl_overloaded", "1 while deferrable pipelines are being shed", callback=lambda: {(): int(shedder.overloaded)})
+REGISTRY.gauge("etl_idempotency_checks", "Idempotency store checks since startup", ("result",), callback=lambda: {("hit",): idempotency.hits, ("miss",): idempotency.misses})
 
-            # Validate object_name and regex pattern for any potential issues
-            if not object_name or not config.regex_trigger:
-                logging.error(f"[ ERROR ] Missing or invalid object_name or regex_trigger: object_name={object_name}, regex_trigger={config.regex_trigger}")
-                continue
+async def claim_jobs():
+    if not DISPATCH_COALESCE_MS:
+        return await claim_queued_jobs(job_queue, QUEUE_WORKERS)
 
-            # Guard to filter on type of file
-            if not re.match(config.regex_trigger, object_name):
-                logging.warning(f"[ END CHECKS ] not running flow: ({config.prefect_flow.__name__}) [{object_name}] does not match regex [{config.regex_trigger}]")
-                continue
+    async with coalesce_lock:
+        jobs = await claim_queued_jobs(job_queue, QUEUE_WORKERS, DISPATCH_COALESCE_MS / 1000, DISPATCH_COALESCE_MAX_EVENTS)
+    if jobs:
+        COALESCED_EVENTS.observe(len(jobs))
+    return jobs
 
-            logging.warning(f"[ GUARD ][{config.prefect_flow.__name__}] OBJ_NAME_REGEX_TRIGGER_MATCH: [{object_name}] matches [{config.regex_trigger}]")
+async def lease_keeper():
+    # renew leases and idempotency claims well before they expire so other replicas do not take over runs still going here
+    while True:
+        await asyncio.sleep(min(LEASE_SECONDS, IDEMPOTENCY_CLAIM_SECONDS) / 3)
+        try:
+            await dispatcher.renew_claims()
+        except Exception as e:
+            logging.error(f"[ IDEMPOTENCY ] claim renewal failed: {e}")
+        if not running_jobs:
+            continue
+        try:
+            renewed = await run_in_threadpool(job_queue.heartbeat, *running_jobs)
+        except Exception as e:
+            logging.error(f"[ QUEUE ] lease renewal failed: {e}")
+            continue
+        lost = running_jobs - set(renewed)
+        if lost:
+            logging.warning(f"[ QUEUE ] lost the lease of job(s) {sorted(lost)}, another replica may run them again")
 
-            # Ensure os.path.splitext doesn't cause errors by checking object_name validity
+async def queue_worker(worker_id):
+    # drain the durable queue, waking up early whenever the webhook enqueues something new
+    while True:
+        jobs = await claim_jobs()
+        if not jobs:
+            job_available.clear()
             try:
-                dest_obj_name = f"{os.path.splitext(object_name)[0]}{config.dest_obj_suffix}"
-            except Exception as e:
-                logging.error(f"[ ERROR ] Failed to parse object name: {object_name}, Error: {str(e)}")
-                continue
+                await asyncio.wait_for(job_available.wait(), timeout=QUEUE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
 
-            matching_pipelines.append((config.prefect_flow, config.src, object_name, config.dest, dest_obj_name))
+        # a single job unless the queue is backed up or a coalescing window is set
+        for job in jobs:
+            QUEUE_WAIT.observe(max(time.time() - job.enqueued_at, 0.0))
+        running_jobs.update(job.id for job in jobs)
+        try:
+            failures = await dispatch_jobs(dispatcher, job_queue, jobs)
+        except asyncio.CancelledError:
+            # shutting down, leave the jobs running so recover() or their lease expiry requeues them
+            raise
         except Exception as e:
-            logging.error(f"[ CRITICAL ERROR ] Exception occurred during run criteria checks: {str(e)}")
-        return matching_pipelines
+            # the queue could not ack or fail them, they stay running until recover() or their lease expiry requeues them
+            logging.error(f"[ QUEUE ][worker {worker_id}] could not settle job(s) {[job.id for job in jobs]}: {e}")
+            failures = []
+        finally:
+            running_jobs.difference_update(job.id for job in jobs)
+        DISPATCH_FAILURES.inc(len(failures))
+        for job, status, error in failures:
+            logging.error(f"[ QUEUE ][worker {worker_id}] job {job.id} failed (attempt {job.attempts}, now {status}): {error}")
 
-@app.post("/trigger-etl")
+@app.post("/trigger-etl", status_code=202)
 async def trigger_etl(request: Request):
-    # collect metadata from minio bucket notify event
-    event_data = await request.json()
+    # persist the minio bucket notify event and acknowledge right away, the queue workers run the flows
+    event_data = without_precompressed_copies(await request.json())
+    if event_data is None:
+        return {"message": "ETL event ignored, only precompressed copies", "job_id": None}
+    job_id = await run_in_threadpool(job_queue.put, event_data)
+    EVENTS_RECEIVED.inc()
+    job_available.set()
+
+    return {"message": "ETL event queued", "job_id": job_id}
+
+@app.post("/backfill", status_code=202)
+async def start_backfill(request: Request):
+    # replay existing objects of a bucket prefix, eg. to run a newly added pipeline on historical logs
+    body = await request.json()
+    bucket = body.get("bucket")
+    pipelines = body.get("pipelines") or None
+    mode = body.get("mode") or "all"
+    if mode not in BACKFILL_MODES:
+        return JSONResponse({"error": f"mode must be one of {list(BACKFILL_MODES)}"}, status_code=400)
+    if bucket not in router.buckets():
+        return JSONResponse({"error": f"no pipeline reads from bucket {bucket}"}, status_code=400)
+    unknown = set(pipelines or ()) - {pipeline_name(config) for config in PIPELINE_CONFIGS}
+    if unknown:
+        return JSONResponse({"error": f"unknown pipelines {sorted(unknown)}"}, status_code=400)
+
+    backfill = await run_in_threadpool(backfills.store.create, bucket, body.get("prefix") or "", pipelines, mode)
+    backfills.start(backfill)
+    return {"message": "Backfill started", "backfill_id": backfill.id}
 
-    object_name = event_data.get('Records', [{}])[0].get('s3', {}).get('object', {}).get('key', 'Unknown')
+@app.get("/backfill")
+async def list_backfills():
+    return [backfill._asdict() for backfill in await run_in_threadpool(backfills.store.all)]
 
-    logging.info(f"EVENT_DATA: {event_data}")
-    logging.info(f"EVENT_DATA_FILENAME: {object_name}")
+@app.get("/backfill/{backfill_id}")
+async def get_backfill(backfill_id: int):
+    backfill = await run_in_threadpool(backfills.store.get, backfill_id)
+    if backfill is None:
+        return JSONResponse({"error": f"backfill {backfill_id} not found"}, status_code=404)
+    return backfill._asdict()
 
-    #check filters:
-    matching_pipelines = await filter_runs(object_name=object_name)
-    
-    # Run all matching pipelines concurrently
-    if matching_pipelines:
-        await asyncio.gather(*(run_flow(flow, src, obj_name, dest, dest_obj_name) for flow, src, obj_name, dest, dest_obj_name in matching_pipelines))
+@app.delete("/backfill/{backfill_id}")
+async def cancel_backfill(backfill_id: int):
+    await backfills.cancel(backfill_id)
+    return await get_backfill(backfill_id)
 
-    return {"message": f"{len(matching_pipelines)} ETL pipeline(s) triggered"}
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(await run_in_threadpool(REGISTRY.render), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    return {
+        "queue_depth": await run_in_threadpool(job_queue.depth),
+        "prescan_cache": {"hits": prescan_cache.hits, "misses": prescan_cache.misses},
+        "idempotency": idempotency.stats(),
+        "lanes": scheduler.snapshot(),
+        "executors": scheduler.executor_snapshot(),
+        "load_shedding": await run_in_threadpool(shedder.stats),
+    }
 
 @app.get("/get-object/{bucket_name}/{object_name}")
-async def get_object(bucket_name: str, object_name: str):
+async def get_object(bucket_name: str, object_name: str, request: Request, mode: str = GET_OBJECT_MODE):
+    if mode == "redirect":
+        # hand the bulk transfer to minio, the api only signs the url
+        return RedirectResponse(presigned_object_url(presign_client, bucket_name, object_name), status_code=307)
+
     try:
-        # get object from Minio
-        response = await run_flow(minio_client.get_object, bucket_name, object_name)
-        data = response.read()
-        file_data = io.BytesIO(data)
+        stat = await run_in_threadpool(minio_client.stat_object, bucket_name, object_name)
+    except S3Error as err:
+        return JSONResponse({"error": str(err)}, status_code=404)
 
-        # return the file as a response
-        return StreamingResponse(file_data, media_type="application/octet-stream", headers={"Content-Disposition": f"attachment; filename={object_name}"})
+    headers = object_headers(stat, object_name)
+    compressible = is_compressible(object_name, stat.size)
+    if compressible:
+        headers["Vary"] = "Accept-Encoding"
+    if etag_matches(request.headers.get("if-none-match"), stat.etag):
+        return Response(status_code=304, headers={key: headers[key] for key in ("ETag", "Last-Modified", "Vary") if key in headers})
+
+    try:
+        byte_range = parse_range(request.headers.get("range"), stat.size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{stat.size}"})
+
+    encodings = accepted_encodings(request.headers.get("accept-encoding")) if compressible and byte_range is None else []
+    if encodings:
+        response = await compressed_object(bucket_name, object_name, stat, headers, encodings)
+        if response is not None:
+            return response
+
+    status_code = 200
+    offset, length = 0, stat.size
+    request_length = 0  # 0 asks minio for the whole object
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        offset, length = start, end - start + 1
+        request_length = length
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.size}"
+    headers["Content-Length"] = str(length)
+
+    try:
+        # stream straight from minio, memory per download is bounded by the chunk size
+        response = await run_in_threadpool(minio_client.get_object, bucket_name, object_name, offset, request_length)
+    except S3Error as err:
+        return JSONResponse({"error": str(err)}, status_code=404)
+
+    return StreamingResponse(stream_object(response), status_code=status_code, media_type="application/octet-stream", headers=headers)
+
+async def compressed_object(bucket_name, object_name, stat, headers, encodings):
+    # a precompressed copy written by the flow costs no CPU here, otherwise compress while streaming
+    precompressed = await run_in_threadpool(precompressed_object, minio_client, bucket_name, object_name, stat, encodings)
+    if precompressed is not None:
+        encoding, source_name, source_stat = precompressed
+        headers["Content-Length"] = str(source_stat.size)
+    else:
+        encoding = stream_encoding(encodings)
+        if encoding is None:
+            return None
+        source_name = object_name
+    try:
+        response = await run_in_threadpool(minio_client.get_object, bucket_name, source_name)
     except S3Error as err:
-        return {"error": str(err)}, 404
+        return JSONResponse({"error": str(err)}, status_code=404)
+
+    chunks = stream_object(response)
+    if precompressed is None:
+        chunks = compress_stream(chunks, encoding)
+    # ranges apply to the uncompressed object only
+    headers.pop("Accept-Ranges")
+    headers["ETag"] = f'"{encoded_etag(stat.etag, encoding)}"'
+    headers["Content-Encoding"] = encoding
+    return StreamingResponse(chunks, media_type="application/octet-stream", headers=headers)
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+@app.get("/summary/{log}")
+async def summary(log: str, start: str = Query(None, alias="from"), to: str = None, kind: str = None):
+    """Lines of a log's logfisher summary between from and to, optionally only of some kinds (kind=FAULT,TOTE)"""
+    try:
+        start, end, kinds = parse_timestamp(start), parse_timestamp(to), parse_kinds(kind)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        lines, fetched = await run_in_threadpool(summary_reader.read, log, start, end, kinds)
+    except S3Error as err:
+        return JSONResponse({"error": str(err)}, status_code=404)
+    return PlainTextResponse("".join(f"{line}\n" for line in lines), headers={"X-Summary-Bytes-Read": str(fetched)})
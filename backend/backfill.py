@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import urllib.request
+from collections import namedtuple
+from itertools import islice
+
+from dispatcher import EventRecord
+from reconcile import OutputIndex
+from router import pipeline_name
+from sqlite_store import SqliteStore
+
+BACKFILL_PATH = os.getenv("BACKFILL_PATH", "./state/backfills.sqlite3")
+# objects dispatched at once, and objects dispatched per second (0 = no limit), per backfill
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4"))
+BACKFILL_RATE = float(os.getenv("BACKFILL_RATE", "5"))
+# objects listed between two cursor checkpoints
+BACKFILL_PAGE_SIZE = int(os.getenv("BACKFILL_PAGE_SIZE", "200"))
+BACKFILL_API_URL = os.getenv("BACKFILL_API_URL", "http://localhost:8000")
+# seconds between retries of the runs of a page that another dispatch still holds in progress
+BACKFILL_HELD_RETRY = float(os.getenv("BACKFILL_HELD_RETRY", "10"))
+
+# mode "all" replays every matching object, "gaps" only the runs whose output is missing or stale
+BACKFILL_MODES = ("all", "gaps")
+
+Backfill = namedtuple('Backfill', ['id', 'bucket', 'prefix', 'pipelines', 'mode', 'cursor', 'status', 'listed', 'matched', 'runs', 'error', 'created_at', 'updated_at'])
+BACKFILL_COLUMNS = ", ".join(Backfill._fields)
+
+class BackfillStore(SqliteStore):
+    """Backfill jobs and their listing cursor, kept in a local SQLite file
+
+    The cursor is the last object key whose runs finished dispatching, listing resumes after
+    it (S3 lists keys in lexicographic order) so a restarted backfill does not start over.
+    """
+
+    def __init__(self, path=BACKFILL_PATH):
+        super().__init__(
+            path,
+            """CREATE TABLE IF NOT EXISTS backfills (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bucket TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                pipelines TEXT,
+                cursor TEXT,
+                status TEXT NOT NULL DEFAULT 'running',
+                listed INTEGER NOT NULL DEFAULT 0,
+                matched INTEGER NOT NULL DEFAULT 0,
+                runs INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""",
+        )
+        if "mode" not in self._columns("backfills"):
+            self._conn.execute("ALTER TABLE backfills ADD COLUMN mode TEXT NOT NULL DEFAULT 'all'")
+
+    def _backfill(self, row):
+        return Backfill(*row[:3], json.loads(row[3]) if row[3] else None, *row[4:])
+
+    def create(self, bucket, prefix="", pipelines=None, mode="all"):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO backfills (bucket, prefix, pipelines, mode, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (bucket, prefix, json.dumps(sorted(pipelines)) if pipelines else None, mode, now, now),
+            )
+        return self.get(cursor.lastrowid)
+
+    def get(self, backfill_id):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {BACKFILL_COLUMNS} FROM backfills WHERE id = ?", (backfill_id,)).fetchone()
+        return self._backfill(row) if row else None
+
+    def all(self):
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {BACKFILL_COLUMNS} FROM backfills ORDER BY id").fetchall()
+        return [self._backfill(row) for row in rows]
+
+    def running(self):
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {BACKFILL_COLUMNS} FROM backfills WHERE status = 'running' ORDER BY id").fetchall()
+        return [self._backfill(row) for row in rows]
+
+    def checkpoint(self, backfill_id, cursor, listed, matched, runs):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE backfills SET cursor = ?, listed = listed + ?, matched = matched + ?, runs = runs + ?, updated_at = ? WHERE id = ?",
+                (cursor, listed, matched, runs, time.time(), backfill_id),
+            )
+
+    def finish(self, backfill_id, status, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE backfills SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                (status, error, time.time(), backfill_id),
+            )
+
+class RateLimiter:
+    """Spaces acquire() calls at least 1/rate seconds apart, rate 0 disables the limit"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            delay = self._next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(self._next, time.monotonic()) + self.interval
+
+def list_page(minio_client, bucket_name, prefix, start_after, limit):
+    # list_objects pages through the bucket lazily, stop after `limit` keys
+    objects = minio_client.list_objects(bucket_name, prefix=prefix or None, recursive=True, start_after=start_after)
+    return [(obj.object_name, obj.etag, obj.last_modified) for obj in islice(objects, limit) if not obj.is_dir]
+
+class BackfillRunner:
+    """Replays existing objects of a bucket prefix through the router as if they were just uploaded
+
+    Each backfill lists its prefix page by page, dispatches the objects that route to a pipeline
+    with at most `concurrency` objects in flight and at most `rate` objects started per second,
+    then checkpoints the cursor. The cursor only moves past a page once each of its runs is done:
+    runs the idempotency store reports as held in progress by another dispatch (eg. the claims of
+    a crashed replica, until they lapse) are retried every BACKFILL_HELD_RETRY seconds until they
+    either went through or can be claimed again. Backfills still running when the API stops are
+    resumed on the next start; objects of an interrupted page are dispatched again and the runs
+    that already completed are skipped. In "gaps" mode the destinations are listed up
+    front and each object only runs the pipelines whose output is missing or older than it,
+    so recovering from an outage costs time proportional to the gap.
+    """
+
+    def __init__(self, store, dispatcher, minio_client, concurrency=BACKFILL_CONCURRENCY, rate=BACKFILL_RATE, page_size=BACKFILL_PAGE_SIZE):
+        self.store = store
+        self.dispatcher = dispatcher
+        self.minio_client = minio_client
+        self.concurrency = concurrency
+        self.rate = rate
+        self.page_size = page_size
+        self._tasks = {}
+
+    def start(self, backfill):
+        task = asyncio.create_task(self._run(backfill))
+        self._tasks[backfill.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(backfill.id, None))
+
+    def resume(self):
+        backfills = self.store.running()
+        for backfill in backfills:
+            logging.info(f"[ BACKFILL ][{backfill.id}] resuming {backfill.bucket}/{backfill.prefix} after {backfill.cursor}")
+            self.start(backfill)
+        return backfills
+
+    async def cancel(self, backfill_id):
+        await asyncio.get_running_loop().run_in_executor(None, self.store.finish, backfill_id, "cancelled")
+        task = self._tasks.pop(backfill_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def shutdown(self):
+        # leave the backfills running in the store so the next start resumes them
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _routes(self, backfill, object_name):
+        routes = self.dispatcher.router.route(backfill.bucket, object_name)
+        if backfill.pipelines:
+            routes = [route for route in routes if pipeline_name(route.config) in backfill.pipelines]
+        return routes
+
+    def _page_routes(self, backfill, page, output_index):
+        # {object name: pipelines to run on it} for the objects of a page that need any
+        routes = [route for object_name, _, _ in page for route in self._routes(backfill, object_name)]
+        if output_index is not None:
+            routes = output_index.gaps(routes, {object_name: last_modified for object_name, _, last_modified in page})
+        pipelines = {}
+        for route in routes:
+            pipelines.setdefault(route.object_name, set()).add(pipeline_name(route.config))
+        return pipelines
+
+    async def _dispatch(self, record, pipelines, semaphore, limiter):
+        # (runs dispatched, pipelines whose run another dispatch still holds in progress)
+        async with semaphore:
+            await limiter.acquire()
+            held = []
+            dispatched = await self.dispatcher.dispatch([record], pipelines, held)
+            return sum(len(batch) for batch in dispatched.values()), {pipeline_name(route.config) for route in held}
+
+    async def _dispatch_page(self, backfill, records, pipelines, semaphore, limiter):
+        """Dispatch the records of a page until none of their runs is held by another dispatch, returns the runs dispatched"""
+        runs = 0
+        pending = {record: pipelines[record.key] for record in records}
+        while pending:
+            results = await asyncio.gather(*(self._dispatch(record, names, semaphore, limiter) for record, names in pending.items()))
+            runs += sum(count for count, _ in results)
+            pending = {record: held for record, (_, held) in zip(pending, results) if held}
+            if pending:
+                logging.info(f"[ BACKFILL ][{backfill.id}] {len(pending)} object(s) have runs still in progress elsewhere, retrying in {BACKFILL_HELD_RETRY}s")
+                await asyncio.sleep(BACKFILL_HELD_RETRY)
+        return runs
+
+    async def _run(self, backfill):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.rate)
+        cursor = backfill.cursor
+        output_index = OutputIndex(self.minio_client, self.dispatcher.prescan_cache.collection, backfill.prefix) if backfill.mode == "gaps" else None
+        try:
+            while True:
+                page = await loop.run_in_executor(None, list_page, self.minio_client, backfill.bucket, backfill.prefix, cursor, self.page_size)
+                if not page:
+                    break
+                pipelines = await loop.run_in_executor(None, self._page_routes, backfill, page, output_index)
+                records = [EventRecord(backfill.bucket, object_name, etag) for object_name, etag, _ in page if object_name in pipelines]
+                runs = await self._dispatch_page(backfill, records, pipelines, semaphore, limiter)
+                cursor = page[-1][0]
+                await loop.run_in_executor(None, self.store.checkpoint, backfill.id, cursor, len(page), len(records), runs)
+                logging.info(f"[ BACKFILL ][{backfill.id}] dispatched {len(records)}/{len(page)} object(s) up to {cursor}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"[ BACKFILL ][{backfill.id}] failed after {cursor}: {e}")
+            await loop.run_in_executor(None, self.store.finish, backfill.id, "failed", str(e))
+            return
+        await loop.run_in_executor(None, self.store.finish, backfill.id, "completed")
+        logging.info(f"[ BACKFILL ][{backfill.id}] completed {backfill.bucket}/{backfill.prefix}")
+
+def _request(method, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(f"{BACKFILL_API_URL}{path}", data=data, method=method, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Start and follow backfills on the flows API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    start = commands.add_parser("start", help="replay the objects of a bucket prefix through the pipelines")
+    start.add_argument("bucket")
+    start.add_argument("--prefix", default="")
+    start.add_argument("--pipeline", action="append", dest="pipelines", help="only run this pipeline (flow name), can be repeated")
+    start.add_argument("--gaps", action="store_const", const="gaps", default="all", dest="mode", help="only run pipelines whose output is missing or older than the input")
+    status = commands.add_parser("status", help="show one or all backfills")
+    status.add_argument("backfill_id", nargs="?")
+    cancel = commands.add_parser("cancel", help="stop a running backfill")
+    cancel.add_argument("backfill_id")
+    args = parser.parse_args(argv)
+
+    if args.command == "start":
+        result = _request("POST", "/backfill", {"bucket": args.bucket, "prefix": args.prefix, "pipelines": args.pipelines, "mode": args.mode})
+    elif args.command == "status":
+        result = _request("GET", f"/backfill/{args.backfill_id}" if args.backfill_id else "/backfill")
+    else:
+        result = _request("DELETE", f"/backfill/{args.backfill_id}")
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
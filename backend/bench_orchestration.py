@@ -0,0 +1,51 @@
+"""Events per second of a pipeline with a Prefect task run per step and with its steps inline in one flow run
+
+    python bench_orchestration.py alphabot-logs-bucket alphabot_001103_2024_08_10_09_16_52.txt [--pipeline minio_txt_to_minio] [--events 50] [--concurrency 8]
+
+Runs the pipeline on an existing object --events times in each mode, --concurrency runs at a time like
+the dispatcher's flow workers, against the configured Prefect API, MinIO and Mongo. The pipeline's
+output is rewritten on every run (prescan inserts a prescan record per run).
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import PIPELINE_CONFIGS
+from flow_worker import load_flow, run_flow
+from router import PipelineRouter, pipeline_name
+
+MODES = {"tasks": False, "flow": True}
+
+def measure(route, events, concurrency, inline):
+    flow = load_flow(route.config.prefect_flow)
+    args = (route.src, route.object_name, route.dest, route.dest_object_name)
+    name = pipeline_name(route.config)
+    with ThreadPoolExecutor(concurrency) as pool:
+        # one run first so imports, client connections and the flow's registration are not measured
+        run_flow(name, flow, *args, inline=inline)
+        started = time.perf_counter()
+        list(pool.map(lambda _: run_flow(name, flow, *args, inline=inline), range(events)))
+        return events / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bucket")
+    parser.add_argument("object_name")
+    parser.add_argument("--pipeline", default="minio_txt_to_minio", help="flow name of the pipeline to run")
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    routes = [route for route in PipelineRouter(PIPELINE_CONFIGS).route(args.bucket, args.object_name) if pipeline_name(route.config) == args.pipeline]
+    if not routes:
+        sys.exit(f"{args.pipeline} does not run on {args.bucket}/{args.object_name}")
+
+    results = {mode: measure(routes[0], args.events, args.concurrency, inline) for mode, inline in MODES.items()}
+    print(f"{'':8}{'events/s':>10}")
+    for mode, rate in results.items():
+        print(f"{mode:8}{rate:>10.1f}")
+    print(f"inline steps are {results['flow'] / results['tasks']:.1f}x faster")
+
+if __name__ == "__main__":
+    main()
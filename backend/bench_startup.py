@@ -0,0 +1,54 @@
+"""Startup cost of the flows API: import time, imported modules and peak RSS, measured in fresh interpreters
+
+    python bench_startup.py [--runs 5] [--target config|api]
+
+"lazy" is what the API pays now that pipelines are configured by import path, "eager" additionally
+resolves every configured flow, which is what importing config.py used to do.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import {target}
+imported = time.perf_counter()
+if {eager}:
+    from config import PIPELINE_CONFIGS
+    from flow_worker import load_flow
+    for pipeline in PIPELINE_CONFIGS:
+        load_flow(pipeline.prefect_flow)
+print(json.dumps({{
+    "seconds": time.perf_counter() - started,
+    "import_seconds": imported - started,
+    "modules": len(sys.modules),
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}}))
+"""
+
+def measure(target, eager, runs):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", PROBE.format(target=target, eager=eager)], capture_output=True, text=True)
+        if result.returncode:
+            sys.exit(result.stderr)
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", default="config", choices=["config", "api"])
+    args = parser.parse_args()
+
+    results = {mode: measure(args.target, mode == "eager", args.runs) for mode in ("lazy", "eager")}
+    print(f"{'':8}{'seconds':>10}{'modules':>10}{'max rss MB':>12}")
+    for mode, result in results.items():
+        print(f"{mode:8}{result['seconds']:>10.3f}{result['modules']:>10.0f}{result['max_rss_mb']:>12.1f}")
+    print(f"lazy startup is {results['eager']['seconds'] / results['lazy']['seconds']:.1f}x faster")
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,51 @@ import sys
 sys.path.append('./flows/')
 
 from collections import namedtuple
-from flows.templates.minio_csv_to_minio import minio_csv_to_minio
-from flows.templates.minio_txt_to_minio import minio_txt_to_minio
-from flows.templates.minio_to_mongo import minio_to_mongo
-from flows.instability.instability import motor_fault_detection_flow
-from flows.collector.prescan import prescan_flow
-from command.move_event_flow import logfisher_summary_to_move_events_plot_flow
-from snapstat import snapstat_fingerprints
-from controls_report import controls_report
-
-from logfisher_summary_flow import alphabot_log_to_logfisher_summary_flow
 
+import logging
 import subprocess
 import sys
 from minio import Minio
-from minio.error import S3Error
+from minio.credentials import StaticProvider
+from minio.minioadmin import MinioAdmin
 import os
 
-ALIAS_NAME = "myminio"
 MINIO_URL = os.getenv('MINIO_URL', "http://localhost:9000")
 ACCESS_KEY = "password"
 SECRET_KEY = "password"
 
-# Initialize MinIO client
-client = Minio(
-    MINIO_URL.replace("http://", ""),
-    access_key=ACCESS_KEY,
-    secret_key=SECRET_KEY,
-    secure=False
-)
+def minio_client():
+    # only configure() talks to minio, the api and flows have their own clients
+    return Minio(
+        MINIO_URL.replace("http://", ""),
+        access_key=ACCESS_KEY,
+        secret_key=SECRET_KEY,
+        secure=False
+    )
+
+def minio_admin():
+    return MinioAdmin(
+        MINIO_URL.replace("http://", ""),
+        credentials=StaticProvider(ACCESS_KEY, SECRET_KEY),
+        secure=False
+    )
 
 # Define the namedtuple for pipeline configuration
-PipelineConfig = namedtuple('PipelineConfig', ['desc', 'src', 'dest', 'dest_obj_suffix', 'prefect_flow', 'regex_trigger', 'faults_trigger'])
+# stage: pipelines run in ascending stage order per event batch, stage 0 (prescan) feeds the faults_trigger gates of later stages
+# regex_trigger: must match the whole object name, escape the "." of extensions
+# faults_trigger: "*" runs on every object, else the fatal fault codes of the log that run the pipeline, an empty list disables it
+# src and dest must be buckets of BUCKET_CONFIGS (dest "mongo" for pipelines writing to MongoDB), the API refuses to start otherwise
+# lane: scheduler priority lane (critical, standard, bulk), max_concurrency: cap on simultaneous runs of the pipeline
+# prefect_flow: the flow, or its "module:attribute" import path which is only imported when the pipeline first runs
+# executor: "thread" runs the flow in the API process, "process" in a warm worker process for CPU bound pure python flows,
+#   "deployment" submits it to the flow's Prefect deployment (see deploy_pipelines.py) for workers on other nodes
+# deferrable: low value pipelines whose runs are set aside while the system is overloaded and replayed later
+# orchestration: "tasks" records every @step as a Prefect task run, "flow" runs the steps as plain calls inside one flow run
+# batch_flow: import path of a variant of the flow taking a list of (src, object, dest, dest object), runs of several objects are grouped into it
+# deployment: deployment name used with the "deployment" executor, DEPLOYMENT_NAME ("etl") when None
+# output_suffixes: suffixes of the objects the flow writes to dest after the input's stem, for flows that do not write
+#   <stem><dest_obj_suffix>, gap backfills check them to tell whether the pipeline already ran on an input
+PipelineConfig = namedtuple('PipelineConfig', ['desc', 'src', 'dest', 'dest_obj_suffix', 'prefect_flow', 'regex_trigger', 'faults_trigger', 'stage', 'lane', 'max_concurrency', 'executor', 'deferrable', 'orchestration', 'batch_flow', 'deployment', 'output_suffixes'], defaults=(1, "standard", None, "thread", False, "tasks", None, None, None))
 
 # Define the configurations for the pipelines directly
 PIPELINE_CONFIGS = [
@@ -42,78 +55,102 @@ PIPELINE_CONFIGS = [
         src="alphabot-logs-bucket",
         dest="logfisher-summaries",
         dest_obj_suffix="_summary.txt",
-        prefect_flow=alphabot_log_to_logfisher_summary_flow,
-        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*.txt',
+        prefect_flow="logfisher_summary_flow.logfisher_summary_flow:alphabot_log_to_logfisher_summary_flow",
+        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*\.txt',
         faults_trigger="*",
+        executor="process",
     ),
     PipelineConfig(
         desc="Generate move events plot from logfisher summary",
         src="logfisher-summaries",
         dest="plots",
         dest_obj_suffix="_move_events.html",
-        prefect_flow=logfisher_summary_to_move_events_plot_flow,
-        regex_trigger=r'.*_summary.txt',
+        prefect_flow="command.move_event_flow:logfisher_summary_to_move_events_plot_flow",
+        regex_trigger=r'.*_summary\.txt',
         faults_trigger="*",
+        lane="bulk",
+        deferrable=True,
     ),
     PipelineConfig(
         desc="Generate controls report from logs",
         src="alphabot-logs-bucket",
         dest="plots",
         dest_obj_suffix="_controls_report.html",
-        prefect_flow=controls_report.controls_report_flow,
-        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data.csv',
-        faults_trigger=["05_12_00"," 05_0E_00"],
+        prefect_flow="controls_report.controls_report:controls_report_flow",
+        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data\.csv',
+        faults_trigger=["05_12_00", "05_0E_00"],
+        lane="bulk",
+        max_concurrency=2,
+        output_suffixes=("-report.html", "-analysis.tar.gz"),
     ),
     PipelineConfig(
         desc="Generate instability plot from logs",
         src="alphabot-logs-bucket",
         dest="plots",
         dest_obj_suffix="_instability_plot.png",
-        prefect_flow=motor_fault_detection_flow,
-        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data.csv',
+        prefect_flow="flows.instability.instability:motor_fault_detection_flow",
+        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data\.csv',
         faults_trigger=["0C_0B_00"],
+        lane="bulk",
+        max_concurrency=2,
     ),
     PipelineConfig(
         desc="Transform TXT logs and store in summary bucket",
         src="alphabot-logs-bucket",
         dest="alphabot-logs-summary-bucket",
         dest_obj_suffix="_transformed.txt",
-        prefect_flow=minio_txt_to_minio,
-        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*.txt',
+        prefect_flow="flows.templates.minio_txt_to_minio:minio_txt_to_minio",
+        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*\.txt',
         faults_trigger="*",
+        lane="bulk",
+        deferrable=True,
+        orchestration="flow",
+        batch_flow="flows.templates.minio_txt_to_minio:minio_txt_to_minio_batch",
     ),
     PipelineConfig(
         desc="Prescan TXT logs and store metadata in MongoDB",
         src="alphabot-logs-bucket",
-        dest="mongo", dest_obj_suffix="none", prefect_flow=prescan_flow, regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*.txt',
+        dest="mongo", dest_obj_suffix="none", prefect_flow="flows.collector.prescan:prescan_flow", regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*\.txt',
         faults_trigger="*",
+        stage=0,
+        lane="critical",
+        orchestration="flow",
+        batch_flow="flows.collector.prescan:prescan_batch_flow",
     ),
     PipelineConfig(
         desc="Transform CSV logs and store in MongoDB",
         src="alphabot-logs-bucket",
         dest="mongo",
         dest_obj_suffix="none",
-        prefect_flow=minio_to_mongo,
-        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data.csv',
-        faults_trigger=["disabled, template"],
+        prefect_flow="flows.templates.minio_to_mongo:minio_to_mongo",
+        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data\.csv',
+        faults_trigger=[],  # disabled, template
+        lane="bulk",
     ),
     PipelineConfig(
         desc="Transform CSV logs and store in summary bucket",
         src="alphabot-logs-bucket",
-        dest="alphabot-logs-s-bucket",
+        dest="alphabot-logs-summary-bucket",
         dest_obj_suffix="_transformed.csv",
-        prefect_flow=minio_csv_to_minio,
-        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data.csv',
-        faults_trigger=["disabled, template"],
+        prefect_flow="flows.templates.minio_csv_to_minio:minio_csv_to_minio",
+        regex_trigger=r'alphabot_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*_[0-9]*-data\.csv',
+        faults_trigger=[],  # disabled, template
+        lane="bulk",
+        deferrable=True,
+        orchestration="flow",
+        batch_flow="flows.templates.minio_csv_to_minio:minio_csv_to_minio_batch",
     ),
     PipelineConfig(
         desc="Generate snapstat fingerprints from logs",
         src="alphabot-logs-bucket",
-        dest="alphabot-logs-summary-bucket",
-        dest_obj_suffix="_snapstat_fingerprints.txt",
-        prefect_flow=snapstat_fingerprints,
-        regex_trigger=r'alphabot_snapstat.*.txt',
+        # the fingerprints are inserted into MongoDB, nothing is written to a bucket
+        dest="mongo",
+        dest_obj_suffix="none",
+        prefect_flow="snapstat.snapstat_fingerprints_flow:snapstat_fingerprints",
+        regex_trigger=r'alphabot_snapstat.*\.txt',
         faults_trigger=["05_0E_00", "05_12_00"],
+        max_concurrency=4,
+        executor="process",
     ),
 ]
 
@@ -141,103 +178,13 @@ BUCKET_CONFIGS = [
     ),
 ]
 
-def restart_minio_server():
-    try:
-        subprocess.run(["mc", "admin", "service", "restart", "myminio"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to restart service: {e}")
-        # Add additional logging or error handling here
-
-
-def reset_webhooks():
-    def get_webhook_configs():
-        # Run the mc admin config get command and capture the output
-        result = subprocess.run(
-            ["mc", "admin", "config", "get", "myminio/", "notify_webhook"],
-            capture_output=True,
-            text=True
-        )
-        return result.stdout
-
-    def extract_webhook_names(config_output):
-        # Extract webhook names from the config output
-        webhook_names = []
-        for line in config_output.splitlines():
-            if line.startswith("notify_webhook:"):
-                webhook_name = line.split()[0].split(":")[1]
-                webhook_names.append(webhook_name)
-        return webhook_names
-
-    def reset_webhook_configs(webhook_names):
-        # Reset each webhook configuration
-        for name in webhook_names:
-            subprocess.run(["mc", "admin", "config", "reset", "myminio", f"notify_webhook:{name}"])
-            print(f"Reset webhook configuration: {name}")
-        restart_minio_server()
-
-    config_output = get_webhook_configs()
-    webhook_names = extract_webhook_names(config_output)
-    reset_webhook_configs(webhook_names)
-
 def configure():
+    # imported here, the api imports this module only for the pipeline and bucket configs
+    from webhooks import WebhookReconciler
 
-    def set_mc_alias():
-        command = ["mc", "alias", "set", ALIAS_NAME, MINIO_URL, ACCESS_KEY, SECRET_KEY]
-        result = subprocess.run(command, capture_output=True, text=True)
-        print("Alias set successfully." if result.returncode == 0 else f"Failed to set alias.\nError: {result.stderr}")
-
-    set_mc_alias()
-    reset_webhooks()
-    for config in BUCKET_CONFIGS:
-        bucket_name = config.name
-
-        # Check if the bucket already exists
-        try:
-            if not client.bucket_exists(bucket_name):
-                # Create the bucket if it does not exist
-                client.make_bucket(bucket_name)
-                print(f"Bucket {bucket_name} created.")
-            else:
-                print(f"Bucket {bucket_name} already exists.")
-        except S3Error as err:
-            print(f"Error checking/creating bucket {bucket_name}: {err}")
-
-        # Configure webhook for each bucket
-        try:
-            notify_webhooks = config.notify_webhooks
-            if notify_webhooks == [""]:
-                continue
-
-            subprocess.run(["mc", "event", "remove", f"{ALIAS_NAME}/{bucket_name}", "--force"])
-
-            # Check existing webhook configuration
-            result = subprocess.run(
-                ["mc", "admin", "config", "get", f"{ALIAS_NAME}/", f"notify_webhook:{bucket_name}"],
-                capture_output=True, text=True
-            )
-            current_config = result.stdout
-
-            # Set all new webhooks at once
-            for i, url in enumerate(config.notify_webhooks):
-                subprocess.run([
-                    "mc", "admin", "config", "set", f"{ALIAS_NAME}/",
-                    f"notify_webhook:{bucket_name}_{i}",
-                    f"endpoint={url}",
-                    "auth_token=", "queue_limit=0", "queue_dir=",
-                    "client_cert=", "client_key="
-                ])
-                restart_minio_server()
-                subprocess.run([
-                    "mc", "event", "add", f"{ALIAS_NAME}/{bucket_name}",
-                    f"arn:minio:sqs::{bucket_name}_{i}:webhook", "--event", "put"
-                ])
-                print(f"Webhook configured for bucket {bucket_name}.")
-        except Exception as e:
-            print(f"Error configuring webhook for bucket {bucket_name}: {e}")
-
-    # Restart MinIO service
-    restart_minio_server()
-    print("MinIO service restarted.")
+    logging.basicConfig(level=logging.INFO)
+    # buckets, webhook targets and bucket notifications, MinIO restarts at most once
+    WebhookReconciler(minio_client(), minio_admin(), BUCKET_CONFIGS).reconcile()
 
     # Set Prefect concurrency limit
     subprocess.run(["prefect", "gcl", "create", "my-concurrency-limit", "--limit", "10", "--slot-decay-per-second", "1.0"])
@@ -245,4 +192,3 @@ def configure():
 
 if __name__ == "__main__":
     configure()
-
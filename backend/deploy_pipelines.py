@@ -0,0 +1,61 @@
+"""Create the Prefect deployments of the pipelines dispatched with executor="deployment"
+
+    python deploy_pipelines.py [--work-pool work-pool-alpha] [--pipeline prescan_flow ...]
+
+Each pipeline's flow, and its batch_flow, is deployed as "<flow name>/<deployment>" (PipelineConfig.deployment,
+DEPLOYMENT_NAME by default) to the work pool with its code loaded from this directory, so workers need the
+same image or checkout at the same path (flows/collector/deployment/start_work_pool.sh starts a process worker).
+"""
+import argparse
+import inspect
+import os
+import sys
+
+from config import PIPELINE_CONFIGS
+from flow_worker import DEPLOYMENT_NAME, deployment_name, flow_parameters, load_flow
+from router import pipeline_name
+
+DEPLOYMENT_WORK_POOL = os.getenv("DEPLOYMENT_WORK_POOL", "work-pool-alpha")
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# positional arguments the dispatcher runs a flow with: (src bucket, object, dest bucket, dest object), batch flows (objects, max_workers)
+FLOW_ARITY = 4
+BATCH_FLOW_ARITY = 2
+
+def entrypoint(flow):
+    # "path/to/module.py:function" relative to the deployment's source directory
+    return f"{os.path.relpath(inspect.getsourcefile(flow.fn), SOURCE_DIR)}:{flow.fn.__name__}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--work-pool", default=DEPLOYMENT_WORK_POOL)
+    parser.add_argument("--pipeline", action="append", dest="pipelines", help="deploy this pipeline (flow name) even if it runs in process, can be repeated")
+    args = parser.parse_args()
+
+    if args.pipelines:
+        configs = [config for config in PIPELINE_CONFIGS if pipeline_name(config) in args.pipelines]
+    else:
+        configs = [config for config in PIPELINE_CONFIGS if config.executor == "deployment"]
+    if not configs:
+        sys.exit("no pipeline to deploy, set executor=\"deployment\" in PIPELINE_CONFIGS or name pipelines with --pipeline")
+
+    flows = [(config, path) for config in configs for path in (config.prefect_flow, config.batch_flow) if path]
+    # deployment parameters are bound to each flow's signature, check them all before deploying any
+    errors = []
+    for config, path in flows:
+        try:
+            flow_parameters(path, (None,) * (BATCH_FLOW_ARITY if path == config.batch_flow else FLOW_ARITY))
+        except TypeError as e:
+            errors.append(f"{pipeline_name(config)}: {path} does not take the arguments the dispatcher runs it with: {e}")
+    if errors:
+        sys.exit("\n".join(errors))
+
+    for config, path in flows:
+        flow = load_flow(path)
+        flow.from_source(source=SOURCE_DIR, entrypoint=entrypoint(flow)).deploy(
+            name=config.deployment or DEPLOYMENT_NAME,
+            work_pool_name=args.work_pool,
+        )
+        print(f"{deployment_name(path, config.deployment)} -> {args.work_pool}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+import asyncio
+import logging
+import os
+import time
+from collections import namedtuple
+from functools import partial
+from urllib.parse import unquote_plus
+
+from etl_shared.batches import BATCH_CONCURRENCY
+from etl_shared.metrics import REGISTRY
+from flow_worker import flow_path, run_deployment_flow, run_flow, run_flow_in_worker
+from prescan_cache import log_name
+from router import is_precompressed_copy, pipeline_name
+
+EventRecord = namedtuple('EventRecord', ['bucket', 'key', 'etag'])
+
+ROUTING_SECONDS = REGISTRY.histogram("etl_routing_seconds", "Time to route one event record to its pipelines", ("bucket",), buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+ROUTED_RUNS = REGISTRY.counter("etl_routed_runs_total", "Pipeline runs matched by routing, before fault gates and deduplication", ("pipeline",))
+
+# pipelines in this stage produce the prescan record that fault gated pipelines are matched against
+PRESCAN_STAGE = 0
+# objects per run of a pipeline's batch_flow
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "50"))
+# below this queue depth events are dispatched one at a time, each object keeps its own flow run
+BATCH_MIN_DEPTH = int(os.getenv("BATCH_MIN_DEPTH", "20"))
+
+def event_records(event_data):
+    # minio may batch several records into one notification, keys arrive url-encoded
+    records = []
+    for record in event_data.get('Records', []):
+        s3 = record.get('s3', {})
+        key = s3.get('object', {}).get('key')
+        if not key:
+            logging.error(f"[ ERROR ] Skipping record without object key: {record}")
+            continue
+        records.append(EventRecord(s3.get('bucket', {}).get('name'), unquote_plus(key), s3.get('object', {}).get('eTag')))
+    return records
+
+def without_precompressed_copies(event_data):
+    """The event without the records of precompressed copies, None when no other record is left
+
+    Flows write .gz/.br copies next to their text artifacts, each one notifies the bucket's
+    webhook like the artifact itself. Dropping them before the queue saves a queued, claimed
+    and routed job per copy that no pipeline would run on.
+    """
+    records = event_data.get('Records', [])
+    kept = [
+        record for record in records
+        if not is_precompressed_copy(unquote_plus(record.get('s3', {}).get('object', {}).get('key') or ""))
+    ]
+    if len(kept) == len(records):
+        return event_data
+    return {**event_data, 'Records': kept} if kept else None
+
+def is_fault_gated(config):
+    # compiled configs, faults_trigger is None for "*" and a frozenset of fault codes otherwise
+    return config.faults_trigger is not None
+
+def idempotency_key(route):
+    return (route.src, route.object_name, (route.etag or "").strip('"'), pipeline_name(route.config))
+
+def batch_size(queue_depth, workers):
+    """Events a queue worker claims at once: one while the queue is short, else its share of the backlog up to BATCH_MAX_SIZE"""
+    if queue_depth < BATCH_MIN_DEPTH:
+        return 1
+    return max(1, min(BATCH_MAX_SIZE, queue_depth // max(workers, 1)))
+
+async def claim_queued_jobs(job_queue, workers, coalesce_seconds=0, max_events=BATCH_MAX_SIZE):
+    """Claim the queued jobs of one dispatch
+
+    Without a coalescing window a worker claims batch_size() jobs. With one it claims up to
+    max_events jobs, then waits coalesce_seconds for the rest of an upload storm and claims
+    whatever arrived meanwhile, up to max_events in total.
+    """
+    loop = asyncio.get_running_loop()
+    if not coalesce_seconds:
+        # under backlog claim several events so pipelines with a batch flow process them in one run
+        depth = await loop.run_in_executor(None, job_queue.depth)
+        return await loop.run_in_executor(None, job_queue.claim, batch_size(depth, workers))
+
+    jobs = await loop.run_in_executor(None, job_queue.claim, max_events)
+    if jobs and len(jobs) < max_events:
+        # give the rest of the burst time to arrive, then take everything queued meanwhile
+        await asyncio.sleep(coalesce_seconds)
+        jobs += await loop.run_in_executor(None, job_queue.claim, max_events - len(jobs))
+    return jobs
+
+def flow_calls(runs):
+    """(config, flow, args, routes) of each flow call for the {(flow, *args): route} runs of a stage
+
+    Runs of a pipeline with a batch_flow are grouped into calls of it with up to BATCH_MAX_SIZE
+    objects, the other runs (and batches of one) call the pipeline's flow per object.
+    """
+    calls = []
+    grouped = {}
+    for (flow, *args), route in runs.items():
+        if route.config.batch_flow:
+            grouped.setdefault(flow, []).append((tuple(args), route))
+        else:
+            calls.append((route.config, flow, tuple(args), [route]))
+    for flow, items in grouped.items():
+        for start in range(0, len(items), BATCH_MAX_SIZE):
+            chunk = items[start:start + BATCH_MAX_SIZE]
+            config = chunk[0][1].config
+            if len(chunk) == 1:
+                calls.append((config, flow, chunk[0][0], [chunk[0][1]]))
+            else:
+                calls.append((config, config.batch_flow, ([args for args, _ in chunk],), [route for _, route in chunk]))
+    return calls
+
+def run_errors(routes, result):
+    """Error of each route of a flow call, None for the routes that went through"""
+    if isinstance(result, Exception):
+        return [result] * len(routes)
+    if len(routes) == 1 or result is None:
+        # a batch run through a deployment only returns its rows when the flow persists results
+        return [None] * len(routes)
+    # batch flows return one result row per object, in order
+    return [row["error"] if row["status"] == "failed" else None for row in result]
+
+async def dispatch_jobs(dispatcher, job_queue, jobs):
+    """Dispatch the events of claimed queue jobs, returns (job, status, error) of the jobs that failed
+
+    Jobs whose runs all went through are acked. A job with a failed run, or all of them when the
+    dispatch itself raised, is fail()ed: requeued for another attempt, or parked as failed once it
+    ran out of attempts. Its runs that went through are done in the idempotency store, so the
+    retry only runs the failed pipelines again.
+    """
+    loop = asyncio.get_running_loop()
+    records = {job.id: event_records(job.payload) for job in jobs}
+    logging.info(f"EVENT_DATA: {[job.payload for job in jobs]}")
+    logging.info(f"EVENT_DATA_FILENAMES: {[record.key for job_records in records.values() for record in job_records]}")
+
+    failed = []
+    try:
+        await dispatcher.dispatch([record for job_records in records.values() for record in job_records], failed=failed)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        errors = {job.id: e for job in jobs}
+    else:
+        failed_objects = {}
+        for route, error in failed:
+            failed_objects.setdefault((route.src, route.object_name), error)
+        errors = {}
+        for job in jobs:
+            for record in records[job.id]:
+                error = failed_objects.get((record.bucket, record.key))
+                if error is not None:
+                    errors[job.id] = error if isinstance(error, Exception) else RuntimeError(error)
+                    break
+
+    done = [job.id for job in jobs if job.id not in errors]
+    if done:
+        await loop.run_in_executor(None, partial(job_queue.ack, *done))
+    failures = []
+    for job in jobs:
+        if job.id in errors:
+            status = await loop.run_in_executor(None, job_queue.fail, job, errors[job.id])
+            failures.append((job, status, errors[job.id]))
+    return failures
+
+class Dispatcher:
+    """Routes event records and runs the matching pipelines stage by stage
+
+    Pipelines run in ascending PipelineConfig.stage order. Fault gated pipelines (faults_trigger
+    other than "*") are only scheduled once the prescan stage of the batch has finished and the
+    log's fatal_fault_code is one of their faults_trigger codes. When prescan finishes it also
+    picks up gated objects of the same log that were uploaded before the prescan record existed.
+    Runs already dispatched for the same object content are skipped through the idempotency store,
+    the remaining runs go through the scheduler in their pipeline's lane. Their claims stay in
+    progress (renewed by renew_claims()) until the run succeeds, failed or cancelled runs are
+    released so a retry or the replay of the event runs them again. Under load the shedder sets
+    runs of deferrable pipelines aside.
+    """
+
+    def __init__(self, router, prescan_cache, minio_client, scheduler, idempotency=None, shedder=None):
+        self.router = router
+        self.prescan_cache = prescan_cache
+        self.minio_client = minio_client
+        self.scheduler = scheduler
+        self.idempotency = idempotency
+        self.shedder = shedder
+        # idempotency keys claimed by runs still in flight
+        self.in_flight = set()
+        self.stages = sorted({config.stage for config in router.configs})
+        for config in router.configs:
+            scheduler.set_limit(pipeline_name(config), config.max_concurrency)
+
+    async def faults_match(self, route):
+        if not is_fault_gated(route.config):
+            return True
+        prescan_metadata = await self.prescan_cache.get(log_name(route.object_name))
+        fatal_fault = prescan_metadata.get("fatal_fault_code") if prescan_metadata else None
+        if fatal_fault not in route.config.faults_trigger:
+            logging.info(f"[ FAULT GATE ][{pipeline_name(route.config)}] not running on [{route.object_name}], fatal fault {fatal_fault} not in {sorted(route.config.faults_trigger)}")
+            return False
+        return True
+
+    def _list_log_objects(self, bucket_name, prefix):
+        return [(obj.object_name, obj.etag) for obj in self.minio_client.list_objects(bucket_name, prefix=prefix)]
+
+    async def prescanned_sibling_routes(self, prescan_routes):
+        # objects of a freshly prescanned log that only gated pipelines were waiting on
+        routes = []
+        for bucket_name, name in {(route.src, log_name(route.object_name)) for route in prescan_routes}:
+            try:
+                object_names = await asyncio.get_running_loop().run_in_executor(None, self._list_log_objects, bucket_name, name)
+            except Exception as e:
+                logging.error(f"[ ERROR ] Failed to list objects of {bucket_name}/{name}: {e}")
+                continue
+            for object_name, etag in object_names:
+                if log_name(object_name) != name:
+                    continue
+                routes.extend(
+                    route for route in self.router.route(bucket_name, object_name, etag)
+                    if route.config.stage > PRESCAN_STAGE and is_fault_gated(route.config)
+                )
+        return routes
+
+    async def claim_new(self, routes, held=None):
+        # drop runs that were already dispatched for this exact object content, the ones still in progress elsewhere go to held
+        if self.idempotency is None or not routes:
+            return routes
+        keys = [idempotency_key(route) for route in routes]
+        claimed, in_progress = await asyncio.get_running_loop().run_in_executor(None, self.idempotency.claim, keys)
+        claimed = set(claimed)
+        in_progress = set(in_progress)
+        self.in_flight.update(claimed)
+        fresh = []
+        for route, key in zip(routes, keys):
+            if key in claimed:
+                claimed.discard(key)
+                fresh.append(route)
+            else:
+                if held is not None and key in in_progress:
+                    held.append(route)
+                logging.info(f"[ DUPLICATE ][{pipeline_name(route.config)}] already dispatched [{route.src}/{route.object_name}] etag {key[2]}")
+        return fresh
+
+    async def _settle(self, action, routes):
+        if self.idempotency is None or not routes:
+            return
+        keys = [idempotency_key(route) for route in routes]
+        await asyncio.get_running_loop().run_in_executor(None, getattr(self.idempotency, action), keys)
+        self.in_flight.difference_update(keys)
+
+    async def complete(self, routes):
+        await self._settle("complete", routes)
+
+    async def release(self, routes):
+        await self._settle("release", routes)
+
+    def _release_now(self, routes):
+        # called while being cancelled, the claims must not wait for an executor that may be shutting down
+        keys = [idempotency_key(route) for route in routes]
+        try:
+            self.idempotency.release(keys)
+        except Exception as e:
+            logging.error(f"[ ERROR ] Failed to release the claims of cancelled runs, they lapse after the claim timeout: {e}")
+        self.in_flight.difference_update(keys)
+
+    async def renew_claims(self):
+        """Keep the claims of runs still in flight from lapsing"""
+        if self.idempotency is not None and self.in_flight:
+            await asyncio.get_running_loop().run_in_executor(None, self.idempotency.renew, list(self.in_flight))
+
+    async def schedule(self, config, flow, args):
+        name = pipeline_name(config)
+        inline = config.orchestration == "flow"
+        width = 1
+        if flow == config.batch_flow:
+            # a batch processes several objects at a time, it takes that many slots of the scheduler
+            width = self.scheduler.width(name, config.executor, min(BATCH_CONCURRENCY, len(args[0])))
+            args = (*args, width)
+        if config.executor == "deployment":
+            # the deployment's flow runs on a Prefect worker, parameters come from the routing decision
+            return await self.scheduler.run(config.lane, name, run_deployment_flow, name, flow, config.deployment, *args, executor="deployment", width=width)
+        if config.executor == "process":
+            # worker processes resolve the flow from its import path, flow objects do not pickle
+            run = partial(run_flow_in_worker, inline=inline)
+            drained, result, error = await self.scheduler.run(config.lane, name, run, flow_path(flow), name, *args, executor="process", width=width)
+            REGISTRY.merge(drained)
+            if error is not None:
+                raise error
+            return result
+        return await self.scheduler.run(config.lane, name, partial(run_flow, inline=inline), name, flow, *args, width=width)
+
+    async def submit(self, routes):
+        # submit the whole stage at once, the scheduler orders the runs by lane and pipeline caps
+        runs = {}
+        for route in routes:
+            runs.setdefault((route.config.prefect_flow, route.src, route.object_name, route.dest, route.dest_object_name), route)
+
+        calls = flow_calls(runs)
+        results = await asyncio.gather(*(
+            self.schedule(config, flow, args)
+            for config, flow, args, _ in calls
+        ), return_exceptions=True)
+
+        batches = {}
+        for flow, *args in runs:
+            batches.setdefault(flow, []).append(tuple(args))
+        failed = []
+        for (config, _, _, call_routes), result in zip(calls, results):
+            # one failing flow, or object of a batch, should not take the others down
+            for route, error in zip(call_routes, run_errors(call_routes, result)):
+                if error is not None:
+                    logging.error(f"[ FLOW FAILED ][{pipeline_name(config)}] {route.object_name}: {error}")
+                    failed.append((route, error))
+        return batches, failed
+
+    async def dispatch(self, records, pipelines=None, held=None, failed=None, deferred=None):
+        """Run the pipelines matching the records, only those named in `pipelines` when given
+
+        Routes skipped because another dispatch still holds their claim in progress are appended
+        to `held` when given, they are not done yet and may still fail or be abandoned. A failing
+        run does not stop the others, (route, error) of each failed run is appended to `failed`
+        when given. Routes the load shedder set aside are appended to `deferred` when given.
+        """
+        routes_by_stage = {}
+        for record in records:
+            started = time.perf_counter()
+            routes = self.router.route(record.bucket, record.key, record.etag)
+            ROUTING_SECONDS.observe(time.perf_counter() - started, str(record.bucket))
+            if pipelines:
+                routes = [route for route in routes if pipeline_name(route.config) in pipelines]
+            if not routes:
+                logging.info(f"[ END CHECKS ] no pipeline matches [{record.bucket}/{record.key}]")
+            for route in routes:
+                ROUTED_RUNS.inc(1, pipeline_name(route.config))
+                logging.info(f"[ GUARD ][{pipeline_name(route.config)}] OBJ_NAME_REGEX_TRIGGER_MATCH: [{record.bucket}/{record.key}] matches [{route.config.regex_trigger}]")
+                routes_by_stage.setdefault(route.config.stage, []).append(route)
+
+        dispatched = {}
+        for stage in self.stages:
+            stage_routes = [route for route in routes_by_stage.get(stage, []) if await self.faults_match(route)]
+            if self.shedder is not None:
+                # before claiming, a deferred run must not count as dispatched when it is replayed
+                kept = await self.shedder.shed(stage_routes)
+                if deferred is not None:
+                    deferred.extend(route for route in stage_routes if route not in kept)
+                stage_routes = kept
+            stage_routes = await self.claim_new(stage_routes, held)
+            if stage_routes:
+                try:
+                    batches, stage_failed = await self.submit(stage_routes)
+                except asyncio.CancelledError:
+                    # shutting down or the lease was lost, the event is replayed and has to claim these runs again
+                    if self.idempotency is not None:
+                        self._release_now(stage_routes)
+                    raise
+                for flow, batch in batches.items():
+                    dispatched.setdefault(flow, []).extend(batch)
+                # forget failed runs so a retry or re-upload can run them again
+                failed_routes = [route for route, _ in stage_failed]
+                await self.release(failed_routes)
+                await self.complete([route for route in stage_routes if route not in failed_routes])
+                if failed is not None:
+                    failed.extend(stage_failed)
+
+            if stage == PRESCAN_STAGE and stage_routes:
+                for route in stage_routes:
+                    # record_saved_listeners only fire for prescans run in this process
+                    if route.config.executor != "thread":
+                        self.prescan_cache.invalidate(log_name(route.object_name))
+                for route in await self.prescanned_sibling_routes(stage_routes):
+                    if pipelines and pipeline_name(route.config) not in pipelines:
+                        continue
+                    routes_by_stage.setdefault(route.config.stage, []).append(route)
+        return dispatched
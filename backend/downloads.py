@@ -0,0 +1,166 @@
+import os
+import re
+import zlib
+from datetime import timedelta
+from email.utils import format_datetime
+from urllib.parse import urlparse
+
+from minio import Minio
+from minio.error import S3Error
+
+from etl_shared.storage import PRECOMPRESSED_SUFFIXES, SOURCE_ETAG_METADATA, brotli
+
+CHUNK_SIZE = int(os.getenv("GET_OBJECT_CHUNK_SIZE", str(1024 * 1024)))
+
+# "proxy" streams bytes through the API, "redirect" answers with a 307 to a presigned MinIO URL
+GET_OBJECT_MODE = os.getenv("GET_OBJECT_MODE", "proxy")
+# MinIO as reachable by whoever follows the artifact links, presigned URLs are signed for this host
+MINIO_PUBLIC_URL = os.getenv("MINIO_PUBLIC_URL", "http://localhost:9000")
+PRESIGNED_URL_EXPIRY = timedelta(seconds=int(os.getenv("PRESIGNED_URL_EXPIRY", "300")))
+
+# compress text artifacts for clients sending Accept-Encoding, ranges are always served uncompressed
+COMPRESS_RESPONSES = os.getenv("COMPRESS_RESPONSES", "true").lower() in ("1", "true", "yes")
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESSIBLE_EXTENSIONS = (".html", ".htm", ".txt", ".csv", ".json", ".log", ".md", ".svg", ".xml", ".js", ".css")
+# levels for compressing on the fly, lower than the precompressed copies to keep the API's CPU in check
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+# encodings the API can compress itself, brotli is optional
+STREAM_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range(range_header, size):
+    """Return the inclusive (start, end) byte range requested, or None to serve the whole object
+
+    Only single ranges are honoured, anything else (multiple ranges, other units, malformed
+    headers, a last byte before the first) falls back to a full 200 response as RFC 9110 allows.
+    RangeNotSatisfiable is only raised for a valid range that starts at or past the end of the object.
+    """
+    if not range_header:
+        return None
+    match = _RANGE_PATTERN.match(range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        # suffix range, the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        # an invalid range-spec (RFC 9110 14.1.1), ignored rather than unsatisfiable
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last), size - 1) if last else size - 1
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    # the compressed representations of the object carry its etag with the encoding appended
+    etags = {etag} | {encoded_etag(etag, encoding) for encoding in PRECOMPRESSED_SUFFIXES}
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/").strip('"') in etags for candidate in candidates)
+
+def encoded_etag(etag, encoding):
+    return f"{etag}-{encoding}"
+
+def is_compressible(object_name, size):
+    return COMPRESS_RESPONSES and size >= COMPRESS_MIN_BYTES and object_name.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+def accepted_encodings(accept_encoding):
+    """Content codings allowed by an Accept-Encoding header that the API can serve, most preferred first"""
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        quality = 1.0
+        params = params.strip().lower()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    ranked = [(qualities.get(encoding, qualities.get("*", 0.0)), encoding) for encoding in PRECOMPRESSED_SUFFIXES]
+    # sorted() is stable, equal qualities keep the server's preference (brotli first)
+    return [encoding for quality, encoding in sorted(ranked, key=lambda item: -item[0]) if quality > 0]
+
+def stream_encoding(encodings):
+    """First of the accepted encodings the API can compress on the fly, None when there is none"""
+    return next((encoding for encoding in encodings if encoding in STREAM_ENCODINGS), None)
+
+def precompressed_object(client, bucket_name, object_name, stat, encodings):
+    """(encoding, object name, stat) of a precompressed copy made from this version of the object, or None"""
+    for encoding in encodings:
+        sibling_name = f"{object_name}{PRECOMPRESSED_SUFFIXES[encoding]}"
+        try:
+            sibling = client.stat_object(bucket_name, sibling_name)
+        except S3Error:
+            continue
+        # a copy left over from an earlier version of the object would serve stale content
+        if sibling.metadata.get(f"x-amz-meta-{SOURCE_ETAG_METADATA}") == stat.etag:
+            return encoding, sibling_name, sibling
+    return None
+
+def compress_stream(chunks, encoding):
+    """Compress an iterator of byte chunks as they are read, memory stays bounded by the chunk size"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush = compressor.process, compressor.finish
+    else:
+        # wbits 31 writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, flush = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            compressed = compress(chunk)
+            if compressed:
+                yield compressed
+        yield flush()
+    finally:
+        chunks.close()
+
+def object_headers(stat, object_name):
+    return {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{stat.etag}"',
+        "Last-Modified": format_datetime(stat.last_modified, usegmt=True),
+        "Content-Disposition": f"attachment; filename={object_name}",
+    }
+
+def stream_object(response, chunk_size=CHUNK_SIZE):
+    """Yield an open MinIO response chunk by chunk and hand its connection back to the pool"""
+    try:
+        yield from response.stream(chunk_size)
+    finally:
+        response.close()
+        response.release_conn()
+
+def public_minio_client():
+    public_url = urlparse(MINIO_PUBLIC_URL)
+    # a fixed region keeps presigning purely local, no bucket location lookup against the public host
+    return Minio(
+        public_url.netloc,
+        access_key="password",
+        secret_key="password",
+        secure=public_url.scheme == "https",
+        region="us-east-1",
+    )
+
+def presigned_object_url(client, bucket_name, object_name, expires=PRESIGNED_URL_EXPIRY):
+    return client.presigned_get_object(
+        bucket_name,
+        object_name,
+        expires=expires,
+        response_headers={"response-content-disposition": f"attachment; filename={object_name}"},
+    )
@@ -0,0 +1,145 @@
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from etl_shared.metrics import REGISTRY, run_instrumented
+from etl_shared.steps import steps_inline
+
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", str(os.cpu_count() or 1)))
+# deployment runs in flight at once, each holds a thread polling its flow run until it finishes
+DEPLOYMENT_WORKERS = int(os.getenv("DEPLOYMENT_WORKERS", "32"))
+# default deployment name of a flow, pipelines can override it with PipelineConfig.deployment
+DEPLOYMENT_NAME = os.getenv("DEPLOYMENT_NAME", "etl")
+
+_flows = {}
+
+def flow_path(flow):
+    """Importable "module:attribute" path of a flow so worker processes can resolve it themselves"""
+    if isinstance(flow, str):
+        return flow
+    fn = getattr(flow, "fn", flow)
+    return f"{fn.__module__}:{fn.__qualname__}"
+
+def resolve_flow(path):
+    flow = _flows.get(path)
+    if flow is None:
+        module_name, _, attribute = path.partition(":")
+        flow = importlib.import_module(module_name)
+        for name in attribute.split("."):
+            flow = getattr(flow, name)
+        _flows[path] = flow
+    return flow
+
+def load_flow(flow):
+    """The flow itself, importing its module on first use when configured as an import path"""
+    return resolve_flow(flow) if isinstance(flow, str) else flow
+
+def run_flow(pipeline, flow, *args, inline=False):
+    # resolved on the executor thread, the first run of a pipeline pays for its imports off the event loop
+    with steps_inline(inline):
+        return run_instrumented(pipeline, load_flow(flow), *args)
+
+def flow_parameters(flow, args):
+    """{parameter name: value} of a run of flow with positional args, bound to the flow's own signature
+
+    Raises TypeError when the flow does not take these arguments.
+    """
+    flow = load_flow(flow)
+    return dict(inspect.signature(getattr(flow, "fn", flow)).bind(*args).arguments)
+
+def deployment_name(flow, deployment=None):
+    """"<flow name>/<deployment name>" of a flow, Prefect names flows after their function with dashes"""
+    flow_name = flow_path(flow).rpartition(":")[2].rpartition(".")[2].replace("_", "-")
+    return f"{flow_name}/{deployment or DEPLOYMENT_NAME}"
+
+def _run_deployment(name, parameters):
+    from prefect.deployments import run_deployment
+    flow_run = run_deployment(name, parameters=parameters, timeout=None)
+    if not flow_run.state.is_completed():
+        raise RuntimeError(f"flow run {flow_run.name} of {name} ended {flow_run.state.name}: {flow_run.state.message}")
+    try:
+        return flow_run.state.result()
+    except Exception:
+        # results are only available when the flow persists them
+        return None
+
+def run_deployment_flow(pipeline, flow, deployment, *args):
+    """Run a flow on whichever Prefect worker picks up its deployment and wait for it to finish
+
+    args are passed as the parameters they bind to in the flow's signature. Only the run's
+    duration and outcome are recorded here, the I/O metrics stay with the worker.
+    """
+    # bound on the executor thread, the first run of a pipeline pays for its imports off the event loop
+    parameters = flow_parameters(flow, args)
+    return run_instrumented(pipeline, _run_deployment, deployment_name(flow, deployment), parameters)
+
+def warm_worker(paths):
+    # import the flow modules (pandas, prefect, regex tables...) once when the worker starts
+    for path in paths:
+        resolve_flow(path)
+
+def run_flow_in_worker(path, pipeline, *args, inline=False):
+    """Run a flow in a worker process and return (metrics recorded by the run, flow result, error or None)
+
+    Metrics live in the process that records them, so the run's numbers are shipped back for the
+    API to merge into its own registry, including when the flow fails.
+    """
+    result = error = None
+    try:
+        with steps_inline(inline):
+            result = run_instrumented(pipeline, resolve_flow(path), *args)
+    except Exception as e:
+        # keep the error picklable whatever the flow raised
+        error = RuntimeError(f"{type(e).__name__}: {e}")
+    return REGISTRY.drain(), result, error
+
+def noop():
+    pass
+
+class WarmProcessPool(Executor):
+    """Process pool for CPU bound flows whose workers import their flows up front
+
+    Workers are spawned rather than forked, the API process already runs Mongo monitor and
+    executor threads that are not safe to fork. Spawned workers re-import the parent's main
+    module, so the API is started with `uvicorn api:app`: the main module is then uvicorn's
+    entry point and a worker only imports this module and its flows, whereas running api.py as
+    the main module would open every store and build another service in each worker.
+    A worker dying abruptly breaks a ProcessPoolExecutor for good, so a broken pool is replaced
+    on the next submit instead of failing every later run of the lane.
+    """
+
+    def __init__(self, paths, max_workers=PROCESS_WORKERS):
+        self.paths = tuple(paths)
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pool = self._create()
+
+    def _create(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_worker,
+            initargs=(self.paths,),
+        )
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            try:
+                return self._pool.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                logging.error("[ PROCESS POOL ] worker process died, starting a new pool")
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._create()
+                return self._pool.submit(fn, *args, **kwargs)
+
+    def start(self):
+        # the pool only spawns workers on demand, submitting one call per worker starts them all now
+        return [self.submit(noop) for _ in range(self.max_workers)]
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._pool.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -7,19 +7,10 @@ from joblib import dump, load
 from prefect import flow, task
 from prefect import get_run_logger#logger = get_run_logger()
 from prefect.artifacts import create_link_artifact
-from minio import Minio
+from etl_shared import minio_client
 from io import BytesIO
-import os
 from pathlib import Path
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
 
 # ----------------------------- Helper Functions -----------------------------
 
@@ -1,7 +1,7 @@
 from prefect import task, flow
 from prefect.artifacts import create_link_artifact
 from prefect import get_run_logger
-from minio import Minio
+from etl_shared import minio_client
 from minio.error import S3Error
 import pandas as pd
 import json
@@ -13,14 +13,6 @@ import subprocess
 import data_to_csvs
 from datetime import datetime, timedelta
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
 # Buckets
 ALPHABOT_LOGS_MINIO_BUCKET = "alphabot-logs-bucket"
 
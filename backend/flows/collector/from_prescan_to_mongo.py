@@ -1,20 +1,7 @@
 from prefect import task, flow
-from minio import Minio
-from pymongo import MongoClient
-import os
+from etl_shared import minio_client, mongo_collection
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
-# MongoDB client configuration
-mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/")
-db = mongo_client["loganalysis"]
-collection = db["prescan"]
+collection = mongo_collection("loganalysis", "prescan")
 
 @task
 def query_mongodb_for_fault():
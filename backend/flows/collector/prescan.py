@@ -1,33 +1,20 @@
 from datetime import datetime
-from prefect import task, flow
+from prefect import flow
 from prefect.artifacts import create_link_artifact
-from minio import Minio
-from pymongo import MongoClient
+from etl_shared import minio_client, mongo_collection, read_object, insert_records, record_saved_listeners, step, run_batch, create_batch_artifact, BATCH_CONCURRENCY
 import os
 import json
 from io import BytesIO
 import re
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
+collection = mongo_collection("loganalysis", "prescan")
 
-# MongoDB client configuration
-mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/")
-db = mongo_client["loganalysis"]
-collection = db["prescan"]
-
-@task 
+@step
 def extract_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    data = response.read().decode('utf-8')
+    data = read_object(minio_client, bucket_name, object_name).decode('utf-8')
     return data
 
-@task
+@step
 def process_file_with_fatal_fault(file_content, object_name):
     alphabot_version_pattern = re.compile(r'ALPHABOT_VERSION="([^"]+)"')
     command_line_pattern = re.compile(r'COMMAND_LINE="([^"]+)"')
@@ -64,7 +51,6 @@ def process_file_with_fatal_fault(file_content, object_name):
             else:
                 print("OS_BOOT_COUNT not found or null")
 
-
     # loop through all lines to find the fatal fault code
     for line in lines:
         if 'Type:Fatal' in line:
@@ -79,12 +65,14 @@ def process_file_with_fatal_fault(file_content, object_name):
     return data
 
 
-@task
+@step
 def load_to_mongodb(record):
     if record:
-        collection.insert_one(record)
+        insert_records(collection, [record])
+        for listener in record_saved_listeners:
+            listener(record["name"])
 
-@task
+@step
 def create_etl_artifact(bucket_name, object_name):
     link = f"https://{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000/{bucket_name}/{object_name}"
     create_link_artifact(
@@ -93,13 +81,23 @@ def create_etl_artifact(bucket_name, object_name):
         description="## ETL Pipeline Output\n\nData has been successfully extracted from MinIO, processed, and loaded into MongoDB."
     )
 
-@flow
-def prescan_flow(source_bucket_name, source_object_name, target_bucket_name, target_object_name):
+def prescan_object(source_bucket_name, source_object_name, target_bucket_name, target_object_name):
     file_content = extract_from_minio(source_bucket_name, source_object_name)
     record = process_file_with_fatal_fault(file_content, source_object_name)
     load_to_mongodb(record)
+
+@flow
+def prescan_flow(source_bucket_name, source_object_name, target_bucket_name, target_object_name):
+    prescan_object(source_bucket_name, source_object_name, target_bucket_name, target_object_name)
     create_etl_artifact(source_bucket_name, source_object_name)
 
+@flow
+def prescan_batch_flow(objects, max_workers=BATCH_CONCURRENCY):
+    # objects: (source bucket, source object, target bucket, target object) of each log, one flow run for all of them
+    rows = run_batch(prescan_object, objects, max_workers)
+    create_batch_artifact(rows, "Data has been extracted from MinIO, processed, and loaded into MongoDB")
+    return rows
+
 if __name__ == "__main__":
     test_bucket_name = "alphabot-logs-bucket"
     test_object_name = "alphabot_001103_2024_08_10_09_16_52.txt"
@@ -1,27 +1,18 @@
 import io
 from prefect import task, flow
 from prefect.artifacts import create_link_artifact
-from minio import Minio
+from etl_shared import minio_client, mongo_collection, read_object, write_object, replace_record, summary_index_record
 import pandas as pd
-from io import BytesIO
-import os
 from logfisher_summary_flow.parse_logs import generate_summary_for_single_file
 from prefect import get_run_logger#logger = get_run_logger()
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
+# timestamp offset index of every summary, read by the API's /summary endpoint
+summary_index = mongo_collection("loganalysis", "summary_index")
 
 @task
 def extract_from_minio(bucket_name, object_name):
     logger = get_run_logger()
-    response = minio_client.get_object(bucket_name, object_name)
-
-    data = response.read().decode('utf-8')
+    data = read_object(minio_client, bucket_name, object_name).decode('utf-8')
     return data
 
 @task
@@ -44,13 +35,9 @@ def load_to_minio(data, bucket_name, object_name):
     logger = get_run_logger()
     # logger.info(data) 
     # logger.info("READING NOW") 
-    minio_client.put_object(
-        bucket_name,
-        object_name,
-        data=BytesIO(data.encode()),
-        length=len(data),
-        content_type='application/octet_stream'
-    )
+    summary = data.encode()
+    result = write_object(minio_client, bucket_name, object_name, summary, content_type='application/octet_stream', precompress_siblings=True)
+    replace_record(summary_index, {"bucket": bucket_name, "object": object_name}, summary_index_record(bucket_name, object_name, result.etag, summary))
 
 @task
 def create_etl_artifact(bucket_name, object_name):
@@ -1,18 +1,9 @@
 from prefect import task, flow
 from prefect.artifacts import create_link_artifact
-from minio import Minio
+from etl_shared import minio_client, read_object, write_object
 import pandas as pd
 import plotly.express as px
-from io import BytesIO, StringIO
-import os
-
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
+from io import StringIO
 
 class SummaryParser:
     def __init__(self, summary_data):
@@ -109,8 +100,7 @@ class SummaryParser:
 
 @task
 def extract_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    lines = response.read().decode('utf-8')
+    lines = read_object(minio_client, bucket_name, object_name).decode('utf-8')
     return lines
 
 @task
@@ -132,13 +122,7 @@ def create_plot_artifact(summary_data):
 def upload_plot_to_minio(plot_buffer, bucket_name, object_name):
     plot_buffer.seek(0)
     data = plot_buffer.getvalue().encode('utf-8')  # Encode the string to bytes
-    minio_client.put_object(
-        bucket_name,
-        object_name,
-        data=BytesIO(data),  # Pass the buffer directly
-        length=len(data),  # Use the length of the encoded data
-        content_type='text/html'
-    )
+    write_object(minio_client, bucket_name, object_name, data, content_type='text/html', precompress_siblings=True)
 
 @task
 def create_plot_artifact_link(bucket_name, object_name):
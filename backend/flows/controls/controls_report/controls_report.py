@@ -8,30 +8,16 @@ from prefect import flow, task
 from prefect.artifacts import create_link_artifact
 from nbconvert import HTMLExporter
 from nbconvert.preprocessors import ExecutePreprocessor
-from minio import Minio
-from io import BytesIO
+from etl_shared import minio_client, read_object, write_object
 from pathlib import Path
 import os
 
 # Determine the directory where the script is located
 script_dir = Path(__file__).resolve().parent
 
-# Use the script directory to construct absolute paths
-ANALYSIS_CELL_PATH = script_dir / "analysis_cells/relevel_analysis_cell.py"
-ANALYSIS_CELL = open(ANALYSIS_CELL_PATH, 'r').read()
-
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
 @task
 def extract_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    data = response.read()
+    data = read_object(minio_client, bucket_name, object_name)
     
     # Write the CSV data to a disk file
     data_path = script_dir / object_name  # Save the CSV file using the object_name
@@ -132,14 +118,8 @@ def prepare_analysis(data_path):
     return html_data, tarball_data
 
 @task
-def load_to_minio(data, bucket_name, object_name):
-    minio_client.put_object(
-        bucket_name,
-        object_name,
-        data=BytesIO(data),
-        length=len(data),
-        content_type='application/csv'
-    )
+def load_to_minio(data, bucket_name, object_name, precompress_siblings=False):
+    write_object(minio_client, bucket_name, object_name, data, content_type='application/csv', precompress_siblings=precompress_siblings)
 
 @task
 def create_etl_artifact(bucket_name, object_name, artifact_key_label):
@@ -160,7 +140,7 @@ def controls_report_flow(source_bucket_name, source_object_name, target_bucket_n
     create_etl_artifact(target_bucket_name, tarball_obj_name, "ipynb-analysis")
 
     html_obj_name = f"{os.path.splitext(source_object_name)[0]}-report.html"
-    load_to_minio(html_data, target_bucket_name, html_obj_name)
+    load_to_minio(html_data, target_bucket_name, html_obj_name, precompress_siblings=True)
     create_etl_artifact(target_bucket_name, html_obj_name, "html-report")
 
 if __name__ == "__main__":
@@ -3,9 +3,8 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from prefect import flow, task, get_run_logger 
 from prefect.artifacts import create_link_artifact
-from minio import Minio
+from etl_shared import minio_client, read_object, write_object
 from io import BytesIO
-import os
 from pathlib import Path
 
 # Constants
@@ -16,19 +15,10 @@ POSITIVE_THRESHOLD = 9.0  # Threshold for positive limit
 NEGATIVE_THRESHOLD = -9.0  # Threshold for negative limit
 WINDOW_SIZE = int(TIME_WINDOW * SAMPLE_RATE)
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
 # ----------------------------- Tasks -----------------------------
 @task
 def extract_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    data = response.read()
+    data = read_object(minio_client, bucket_name, object_name)
     df = pd.read_csv(BytesIO(data))
     return df
 
@@ -84,15 +74,7 @@ def save_plot(fig, filename='motor_fault_detection_plot.png'):
 
 @task
 def load_to_minio(bucket_name, object_name):
-    data = BytesIO(Path(object_name).read_bytes())
-    length = data.getbuffer().nbytes
-    minio_client.put_object(
-        bucket_name,
-        object_name,
-        data=data,
-        length=length,
-        content_type='application/octet_stream'
-    )
+    write_object(minio_client, bucket_name, object_name, Path(object_name).read_bytes(), content_type='application/octet_stream')
 
 @task
 def create_etl_artifact(bucket_name, object_name):
@@ -2,9 +2,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from prefect import flow, task, get_run_logger 
 from prefect.artifacts import create_link_artifact
-from minio import Minio
+from etl_shared import minio_client
 from io import BytesIO
-import os
 from pathlib import Path
 
 # Constants
@@ -15,14 +14,6 @@ POSITIVE_THRESHOLD = 9.0  # Threshold for positive limit
 NEGATIVE_THRESHOLD = -9.0  # Threshold for negative limit
 WINDOW_SIZE = int(TIME_WINDOW * SAMPLE_RATE)
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
 # ----------------------------- Tasks -----------------------------
 
 @task
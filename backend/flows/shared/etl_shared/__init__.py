@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+# __init__.py
+
+from .batches import *
+from .clients import *
+from .hooks import *
+from .metrics import *
+from .steps import *
+from .storage import *
+from .summary_index import *
@@ -0,0 +1,44 @@
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .steps import steps_inline
+
+# objects of a batch processed at the same time by a batch flow
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+def _run_object(process, args):
+    source_bucket_name, source_object_name, target_bucket_name, target_object_name = args
+    row = {"source": f"{source_bucket_name}/{source_object_name}", "target": f"{target_bucket_name}/{target_object_name}", "status": "completed", "error": ""}
+    started = time.perf_counter()
+    try:
+        with steps_inline():
+            process(*args)
+    except Exception as e:
+        row["status"] = "failed"
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = round(time.perf_counter() - started, 3)
+    return row
+
+def run_batch(process, objects, max_workers=BATCH_CONCURRENCY):
+    """Run process(source bucket, source object, target bucket, target object) for each object of a batch
+
+    Objects are processed max_workers at a time with their steps inline, so the whole batch is a
+    single flow run. A failing object does not stop the others, the returned rows (one per object,
+    in order) record its status and error.
+    """
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(objects)) or 1) as pool:
+        # each object runs in a copy of the flow's context: flow run, pipeline label for the metrics
+        futures = [pool.submit(contextvars.copy_context().run, _run_object, process, tuple(args)) for args in objects]
+        return [future.result() for future in futures]
+
+def create_batch_artifact(rows, description):
+    """One table artifact listing the result of every object of a batch, instead of a link artifact per object"""
+    from prefect.artifacts import create_table_artifact
+    failed = sum(row["status"] == "failed" for row in rows)
+    create_table_artifact(
+        key="etl-batch",
+        table=rows,
+        description=f"## ETL Batch Output\n\n{description}: {len(rows) - failed}/{len(rows)} object(s) completed.",
+    )
@@ -0,0 +1,194 @@
+import os
+import socket
+import threading
+import time
+
+import urllib3
+from minio import Minio
+from pymongo import MongoClient, monitoring
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .metrics import REGISTRY
+
+MINIO_ENDPOINT = f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000"
+MONGO_URL = f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/"
+
+# urllib3 keeps at most MINIO_POOL_SIZE idle keep-alive connections per MinIO host, size it to the flow and API threads
+MINIO_POOL_SIZE = int(os.getenv("MINIO_POOL_SIZE", "64"))
+# wait for a free connection when the pool is exhausted instead of opening throwaway ones
+MINIO_POOL_BLOCK = os.getenv("MINIO_POOL_BLOCK", "false").lower() in ("1", "true", "yes")
+MINIO_CONNECT_TIMEOUT = float(os.getenv("MINIO_CONNECT_TIMEOUT", "5"))
+MINIO_READ_TIMEOUT = float(os.getenv("MINIO_READ_TIMEOUT", "300"))
+MINIO_RETRIES = int(os.getenv("MINIO_RETRIES", "3"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "64"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "30000"))
+
+POOL_EXHAUSTED = REGISTRY.counter("etl_client_pool_exhausted_total", "Connection checkouts that found every pooled connection in use", ("client",))
+POOL_CHECKOUT_SECONDS = REGISTRY.histogram("etl_client_pool_checkout_seconds", "Time spent getting a pooled connection", ("client",), buckets=(0.0001, 0.001, 0.01, 0.1, 1.0, 5.0, 30.0))
+POOL_CHECKOUT_FAILURES = REGISTRY.counter("etl_client_pool_checkout_failures_total", "Connection checkouts that failed, by reason", ("client", "reason"))
+
+class LazyClient:
+    """Stands in for a client that is only created, once, when first used
+
+    Flow modules declare their clients at module level; deferring creation keeps importing a
+    flow cheap and lets every flow of a process share the same connection pools.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _instance(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._instance(), name)
+
+_pool_lock = threading.Lock()
+
+class _InstrumentedPool:
+    """Mixin for urllib3 pools counting checked out connections and checkouts that find the pool exhausted"""
+    in_use = 0
+
+    def _get_conn(self, timeout=None):
+        # the queue starts with maxsize placeholders, it is only empty when every slot is checked out
+        if self.pool is not None and self.pool.empty():
+            POOL_EXHAUSTED.inc(1, "minio")
+        started = time.perf_counter()
+        conn = super()._get_conn(timeout)
+        POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started, "minio")
+        with _pool_lock:
+            self.in_use += 1
+        return conn
+
+    def _put_conn(self, conn):
+        with _pool_lock:
+            self.in_use -= 1
+        return super()._put_conn(conn)
+
+    def idle(self):
+        return sum(1 for conn in list(self.pool.queue) if conn is not None) if self.pool is not None else 0
+
+class InstrumentedHTTPConnectionPool(_InstrumentedPool, HTTPConnectionPool):
+    pass
+
+class InstrumentedHTTPSConnectionPool(_InstrumentedPool, HTTPSConnectionPool):
+    pass
+
+def new_http_client():
+    """urllib3 PoolManager for MinIO with a sized keep-alive pool, timeouts and retries"""
+    manager = urllib3.PoolManager(
+        maxsize=MINIO_POOL_SIZE,
+        block=MINIO_POOL_BLOCK,
+        timeout=urllib3.Timeout(connect=MINIO_CONNECT_TIMEOUT, read=MINIO_READ_TIMEOUT),
+        retries=urllib3.Retry(total=MINIO_RETRIES, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+        socket_options=HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)],
+    )
+    manager.pool_classes_by_scheme = {"http": InstrumentedHTTPConnectionPool, "https": InstrumentedHTTPSConnectionPool}
+    _http_clients.append(manager)
+    return manager
+
+def new_minio_client(endpoint=MINIO_ENDPOINT, access_key="password", secret_key="password", secure=False, **kwargs):
+    return Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure, http_client=new_http_client(), **kwargs)
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Tracks open and checked out Mongo connections from pymongo's connection pool events"""
+
+    def __init__(self):
+        self.open = 0
+        self.in_use = 0
+        self._lock = threading.Lock()
+        # checkout events are published on the thread doing the checkout
+        self._local = threading.local()
+
+    def _wait_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def _wait_ended(self, event):
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        if started is not None:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started, "mongo")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def connection_check_out_started(self, event):
+        self._wait_started(event)
+
+    def connection_check_out_failed(self, event):
+        self._wait_ended(event)
+        POOL_CHECKOUT_FAILURES.inc(1, "mongo", str(event.reason))
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            POOL_EXHAUSTED.inc(1, "mongo")
+
+    def connection_checked_out(self, event):
+        self._wait_ended(event)
+        with self._lock:
+            self.in_use += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+def new_mongo_client(url=MONGO_URL, **kwargs):
+    listener = MongoPoolListener()
+    _mongo_listeners.append(listener)
+    return MongoClient(
+        url,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=[listener],
+        **kwargs,
+    )
+
+_http_clients = []
+_mongo_listeners = []
+
+def _connections():
+    minio_pools = [pool for manager in list(_http_clients) for pool in list(manager.pools.values())]
+    return {
+        ("minio", "in_use"): sum(pool.in_use for pool in minio_pools),
+        ("minio", "idle"): sum(pool.idle() for pool in minio_pools),
+        ("mongo", "in_use"): sum(listener.in_use for listener in _mongo_listeners),
+        ("mongo", "idle"): sum(listener.open - listener.in_use for listener in _mongo_listeners),
+    }
+
+REGISTRY.gauge("etl_client_connections", "Pooled MinIO and Mongo connections of this process", ("client", "state"), callback=_connections)
+
+# one client of each kind per process, shared by every flow module and the API
+minio_client = LazyClient(new_minio_client)
+mongo_client = LazyClient(new_mongo_client)
+
+def mongo_collection(db_name, collection_name):
+    return LazyClient(lambda: mongo_client._instance()[db_name][collection_name])
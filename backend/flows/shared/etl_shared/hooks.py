@@ -0,0 +1,3 @@
+# callbacks notified with the log name whenever prescan saves a new record (eg. the dispatcher's prescan cache),
+# kept out of the prescan flow module so the API can register them without importing the flow
+record_saved_listeners = []
@@ -0,0 +1,191 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# pipeline the current flow run belongs to, set by the dispatcher around every flow call
+current_pipeline = ContextVar("current_pipeline", default="unknown")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def labels(self, *labelvalues):
+        return _Bound(self, tuple(str(value) for value in labelvalues))
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labelvalues, (), value) for labelvalues, value in self._values.items()]
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        for labelvalues, value in values.items():
+            self.inc(value, *labelvalues)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            counts, total = self._values.get(labelvalues, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[labelvalues] = (counts, total + value)
+
+    def labels(self, *labelvalues):
+        return _Bound(self, tuple(str(value) for value in labelvalues))
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labelvalues, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append((f"{self.name}_bucket", labelvalues, (("le", le),), cumulative))
+                samples.append((f"{self.name}_count", labelvalues, (), cumulative))
+                samples.append((f"{self.name}_sum", labelvalues, (), total))
+        return samples
+
+    def drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        with self._lock:
+            for labelvalues, (counts, total) in values.items():
+                current, current_total = self._values.get(labelvalues, ([0] * (len(self.buckets) + 1), 0.0))
+                self._values[labelvalues] = ([a + b for a, b in zip(current, counts)], current_total + total)
+
+class Gauge:
+    """Gauge whose samples come from a callback returning {labelvalues tuple: value} at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def samples(self):
+        values = self.callback() if self.callback else {}
+        return [(self.name, tuple(str(value) for value in labelvalues), (), value) for labelvalues, value in values.items()]
+
+class _Bound:
+    def __init__(self, metric, labelvalues):
+        self.metric = metric
+        self.labelvalues = labelvalues
+
+    def inc(self, amount=1):
+        self.metric.inc(amount, *self.labelvalues)
+
+    def observe(self, value):
+        self.metric.observe(value, *self.labelvalues)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metric.observe(time.perf_counter() - started, *self.labelvalues)
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelvalues, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labelnames, labelvalues, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def drain(self):
+        """Take the counters and histograms recorded so far, used to ship a worker process' numbers to the API"""
+        return {name: metric.drain() for name, metric in self._metrics.items() if hasattr(metric, "drain")}
+
+    def merge(self, drained):
+        for name, values in drained.items():
+            metric = self._metrics.get(name)
+            if metric is not None and values:
+                metric.merge(values)
+
+REGISTRY = Registry()
+
+FLOW_RUNS = REGISTRY.counter("etl_flow_runs_total", "Flow runs finished, by pipeline and outcome", ("pipeline", "outcome"))
+FLOW_DURATION = REGISTRY.histogram("etl_flow_duration_seconds", "Wall time of a flow run", ("pipeline",))
+MINIO_BYTES_READ = REGISTRY.counter("etl_minio_bytes_read_total", "Bytes read from MinIO by flows", ("pipeline", "bucket"))
+MINIO_BYTES_WRITTEN = REGISTRY.counter("etl_minio_bytes_written_total", "Bytes written to MinIO by flows", ("pipeline", "bucket"))
+MONGO_RECORDS_WRITTEN = REGISTRY.counter("etl_mongo_records_written_total", "Documents inserted into MongoDB by flows", ("pipeline", "collection"))
+IO_FAILURES = REGISTRY.counter("etl_io_failures_total", "Failed MinIO or MongoDB calls made by flows", ("pipeline", "operation"))
+
+def run_instrumented(pipeline, flow, *args):
+    """Call a flow with its pipeline label set, recording its duration and outcome"""
+    token = current_pipeline.set(pipeline)
+    started = time.perf_counter()
+    outcome = "failed"
+    try:
+        result = flow(*args)
+        outcome = "completed"
+        return result
+    finally:
+        FLOW_DURATION.observe(time.perf_counter() - started, pipeline)
+        FLOW_RUNS.inc(1, pipeline, outcome)
+        current_pipeline.reset(token)
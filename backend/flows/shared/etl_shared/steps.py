@@ -0,0 +1,44 @@
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# set around a flow call to run its steps as plain function calls inside the flow run, see step()
+inline_steps = ContextVar("inline_steps", default=False)
+
+class Step:
+    """A Prefect task that can also run as a plain call of its function
+
+    Every task call costs Prefect API round trips for its run record and state transitions,
+    which dominates flows whose steps only take milliseconds. Inside steps_inline() the step
+    calls the task's function directly, so the flow keeps a single run record; task options
+    such as retries and caching do not apply then. Anything else (submit, map...) goes to the task.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.fn = task.fn
+        functools.update_wrapper(self, task.fn)
+
+    def __call__(self, *args, **kwargs):
+        if inline_steps.get():
+            return self.fn(*args, **kwargs)
+        return self.task(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.task, name)
+
+def step(fn=None, **task_options):
+    """Drop-in for @task / @task(...) on flow steps that should be able to run inline"""
+    if fn is None:
+        return lambda fn: step(fn, **task_options)
+    # prefect is only imported by the flow modules using it, not by the API importing etl_shared
+    from prefect import task
+    return Step(task(fn, **task_options))
+
+@contextmanager
+def steps_inline(enabled=True):
+    token = inline_steps.set(enabled)
+    try:
+        yield
+    finally:
+        inline_steps.reset(token)
@@ -0,0 +1,91 @@
+import gzip
+import os
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:  # optional, artifacts are only precompressed with gzip without it
+    brotli = None
+
+from .metrics import IO_FAILURES, MINIO_BYTES_READ, MINIO_BYTES_WRITTEN, MONGO_RECORDS_WRITTEN, current_pipeline
+
+# precompressed copies of an artifact are stored next to it as "<object><suffix>", by order of preference
+PRECOMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# user metadata of a precompressed copy, the etag of the object version it was compressed from
+SOURCE_ETAG_METADATA = "source-etag"
+PRECOMPRESS_MIN_BYTES = int(os.getenv("PRECOMPRESS_MIN_BYTES", "1024"))
+
+def read_object(client, bucket_name, object_name):
+    """Read a whole MinIO object, counting the bytes against the current pipeline"""
+    try:
+        response = client.get_object(bucket_name, object_name)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+    except Exception:
+        IO_FAILURES.inc(1, current_pipeline.get(), "minio_read")
+        raise
+    MINIO_BYTES_READ.inc(len(data), current_pipeline.get(), bucket_name)
+    return data
+
+def _put_object(client, bucket_name, object_name, data, content_type, metadata=None):
+    try:
+        result = client.put_object(
+            bucket_name,
+            object_name,
+            data=BytesIO(data),
+            length=len(data),
+            content_type=content_type,
+            metadata=metadata,
+        )
+    except Exception:
+        IO_FAILURES.inc(1, current_pipeline.get(), "minio_write")
+        raise
+    MINIO_BYTES_WRITTEN.inc(len(data), current_pipeline.get(), bucket_name)
+    return result
+
+def precompress(data):
+    """{encoding: compressed data}, at high levels since it is paid once per upload rather than per download"""
+    compressed = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        # quality 11 is several times slower than 9 for a few percent on large html
+        compressed["br"] = brotli.compress(data, quality=9)
+    return compressed
+
+def write_object(client, bucket_name, object_name, data, content_type='application/octet_stream', precompress_siblings=False):
+    """Upload bytes to MinIO, counting the bytes against the current pipeline
+
+    With precompress_siblings, text artifacts served through /get-object also get gzip (and
+    brotli) compressed copies tagged with the etag of this upload, so the API can send them
+    as is to clients accepting those encodings instead of compressing on every download.
+    """
+    result = _put_object(client, bucket_name, object_name, data, content_type)
+    if precompress_siblings and len(data) >= PRECOMPRESS_MIN_BYTES:
+        for encoding, compressed in precompress(data).items():
+            _put_object(
+                client, bucket_name, f"{object_name}{PRECOMPRESSED_SUFFIXES[encoding]}", compressed, content_type,
+                metadata={SOURCE_ETAG_METADATA: result.etag},
+            )
+    return result
+
+def insert_records(collection, records):
+    """Insert documents into a Mongo collection, counting them against the current pipeline"""
+    if not records:
+        return
+    try:
+        collection.insert_many(records)
+    except Exception:
+        IO_FAILURES.inc(1, current_pipeline.get(), "mongo_insert")
+        raise
+    MONGO_RECORDS_WRITTEN.inc(len(records), current_pipeline.get(), collection.name)
+
+def replace_record(collection, query, record):
+    """Insert a document or replace the one matching query, counting it against the current pipeline"""
+    try:
+        collection.replace_one(query, record, upsert=True)
+    except Exception:
+        IO_FAILURES.inc(1, current_pipeline.get(), "mongo_replace")
+        raise
+    MONGO_RECORDS_WRITTEN.inc(1, current_pipeline.get(), collection.name)
@@ -0,0 +1,63 @@
+import os
+import re
+from io import BytesIO
+
+# kinds of logfisher summary lines (see parse_logs.parse_alphabot_summary), safety debug changes count as OTHER
+SUMMARY_KINDS = ("FAULT", "TOTE", "MOVE", "OTHER")
+# summary lines per index block, the unit of the ranged reads serving a slice of the summary
+SUMMARY_INDEX_BLOCK_LINES = int(os.getenv("SUMMARY_INDEX_BLOCK_LINES", "256"))
+
+_TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?")
+
+def line_timestamp(line):
+    match = _TIMESTAMP_PATTERN.match(line)
+    return match.group(0) if match else None
+
+def line_kind(line):
+    if " [FAULT] " in line:
+        return "FAULT"
+    if " [TOTE] " in line:
+        return "TOTE"
+    if " -> " in line:
+        return "MOVE"
+    return "OTHER"
+
+def in_time_range(timestamp, start=None, end=None):
+    """Whether a summary timestamp falls in [start, end], end given as "2024-08-13 23:25" covers that whole minute"""
+    return (start is None or timestamp >= start) and (end is None or timestamp[:len(end)] <= end)
+
+def build_summary_index(data, block_lines=SUMMARY_INDEX_BLOCK_LINES):
+    """Blocks of consecutive lines of a summary with their byte range, time span and line kinds
+
+    Summaries are sorted by timestamp, so the blocks are too and a time slice of the summary
+    maps to a contiguous run of blocks.
+    """
+    blocks = []
+    offset = 0
+    timestamp = ""
+    for number, line in enumerate(BytesIO(data)):
+        if number % block_lines == 0:
+            block = {"offset": offset, "length": 0, "first": None, "last": "", "kinds": set()}
+            blocks.append(block)
+        text = line.decode("utf-8", "replace")
+        # continuation lines without a timestamp belong with the previous line
+        timestamp = line_timestamp(text) or timestamp
+        if block["first"] is None:
+            block["first"] = timestamp
+        block["last"] = timestamp
+        block["kinds"].add(line_kind(text))
+        block["length"] += len(line)
+        offset += len(line)
+    for block in blocks:
+        block["kinds"] = sorted(block["kinds"])
+    return blocks
+
+def summary_index_record(bucket_name, object_name, etag, data):
+    """Mongo document indexing one version (etag) of a summary object"""
+    return {
+        "bucket": bucket_name,
+        "object": object_name,
+        "etag": etag,
+        "size": len(data),
+        "blocks": build_summary_index(data),
+    }
@@ -1,7 +1,6 @@
 from prefect import task, flow
 from prefect.artifacts import create_link_artifact
-from minio import Minio
-from pymongo import MongoClient
+from etl_shared import minio_client, mongo_collection, read_object, insert_records
 import pandas as pd
 from io import BytesIO
 import os
@@ -12,19 +11,8 @@ from pathlib import Path
 from snapstat.fingerprints import Sequence, sequences
 from concurrent.futures import ThreadPoolExecutor
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
-# MongoDB client configuration
-mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/")
-db = mongo_client["loganalysis"]
-collection_details = db["loganalysis_details"]
-collection_summary = db["loganalysis_summary"]
+collection_details = mongo_collection("loganalysis", "loganalysis_details")
+collection_summary = mongo_collection("loganalysis", "loganalysis_summary")
 
 # Function to compile the sequence of patterns
 def compile_patterns(event_sequence: Sequence) -> List[re.Pattern]:
@@ -118,8 +106,7 @@ def analyze_log_for_sequence(log_lines: List[str], event_sequence: Sequence, log
 
 @task
 def extract_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    data = response.read().decode('utf-8').splitlines()
+    data = read_object(minio_client, bucket_name, object_name).decode('utf-8').splitlines()
     return data, object_name
 
 @task
@@ -158,9 +145,9 @@ def load_to_mongodb(dfs):
     details_records = details_df.to_dict(orient='records')
     summary_records = summary_df.to_dict(orient='records')
     if details_records is not None and len(details_records) >=1:
-        collection_details.insert_many(details_records)
+        insert_records(collection_details, details_records)
     if details_records is not None and len(details_records) >=1:
-        collection_summary.insert_many(summary_records)
+        insert_records(collection_summary, summary_records)
 
 @task
 def create_etl_artifact(bucket_name, object_name):
@@ -1,7 +1,6 @@
 from prefect import task, flow
 from prefect.artifacts import create_link_artifact
-from minio import Minio
-from pymongo import MongoClient
+from etl_shared import minio_client, mongo_collection
 import pandas as pd
 from io import BytesIO
 import os
@@ -12,19 +11,8 @@ from pathlib import Path
 from snapstat.fingerprints import Sequence, sequences
 from concurrent.futures import ThreadPoolExecutor
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
-# MongoDB client configuration
-mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/")
-db = mongo_client["loganalysis"]
-collection_details = db["loganalysis_details"]
-collection_summary = db["loganalysis_summary"]
+collection_details = mongo_collection("loganalysis", "loganalysis_details")
+collection_summary = mongo_collection("loganalysis", "loganalysis_summary")
 
 # Function to compile the sequence of patterns
 def compile_patterns(event_sequence: Sequence) -> List[re.Pattern]:
@@ -1,28 +1,15 @@
 from prefect import task, flow
 from prefect.artifacts import create_link_artifact
-from minio import Minio
-from pymongo import MongoClient
+from etl_shared import minio_client, mongo_collection, read_object, insert_records
 import pandas as pd
 from io import BytesIO
 import os
 
-# MinIO client configuration
-minio_client = Minio(
-    f"{os.getenv('MINIO_HOSTNAME', 'localhost')}:9000",
-    access_key="password",
-    secret_key="password",
-    secure=False
-)
-
-# MongoDB client configuration
-mongo_client = MongoClient(f"mongodb://{os.getenv('MONGO_HOSTNAME', 'localhost')}:27017/")
-db = mongo_client["loganalysis"]
-collection = db["loganalysis_collection"]
+collection = mongo_collection("loganalysis", "loganalysis_collection")
 
 @task
 def extract_from_minio(bucket_name, object_name):
-    response = minio_client.get_object(bucket_name, object_name)
-    data = response.read()
+    data = read_object(minio_client, bucket_name, object_name)
     df = pd.read_csv(BytesIO(data))
     return df
 
@@ -35,7 +22,7 @@ def transform_data(df, lambda_transform):
 @task
 def load_to_mongodb(df):
     records = df.to_dict(orient='records')
-    collection.insert_many(records)
+    insert_records(collection, records)
 
 @task
 def create_etl_artifact(bucket_name, object_name):
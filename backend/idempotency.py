@@ -0,0 +1,194 @@
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+from etl_shared import mongo_collection
+from job_queue import QUEUE_BACKEND
+from sqlite_store import SqliteStore
+
+IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH", "./state/idempotency.sqlite3")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+# an in-progress claim lapses unless its dispatcher renews it within this long, so the runs of a
+# crashed or hung dispatch can be claimed again by the replay of its event
+IDEMPOTENCY_CLAIM_SECONDS = float(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "30"))
+IDEMPOTENCY_MONGO_DB = os.getenv("IDEMPOTENCY_MONGO_DB", "loganalysis")
+IDEMPOTENCY_MONGO_COLLECTION = os.getenv("IDEMPOTENCY_MONGO_COLLECTION", "etl_idempotency")
+
+class IdempotencyStore(SqliteStore):
+    """Remembers which (bucket, object key, etag, pipeline) runs were already dispatched
+
+    claim() is an atomic check-and-mark of keys as in progress, so duplicate webhook deliveries,
+    MinIO retries and re-uploads of identical content are acknowledged without running the
+    pipeline again. A key only becomes done through complete() once its run succeeded, and done
+    keys expire after the TTL. In-progress claims expire after claim_seconds unless renew()ed and
+    release() forgets them, so a failed, cancelled or crashed run can be dispatched again.
+    The SQLite file belongs to a single process: recover() drops the claims its previous run held.
+    """
+
+    def __init__(self, path=IDEMPOTENCY_PATH, ttl=IDEMPOTENCY_TTL, claim_seconds=IDEMPOTENCY_CLAIM_SECONDS):
+        super().__init__(
+            path,
+            """CREATE TABLE IF NOT EXISTS dispatched (
+                bucket TEXT NOT NULL,
+                object_key TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                pipeline TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (bucket, object_key, etag, pipeline)
+            )""",
+        )
+        self.ttl = ttl
+        self.claim_seconds = claim_seconds
+        self.hits = 0
+        self.misses = 0
+        self._last_purge = 0.0
+        if "state" not in self._columns("dispatched"):
+            # rows written before claims had a state were runs that already went through
+            self._conn.execute("ALTER TABLE dispatched ADD COLUMN state TEXT NOT NULL DEFAULT 'done'")
+
+    def claim(self, keys):
+        """Mark keys as in progress, returns (keys claimed, keys skipped because another dispatch holds them in progress)
+
+        Keys neither claimed nor held are done.
+        """
+        now = time.time()
+        claimed = []
+        held = []
+        with self._transaction() as conn:
+            for key in keys:
+                row = conn.execute(
+                    "SELECT expires_at, state FROM dispatched WHERE bucket = ? AND object_key = ? AND etag = ? AND pipeline = ?",
+                    key,
+                ).fetchone()
+                if row and row[0] > now:
+                    self.hits += 1
+                    if row[1] == "in_progress":
+                        held.append(key)
+                    continue
+                self.misses += 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO dispatched (bucket, object_key, etag, pipeline, expires_at, state) VALUES (?, ?, ?, ?, ?, 'in_progress')",
+                    (*key, now + self.claim_seconds),
+                )
+                claimed.append(key)
+
+        if now - self._last_purge > self.ttl / 10:
+            with self._lock:
+                self._conn.execute("DELETE FROM dispatched WHERE expires_at <= ?", (now,))
+                self._last_purge = now
+        return claimed, held
+
+    def _update(self, sql, keys, *params):
+        with self._lock:
+            self._conn.executemany(sql, [(*params, *key) for key in keys])
+
+    def renew(self, keys):
+        """Extend the in-progress claims of runs still being dispatched"""
+        self._update(
+            "UPDATE dispatched SET expires_at = ? WHERE state = 'in_progress' AND bucket = ? AND object_key = ? AND etag = ? AND pipeline = ?",
+            keys, time.time() + self.claim_seconds,
+        )
+
+    def complete(self, keys):
+        """Mark the keys of runs that went through as done, duplicates are skipped until the TTL"""
+        self._update(
+            "UPDATE dispatched SET state = 'done', expires_at = ? WHERE bucket = ? AND object_key = ? AND etag = ? AND pipeline = ?",
+            keys, time.time() + self.ttl,
+        )
+
+    def release(self, keys):
+        self._update(
+            "DELETE FROM dispatched WHERE state = 'in_progress' AND bucket = ? AND object_key = ? AND etag = ? AND pipeline = ?",
+            keys,
+        )
+
+    def recover(self):
+        """Drop the in-progress claims left by the previous process, their events are replayed"""
+        with self._lock:
+            return self._conn.execute("DELETE FROM dispatched WHERE state = 'in_progress'").rowcount
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+def _key_id(key):
+    bucket, object_key, etag, pipeline = key
+    return {"bucket": bucket, "object_key": object_key, "etag": etag, "pipeline": pipeline}
+
+class MongoIdempotencyStore:
+    """IdempotencyStore in a MongoDB collection, shared by the flowsapi replicas of the Mongo queue
+
+    A duplicate delivered to another replica is skipped like one delivered to the same process.
+    Claims are owned by the replica that made them, a crashed replica's claims lapse after
+    claim_seconds, sooner than the lease of its jobs, so whichever replica takes the jobs over can
+    claim their runs. Expired keys are purged by a TTL index on expires_at.
+    """
+
+    def __init__(self, collection=None, ttl=IDEMPOTENCY_TTL, claim_seconds=IDEMPOTENCY_CLAIM_SECONDS):
+        self.collection = collection if collection is not None else mongo_collection(IDEMPOTENCY_MONGO_DB, IDEMPOTENCY_MONGO_COLLECTION)
+        self.ttl = ttl
+        self.claim_seconds = claim_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.hits = 0
+        self.misses = 0
+
+    def _expiry(self, seconds):
+        # a date, TTL indexes only expire date fields
+        return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+    def claim(self, keys):
+        """Mark keys as in progress, returns (keys claimed, keys skipped because another dispatch holds them in progress)"""
+        claimed = []
+        held = []
+        for key in keys:
+            try:
+                # matches an expired entry to take it over, or inserts, a live entry makes the insert collide
+                self.collection.update_one(
+                    {"_id": _key_id(key), "expires_at": {"$lte": datetime.now(timezone.utc)}},
+                    {"$set": {"state": "in_progress", "owner": self.owner, "expires_at": self._expiry(self.claim_seconds)}},
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                self.hits += 1
+                entry = self.collection.find_one({"_id": _key_id(key)}, {"state": 1})
+                if entry is not None and entry.get("state") == "in_progress":
+                    held.append(key)
+                continue
+            self.misses += 1
+            claimed.append(key)
+        return claimed, held
+
+    def renew(self, keys):
+        if keys:
+            self.collection.update_many(
+                {"_id": {"$in": [_key_id(key) for key in keys]}, "state": "in_progress", "owner": self.owner},
+                {"$set": {"expires_at": self._expiry(self.claim_seconds)}},
+            )
+
+    def complete(self, keys):
+        if keys:
+            self.collection.update_many(
+                {"_id": {"$in": [_key_id(key) for key in keys]}, "owner": self.owner},
+                {"$set": {"state": "done", "expires_at": self._expiry(self.ttl)}},
+            )
+
+    def release(self, keys):
+        if keys:
+            self.collection.delete_many({"_id": {"$in": [_key_id(key) for key in keys]}, "state": "in_progress", "owner": self.owner})
+
+    def recover(self):
+        """Create the TTL index, claims of stopped replicas lapse on their own"""
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        return 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+def open_idempotency_store(backend=QUEUE_BACKEND):
+    # replicas sharing the Mongo queue have to share the store too, or a duplicate delivered to another replica runs again
+    if backend == "mongo":
+        return MongoIdempotencyStore()
+    return IdempotencyStore()
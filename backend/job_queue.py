@@ -0,0 +1,205 @@
+import json
+import os
+import socket
+import time
+import uuid
+from collections import namedtuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+
+from etl_shared import mongo_collection
+from sqlite_store import SqliteStore
+
+# "sqlite" keeps the queue local to one flowsapi, "mongo" shares it between any number of replicas
+QUEUE_BACKEND = os.getenv("ETL_QUEUE_BACKEND", "sqlite")
+# Default location of the on-disk queue, ./state is part of the /app volume so it survives restarts
+QUEUE_PATH = os.getenv("ETL_QUEUE_PATH", "./state/etl_queue.sqlite3")
+MAX_ATTEMPTS = int(os.getenv("ETL_QUEUE_MAX_ATTEMPTS", "3"))
+QUEUE_MONGO_DB = os.getenv("ETL_QUEUE_MONGO_DB", "loganalysis")
+QUEUE_MONGO_COLLECTION = os.getenv("ETL_QUEUE_MONGO_COLLECTION", "etl_jobs")
+# a claimed job is invisible to other replicas for this long, the owner renews it while the job runs
+LEASE_SECONDS = float(os.getenv("ETL_QUEUE_LEASE_SECONDS", "60"))
+
+Job = namedtuple('Job', ['id', 'payload', 'attempts', 'enqueued_at'])
+
+class SqliteJobQueue(SqliteStore):
+    """Durable FIFO of webhook events backed by a local SQLite file"""
+
+    def __init__(self, path=QUEUE_PATH, max_attempts=MAX_ATTEMPTS):
+        super().__init__(
+            path,
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                enqueued_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""",
+            "CREATE INDEX IF NOT EXISTS jobs_status_id ON jobs (status, id)",
+        )
+        self.max_attempts = max_attempts
+
+    def put(self, payload):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (payload, enqueued_at, updated_at) VALUES (?, ?, ?)",
+                (json.dumps(payload), now, now),
+            )
+        return cursor.lastrowid
+
+    def claim(self, limit=1):
+        """Atomically move up to `limit` queued jobs to running and return them"""
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, payload, attempts, enqueued_at FROM jobs WHERE status = 'queued' ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                [(now, row[0]) for row in rows],
+            )
+        return [Job(row[0], json.loads(row[1]), row[2] + 1, row[3]) for row in rows]
+
+    def ack(self, *job_ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def fail(self, job, error):
+        """Put the job back in the queue, or park it as failed once it ran out of attempts"""
+        status = "failed" if job.attempts >= self.max_attempts else "queued"
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, str(error), time.time(), job.id),
+            )
+        return status
+
+    def heartbeat(self, *job_ids):
+        # a single process owns the file, running jobs are only requeued by recover() on restart
+        return list(job_ids)
+
+    def recover(self):
+        """Requeue jobs that were running when the previous process stopped"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'",
+                (time.time(),),
+            )
+        return cursor.rowcount
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+
+class MongoJobQueue:
+    """Leased FIFO of webhook events in a MongoDB collection, shared by any number of flowsapi replicas
+
+    claim() atomically leases queued jobs to this process for lease_seconds and heartbeat() renews
+    the leases of jobs still being dispatched. Jobs whose lease ran out, because their replica
+    crashed or hung, are leased again by whichever replica claims next, as another attempt.
+    Acks and failures only apply while this process still holds the lease.
+    """
+
+    def __init__(self, collection=None, max_attempts=MAX_ATTEMPTS, lease_seconds=LEASE_SECONDS):
+        self.collection = collection if collection is not None else mongo_collection(QUEUE_MONGO_DB, QUEUE_MONGO_COLLECTION)
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _ids(self, job_ids):
+        ids = []
+        for job_id in job_ids:
+            try:
+                ids.append(ObjectId(job_id))
+            except (InvalidId, TypeError):
+                continue
+        return ids
+
+    def put(self, payload):
+        now = time.time()
+        result = self.collection.insert_one({
+            # stored as text, event payloads may have keys mongo does not accept
+            "payload": json.dumps(payload),
+            "status": "queued",
+            "attempts": 0,
+            "enqueued_at": now,
+            "updated_at": now,
+        })
+        return str(result.inserted_id)
+
+    def claim(self, limit=1):
+        """Lease up to `limit` queued jobs, or running jobs whose lease expired, to this process"""
+        jobs = []
+        while len(jobs) < limit:
+            now = time.time()
+            doc = self.collection.find_one_and_update(
+                {"$or": [{"status": "queued"}, {"status": "running", "lease_expires": {"$lt": now}}]},
+                {
+                    "$set": {"status": "running", "owner": self.owner, "lease_expires": now + self.lease_seconds, "updated_at": now},
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("_id", 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is None:
+                break
+            if doc["attempts"] > self.max_attempts:
+                # its lease kept running out, the job likely takes its worker down with it
+                self.collection.update_one(
+                    {"_id": doc["_id"], "owner": self.owner},
+                    {"$set": {"status": "failed", "error": "lease expired on every attempt", "updated_at": now}, "$unset": {"lease_expires": ""}},
+                )
+                continue
+            jobs.append(Job(str(doc["_id"]), json.loads(doc["payload"]), doc["attempts"], doc["enqueued_at"]))
+        return jobs
+
+    def heartbeat(self, *job_ids):
+        """Extend the leases this process still holds, returns the job ids whose lease was renewed"""
+        ids = self._ids(job_ids)
+        if not ids:
+            return []
+        now = time.time()
+        self.collection.update_many(
+            {"_id": {"$in": ids}, "status": "running", "owner": self.owner},
+            {"$set": {"lease_expires": now + self.lease_seconds, "updated_at": now}},
+        )
+        return [str(doc["_id"]) for doc in self.collection.find({"_id": {"$in": ids}, "status": "running", "owner": self.owner}, {"_id": 1})]
+
+    def ack(self, *job_ids):
+        ids = self._ids(job_ids)
+        if ids:
+            self.collection.delete_many({"_id": {"$in": ids}, "owner": self.owner})
+
+    def fail(self, job, error):
+        """Put the job back in the queue, or park it as failed once it ran out of attempts"""
+        status = "failed" if job.attempts >= self.max_attempts else "queued"
+        self.collection.update_one(
+            {"_id": ObjectId(job.id), "owner": self.owner},
+            {"$set": {"status": status, "error": str(error), "updated_at": time.time()}, "$unset": {"lease_expires": "", "owner": ""}},
+        )
+        return status
+
+    def recover(self):
+        """Create the queue index and requeue jobs whose lease expired while no replica was running"""
+        self.collection.create_index([("status", 1), ("_id", 1)])
+        now = time.time()
+        result = self.collection.update_many(
+            {"status": "running", "lease_expires": {"$lt": now}},
+            {"$set": {"status": "queued", "updated_at": now}, "$unset": {"lease_expires": "", "owner": ""}},
+        )
+        return result.modified_count
+
+    def depth(self):
+        return self.collection.count_documents({"$or": [{"status": "queued"}, {"status": "running", "lease_expires": {"$lt": time.time()}}]})
+
+def open_job_queue(backend=QUEUE_BACKEND):
+    if backend == "mongo":
+        return MongoJobQueue()
+    return SqliteJobQueue()
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import time
+from collections import namedtuple
+
+from dispatcher import EventRecord
+from etl_shared.metrics import REGISTRY
+from router import pipeline_name
+from sqlite_store import SqliteStore
+
+DEFERRED_PATH = os.getenv("DEFERRED_PATH", "./state/deferred.sqlite3")
+# overloaded once the durable queue holds more events than this, or runs wait longer than this for a slot
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "200"))
+SHED_WAIT_SECONDS = float(os.getenv("SHED_WAIT_SECONDS", "30"))
+# deferred runs beyond this are dropped, a gap backfill can still produce their outputs later
+SHED_MAX_DEFERRED = int(os.getenv("SHED_MAX_DEFERRED", "10000"))
+SHED_REPLAY_INTERVAL = float(os.getenv("SHED_REPLAY_INTERVAL", "10"))
+SHED_REPLAY_BATCH = int(os.getenv("SHED_REPLAY_BATCH", "20"))
+# how long an overload check is reused, the queue depth is a database query
+SHED_CHECK_INTERVAL = float(os.getenv("SHED_CHECK_INTERVAL", "1"))
+
+SHED_RUNS = REGISTRY.counter("etl_shed_runs_total", "Deferrable runs deferred, dropped or replayed by load shedding", ("pipeline", "action"))
+
+DeferredRun = namedtuple('DeferredRun', ['id', 'bucket', 'object_key', 'etag', 'pipeline'])
+
+class DeferredStore(SqliteStore):
+    """Runs of deferrable pipelines set aside while the system was overloaded, in a local SQLite file
+
+    Replayed runs stay in the store until remove()d once their dispatch went through, a crash
+    or shutdown during the replay leaves them for the next one.
+    """
+
+    def __init__(self, path=DEFERRED_PATH):
+        super().__init__(
+            path,
+            """CREATE TABLE IF NOT EXISTS deferred (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bucket TEXT NOT NULL,
+                object_key TEXT NOT NULL,
+                etag TEXT,
+                pipeline TEXT NOT NULL,
+                deferred_at REAL NOT NULL,
+                UNIQUE (bucket, object_key, pipeline)
+            )""",
+        )
+
+    def add(self, routes, limit=SHED_MAX_DEFERRED):
+        """Defer routes while there is room, returns the routes that did not fit"""
+        now = time.time()
+        dropped = []
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM deferred").fetchone()[0]
+            for route in routes:
+                if count >= limit:
+                    dropped.append(route)
+                    continue
+                # a newer upload of the same object replaces the deferred run
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO deferred (bucket, object_key, etag, pipeline, deferred_at) VALUES (?, ?, ?, ?, ?)",
+                    (route.src, route.object_name, route.etag, pipeline_name(route.config), now),
+                )
+                count += 1
+        return dropped
+
+    def oldest(self, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, bucket, object_key, etag, pipeline FROM deferred ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [DeferredRun(*row) for row in rows]
+
+    def remove(self, run_ids):
+        # by id, a run deferred again meanwhile (or replaced by a newer upload) got a new row and stays
+        with self._lock:
+            self._conn.executemany("DELETE FROM deferred WHERE id = ?", [(run_id,) for run_id in run_ids])
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM deferred").fetchone()[0]
+
+class LoadShedder:
+    """Defers runs of deferrable pipelines while the system is overloaded and replays them later
+
+    The system counts as overloaded when the durable queue is deeper than queue_depth events or
+    runs recently waited longer than wait_seconds for a worker slot. Runs of pipelines with
+    PipelineConfig.deferrable are then parked in the DeferredStore (dropped once it is full)
+    instead of being scheduled, so prescan and the other pipelines keep their slots. replay()
+    feeds parked runs back through the dispatcher once both signals are below half their
+    thresholds.
+    """
+
+    def __init__(self, store, queue_depth, scheduler, max_depth=SHED_QUEUE_DEPTH, max_wait=SHED_WAIT_SECONDS):
+        self.store = store
+        self.queue_depth = queue_depth
+        self.scheduler = scheduler
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.overloaded = False
+        self._checked_at = 0.0
+
+    async def _load(self):
+        depth = await asyncio.get_running_loop().run_in_executor(None, self.queue_depth)
+        return depth, self.scheduler.latency()
+
+    async def check(self):
+        """Re-evaluate the overload state, with hysteresis so it does not flap around the thresholds"""
+        if time.monotonic() - self._checked_at < SHED_CHECK_INTERVAL:
+            return self.overloaded
+        self._checked_at = time.monotonic()
+        depth, wait = await self._load()
+        if self.overloaded:
+            overloaded = depth > self.max_depth / 2 or wait > self.max_wait / 2
+        else:
+            overloaded = depth > self.max_depth or wait > self.max_wait
+        if overloaded != self.overloaded:
+            logging.warning(f"[ LOAD SHEDDING ] {'deferring' if overloaded else 'resuming'} deferrable pipelines, queue depth {depth}, recent wait {wait:.1f}s")
+        self.overloaded = overloaded
+        return overloaded
+
+    async def shed(self, routes):
+        """Routes to run now, deferrable routes are set aside while overloaded"""
+        deferrable = [route for route in routes if route.config.deferrable]
+        if not deferrable or not await self.check():
+            return routes
+        dropped = await asyncio.get_running_loop().run_in_executor(None, self.store.add, deferrable)
+        for route in deferrable:
+            action = "dropped" if route in dropped else "deferred"
+            SHED_RUNS.inc(1, pipeline_name(route.config), action)
+            logging.info(f"[ LOAD SHEDDING ][{pipeline_name(route.config)}] {action} [{route.src}/{route.object_name}]")
+        return [route for route in routes if not route.config.deferrable]
+
+    async def replay(self, dispatcher):
+        # runs for the lifetime of the app, a batch at a time while the system has headroom
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SHED_REPLAY_INTERVAL)
+            try:
+                if await self.check():
+                    continue
+                runs = await loop.run_in_executor(None, self.store.oldest, SHED_REPLAY_BATCH)
+                if not runs:
+                    continue
+                logging.info(f"[ LOAD SHEDDING ] replaying {len(runs)} deferred run(s)")
+                # overload during the replay defers the runs again rather than losing them
+                deferred = [[] for _ in runs]
+                results = await asyncio.gather(*(
+                    dispatcher.dispatch([EventRecord(run.bucket, run.object_key, run.etag)], {run.pipeline}, deferred=run_deferred)
+                    for run, run_deferred in zip(runs, deferred)
+                ), return_exceptions=True)
+                replayed = []
+                for run, result, run_deferred in zip(runs, results, deferred):
+                    if isinstance(result, Exception):
+                        logging.error(f"[ LOAD SHEDDING ][{run.pipeline}] replay of [{run.bucket}/{run.object_key}] failed, kept for the next replay: {result}")
+                        continue
+                    # deferred again under a new row, the old one goes either way
+                    replayed.append(run.id)
+                    if not run_deferred:
+                        SHED_RUNS.inc(1, run.pipeline, "replayed")
+                # only forgotten once dispatched, a crash or shutdown before this point replays them again
+                await loop.run_in_executor(None, self.store.remove, replayed)
+            except Exception as e:
+                logging.error(f"[ LOAD SHEDDING ] replay failed: {e}")
+
+    def stats(self):
+        return {"overloaded": self.overloaded, "deferred": self.store.count()}
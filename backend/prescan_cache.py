@@ -0,0 +1,87 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+PRESCAN_CACHE_TTL = float(os.getenv("PRESCAN_CACHE_TTL", "300"))
+PRESCAN_CACHE_NEGATIVE_TTL = float(os.getenv("PRESCAN_CACHE_NEGATIVE_TTL", "10"))
+PRESCAN_CACHE_SIZE = int(os.getenv("PRESCAN_CACHE_SIZE", "4096"))
+PRESCAN_LOOKUP_WORKERS = int(os.getenv("PRESCAN_LOOKUP_WORKERS", "4"))
+
+def log_name(object_name):
+    """Name of the prescan record covering an object, eg. alphabot_X-data.csv -> alphabot_X"""
+    stem = os.path.splitext(os.path.basename(object_name))[0]
+    return stem[:-len("-data")] if stem.endswith("-data") else stem
+
+class PrescanCache:
+    """TTL/LRU cache of the latest prescan record per log name
+
+    Lookups run on a dedicated executor so a slow Mongo query never blocks the event loop,
+    and concurrent lookups of the same name share a single query. Missing records are
+    cached for a shorter time since prescan is usually about to write them.
+    """
+
+    def __init__(self, collection, ttl=PRESCAN_CACHE_TTL, negative_ttl=PRESCAN_CACHE_NEGATIVE_TTL, maxsize=PRESCAN_CACHE_SIZE):
+        self.collection = collection
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=PRESCAN_LOOKUP_WORKERS, thread_name_prefix="prescan-lookup")
+
+    def _find_latest(self, name):
+        return self.collection.find_one({"name": name}, sort=[("saved_timestamp", -1)])
+
+    def _cached(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False, None
+            expires_at, record = entry
+            if expires_at < time.monotonic():
+                del self._entries[name]
+                return False, None
+            self._entries.move_to_end(name)
+            return True, record
+
+    def _store(self, name, record):
+        ttl = self.ttl if record is not None else self.negative_ttl
+        self._entries[name] = (time.monotonic() + ttl, record)
+        self._entries.move_to_end(name)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _complete(self, name, future):
+        with self._lock:
+            # invalidate() drops the in-flight marker, a read that raced with a new prescan record is not cached
+            if self._inflight.get(name) is not future:
+                return
+            del self._inflight[name]
+            if not future.cancelled() and future.exception() is None:
+                self._store(name, future.result())
+
+    async def get(self, name):
+        found, record = self._cached(name)
+        if found:
+            self.hits += 1
+            return record
+
+        self.misses += 1
+        with self._lock:
+            future = self._inflight.get(name)
+            if future is None:
+                future = asyncio.get_running_loop().run_in_executor(self._executor, self._find_latest, name)
+                self._inflight[name] = future
+                future.add_done_callback(lambda done: self._complete(name, done))
+        return await asyncio.shield(future)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+            self._inflight.pop(name, None)
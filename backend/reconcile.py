@@ -0,0 +1,80 @@
+import logging
+import os
+import posixpath
+
+from minio.error import S3Error
+
+from dispatcher import PRESCAN_STAGE
+from prescan_cache import log_name
+
+def list_outputs(minio_client, bucket_name, prefix=""):
+    """{object name: last modified} of a destination bucket, listed under the directory part of prefix
+
+    Output keys are derived from the input key's stem, so they share its directory but not
+    necessarily a partial file name prefix.
+    """
+    directory = posixpath.dirname(prefix)
+    try:
+        return {
+            obj.object_name: obj.last_modified
+            for obj in minio_client.list_objects(bucket_name, prefix=f"{directory}/" if directory else None, recursive=True)
+            if not obj.is_dir
+        }
+    except S3Error as err:
+        if err.code == "NoSuchBucket":
+            return {}
+        raise
+
+def expected_outputs(route):
+    """Objects the route's pipeline writes to route.dest, PipelineConfig.output_suffixes or else its dest_object_name"""
+    if not route.config.output_suffixes:
+        return [route.dest_object_name]
+    stem = os.path.splitext(route.object_name)[0]
+    return [f"{stem}{suffix}" for suffix in route.config.output_suffixes]
+
+class OutputIndex:
+    """Bulk listing of the outputs pipelines already produced, used to find gaps to reprocess
+
+    Destinations that are MinIO buckets are listed once per index. A route is up to date when
+    each of its expected_outputs exists and was modified after the input. Pipelines writing to Mongo
+    (dest "mongo") have no listable output: the prescan stage counts as done when the log's
+    prescan record exists, other Mongo pipelines are assumed done since their writes cannot
+    be matched back to an input.
+    """
+
+    def __init__(self, minio_client, prescan_collection, prefix=""):
+        self.minio_client = minio_client
+        self.prescan_collection = prescan_collection
+        self.prefix = prefix
+        self._buckets = {}
+
+    def _bucket(self, bucket_name):
+        outputs = self._buckets.get(bucket_name)
+        if outputs is None:
+            outputs = self._buckets[bucket_name] = list_outputs(self.minio_client, bucket_name, self.prefix)
+            logging.info(f"[ RECONCILE ] listed {len(outputs)} existing output(s) in {bucket_name}")
+        return outputs
+
+    def _prescanned(self, routes):
+        names = list({log_name(route.object_name) for route in routes})
+        if not names:
+            return set()
+        return set(self.prescan_collection.distinct("name", {"name": {"$in": names}}))
+
+    def gaps(self, routes, last_modified):
+        """Routes whose output is missing or older than the input, last_modified maps object name to input mtime"""
+        prescanned = self._prescanned([route for route in routes if route.dest == "mongo" and route.config.stage == PRESCAN_STAGE])
+        gaps = []
+        for route in routes:
+            if route.dest == "mongo":
+                if route.config.stage == PRESCAN_STAGE and log_name(route.object_name) not in prescanned:
+                    gaps.append(route)
+                continue
+            outputs = self._bucket(route.dest)
+            input_modified = last_modified.get(route.object_name)
+            for output_name in expected_outputs(route):
+                output_modified = outputs.get(output_name)
+                if output_modified is None or (input_modified is not None and output_modified < input_modified):
+                    gaps.append(route)
+                    break
+        return gaps
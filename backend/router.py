@@ -0,0 +1,152 @@
+import logging
+import os
+import re
+from collections import namedtuple
+from types import MappingProxyType
+
+from etl_shared.storage import PRECOMPRESSED_SUFFIXES
+
+# dest of pipelines that write to MongoDB instead of a bucket
+MONGO_DEST = "mongo"
+EXECUTORS = ("thread", "process", "deployment")
+ORCHESTRATIONS = ("tasks", "flow")
+
+_FAULT_CODE_PATTERN = re.compile(r"^[0-9A-Fa-f]{2}_[0-9A-Fa-f]{2}_[0-9A-Fa-f]{2}$")
+# a "." meant as the literal dot of a file extension at the end of a regex_trigger
+_UNESCAPED_EXTENSION_PATTERN = re.compile(r"(?<!\\)\.\w+$")
+
+Route = namedtuple('Route', ['config', 'src', 'object_name', 'dest', 'dest_object_name', 'etag'], defaults=(None,))
+
+def is_precompressed_copy(object_name):
+    # precompressed copies written next to artifacts are not new inputs
+    return object_name.endswith(tuple(PRECOMPRESSED_SUFFIXES.values()))
+
+def pipeline_name(config):
+    if isinstance(config.prefect_flow, str):
+        # "module:attribute" import path, named after the attribute like the flow function itself
+        return config.prefect_flow.rpartition(":")[2].rpartition(".")[2]
+    return config.prefect_flow.__name__
+
+def parse_faults_trigger(faults_trigger):
+    """None for "*" (any fault, not gated), else the frozenset of fault codes, empty for a disabled pipeline
+
+    Codes may be given as a list or as comma separated strings, surrounding spaces are dropped.
+    """
+    if faults_trigger == "*":
+        return None
+    if isinstance(faults_trigger, str):
+        faults_trigger = [faults_trigger]
+    faults = frozenset(code.strip() for entry in faults_trigger for code in entry.split(",") if code.strip())
+    invalid = sorted(code for code in faults if not _FAULT_CODE_PATTERN.match(code))
+    if invalid:
+        raise ValueError(f"invalid fault code(s) {invalid}, expected \"*\" or codes like 05_0E_00")
+    return faults
+
+def _config_errors(config, bucket_names):
+    errors = []
+    if not config.regex_trigger:
+        errors.append("no regex_trigger")
+    else:
+        try:
+            re.compile(config.regex_trigger)
+        except re.error as e:
+            errors.append(f"invalid regex_trigger {config.regex_trigger!r}: {e}")
+    try:
+        parse_faults_trigger(config.faults_trigger)
+    except (ValueError, TypeError, AttributeError) as e:
+        errors.append(f"faults_trigger {config.faults_trigger!r}: {e}")
+    if bucket_names is not None:
+        if config.src not in bucket_names:
+            errors.append(f"source bucket {config.src} is not in BUCKET_CONFIGS")
+        if config.dest != MONGO_DEST and config.dest not in bucket_names:
+            errors.append(f"destination bucket {config.dest} is not in BUCKET_CONFIGS")
+    if config.executor not in EXECUTORS:
+        errors.append(f"executor {config.executor!r} is not one of {list(EXECUTORS)}")
+    if config.orchestration not in ORCHESTRATIONS:
+        errors.append(f"orchestration {config.orchestration!r} is not one of {list(ORCHESTRATIONS)}")
+    if config.output_suffixes is not None and (isinstance(config.output_suffixes, str) or not all(isinstance(suffix, str) and suffix for suffix in config.output_suffixes)):
+        errors.append(f"output_suffixes {config.output_suffixes!r} is not a list of object name suffixes")
+    if config.output_suffixes and config.dest == MONGO_DEST:
+        errors.append("output_suffixes are set but the pipeline writes to MongoDB")
+    for field in ("prefect_flow", "batch_flow"):
+        path = getattr(config, field)
+        if isinstance(path, str) and ":" not in path:
+            errors.append(f"{field} {path!r} is not a \"module:attribute\" import path")
+    if not isinstance(config.stage, int) or config.stage < 0:
+        errors.append(f"stage {config.stage!r} is not a non-negative int")
+    if config.max_concurrency is not None and (not isinstance(config.max_concurrency, int) or config.max_concurrency < 1):
+        errors.append(f"max_concurrency {config.max_concurrency!r} is neither None (no cap) nor a positive int")
+    return errors
+
+def compile_pipeline_configs(pipeline_configs, bucket_configs=None):
+    """Validated PipelineConfigs with faults_trigger normalised by parse_faults_trigger
+
+    All problems of all configs are collected into one ValueError, so a bad config fails startup
+    instead of individual events. Source and destination buckets are only checked against
+    bucket_configs when they are given.
+    """
+    bucket_names = None if bucket_configs is None else {bucket.name for bucket in bucket_configs}
+    errors = []
+    names = set()
+    for config in pipeline_configs:
+        name = pipeline_name(config)
+        if name in names:
+            errors.append(f"{name}: another pipeline has the same name, names key concurrency caps and deduplication")
+        names.add(name)
+        errors.extend(f"{name}: {error}" for error in _config_errors(config, bucket_names))
+    if errors:
+        raise ValueError("invalid PIPELINE_CONFIGS:\n  " + "\n  ".join(errors))
+
+    if bucket_configs is not None:
+        notified = {bucket.name for bucket in bucket_configs if any(bucket.notify_webhooks)}
+        for config in pipeline_configs:
+            if config.src not in notified:
+                logging.warning(f"[ ROUTER ] {pipeline_name(config)} reads {config.src}, which sends no webhook, only backfills will run it")
+    for config in pipeline_configs:
+        if _UNESCAPED_EXTENSION_PATTERN.search(config.regex_trigger):
+            logging.warning(f"[ ROUTER ] {pipeline_name(config)}: regex_trigger {config.regex_trigger!r} ends in an unescaped \".\", which matches any character")
+    return tuple(config._replace(faults_trigger=parse_faults_trigger(config.faults_trigger)) for config in pipeline_configs)
+
+class PipelineRouter:
+    """Routing table compiled once from PIPELINE_CONFIGS
+
+    The configs are validated and normalised by compile_pipeline_configs. Configs are indexed by
+    source bucket and configs sharing a regex_trigger share one precompiled pattern, so an event
+    costs one dict lookup plus one match per distinct pattern of its bucket, independent of how
+    many pipelines hang off each pattern. Patterns must match the whole object name. Pipelines
+    whose faults_trigger lists no fault code are disabled and left out of the table.
+    """
+
+    def __init__(self, pipeline_configs, bucket_configs=None):
+        self.configs = compile_pipeline_configs(pipeline_configs, bucket_configs)
+        by_bucket = {}
+        for config in self.configs:
+            if config.faults_trigger == frozenset():
+                logging.info(f"[ ROUTER ] {pipeline_name(config)} is disabled, its faults_trigger lists no fault code")
+                continue
+            patterns = by_bucket.setdefault(config.src, {})
+            patterns.setdefault(config.regex_trigger, []).append(config)
+
+        # freeze into (compiled pattern, configs) pairs in declaration order
+        self._by_bucket = MappingProxyType({
+            bucket: tuple((re.compile(regex), tuple(configs)) for regex, configs in patterns.items())
+            for bucket, patterns in by_bucket.items()
+        })
+
+    def buckets(self):
+        return list(self._by_bucket)
+
+    def route(self, bucket_name, object_name, etag=None):
+        """Return a Route for every pipeline whose source bucket and regex_trigger match the object"""
+        routes = []
+        if not object_name or is_precompressed_copy(object_name):
+            return routes
+
+        stem = os.path.splitext(object_name)[0]
+        for pattern, configs in self._by_bucket.get(bucket_name, ()):
+            if pattern.fullmatch(object_name):
+                routes.extend(
+                    Route(config, config.src, object_name, config.dest, f"{stem}{config.dest_obj_suffix}", etag)
+                    for config in configs
+                )
+        return routes
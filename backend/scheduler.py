@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from etl_shared.metrics import REGISTRY
+
+FLOW_WORKERS = int(os.getenv("FLOW_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+# relative share of worker slots each priority lane gets while several lanes have work waiting
+LANE_WEIGHTS = os.getenv("SCHEDULER_LANE_WEIGHTS", "critical=8,standard=4,bulk=1")
+DEFAULT_LANE = "standard"
+DEFAULT_EXECUTOR = "thread"
+# weight of the latest run in the moving average of lane wait times
+WAIT_SMOOTHING = 0.2
+# a wide call that narrower calls overtook this many times for lack of free slots gets the next free slots reserved
+SCHEDULE_MAX_OVERTAKES = int(os.getenv("SCHEDULE_MAX_OVERTAKES", "16"))
+
+SCHEDULE_WAIT = REGISTRY.histogram("etl_schedule_wait_seconds", "Time a routed run waited in its lane for a worker slot", ("pipeline", "lane"))
+
+def parse_lane_weights(spec):
+    weights = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, weight = item.split("=")
+        weights[name.strip()] = int(weight)
+    return weights
+
+class LaneStats:
+    def __init__(self):
+        self.queued = 0
+        self.started = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def as_dict(self):
+        finished = self.completed + self.failed
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_seconds": self.wait_seconds / self.started if self.started else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+            "avg_run_seconds": self.run_seconds / finished if finished else 0.0,
+        }
+
+class FairScheduler:
+    """Runs flow calls on executors with priority lanes and per-pipeline concurrency caps
+
+    executors maps a name ("thread", "process") to (executor, max_workers), at most max_workers
+    calls run on each executor at once. A call of width n (a batch flow processing n objects at a
+    time) takes n slots of its executor and of its pipeline's cap. Once narrower calls overtook a
+    wide call SCHEDULE_MAX_OVERTAKES times because it did not fit, its executor and pipeline start
+    nothing else until enough slots have freed up for it, so a steady stream of single runs cannot
+    starve a batch. Whenever a slot frees up the next call is taken from the
+    lanes with a smooth weighted round robin, skipping calls whose pipeline is at its cap or whose
+    executor is full, so a burst in a low weight lane (eg. heavy reports) cannot starve a high
+    weight one (prescan).
+    """
+
+    def __init__(self, executors, lane_weights=None):
+        self.executors = {name: executor for name, (executor, _) in executors.items()}
+        self.capacity = {name: max_workers for name, (_, max_workers) in executors.items()}
+        self.lane_weights = lane_weights or parse_lane_weights(LANE_WEIGHTS)
+        self.pipeline_limits = {}
+        self._lanes = {lane: deque() for lane in self.lane_weights}
+        self._current = {lane: 0 for lane in self.lane_weights}
+        self._pipeline_running = {}
+        self._executor_running = {name: 0 for name in self.executors}
+        self.stats = {lane: LaneStats() for lane in self.lane_weights}
+        self.recent_wait = 0.0
+        # future of each waiting wide call: [pipeline, executor, width, times a narrower call started while it did not fit]
+        self._overtaken = {}
+        # executor or pipeline: the wide call their freed slots are held for
+        self._reserved = {}
+
+    def set_limit(self, pipeline, max_concurrency):
+        if max_concurrency:
+            self.pipeline_limits[pipeline] = min(max_concurrency, self.pipeline_limits.get(pipeline, max_concurrency))
+
+    def width(self, pipeline, executor, width):
+        """Slots a call asking for `width` can take, within its pipeline's cap and its executor's capacity"""
+        limit = self.pipeline_limits.get(pipeline)
+        if limit is not None:
+            width = min(width, limit)
+        if executor in self.capacity:
+            width = min(width, self.capacity[executor])
+        return max(1, width)
+
+    def _fits(self, pipeline, executor, width):
+        if self._executor_running[executor] + width > self.capacity[executor]:
+            return False
+        limit = self.pipeline_limits.get(pipeline)
+        return limit is None or self._pipeline_running.get(pipeline, 0) + width <= limit
+
+    def _eligible(self, item):
+        future, pipeline, executor = item[:3]
+        if self._reserved.get(("executor", executor), future) is not future or self._reserved.get(("pipeline", pipeline), future) is not future:
+            return False
+        return self._fits(pipeline, executor, item[6])
+
+    def _next_item(self, lane):
+        queue = self._lanes[lane]
+        for item in queue:
+            if self._eligible(item):
+                return item
+        return None
+
+    def _overtake(self, pipeline, executor):
+        # a call of pipeline just started on executor, count it against the wide calls it got ahead of
+        for future, wide in self._overtaken.items():
+            wide_pipeline, wide_executor, width, count = wide
+            if (wide_executor != executor and wide_pipeline != pipeline) or self._fits(wide_pipeline, wide_executor, width):
+                continue
+            wide[3] = count + 1
+            if wide[3] >= SCHEDULE_MAX_OVERTAKES:
+                self._reserved.setdefault(("executor", wide_executor), future)
+                self._reserved.setdefault(("pipeline", wide_pipeline), future)
+
+    def _unreserve(self, future, pipeline, executor):
+        self._overtaken.pop(future, None)
+        for key in (("executor", executor), ("pipeline", pipeline)):
+            if self._reserved.get(key) is future:
+                del self._reserved[key]
+
+    def _pick(self):
+        # smooth weighted round robin over the lanes that have something runnable
+        candidates = {}
+        for lane in self.lane_weights:
+            item = self._next_item(lane)
+            if item is not None:
+                candidates[lane] = item
+        if not candidates:
+            return None, None
+
+        total = 0
+        for lane in candidates:
+            self._current[lane] += self.lane_weights[lane]
+            total += self.lane_weights[lane]
+        lane = max(candidates, key=lambda candidate: self._current[candidate])
+        self._current[lane] -= total
+        return lane, candidates[lane]
+
+    def _schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            lane, item = self._pick()
+            if item is None:
+                return
+            self._lanes[lane].remove(item)
+            future, pipeline, executor, func, args, enqueued_at, width = item
+            self._unreserve(future, pipeline, executor)
+
+            stats = self.stats[lane]
+            stats.queued -= 1
+            if future.cancelled():
+                continue
+            self._overtake(pipeline, executor)
+            wait = time.monotonic() - enqueued_at
+            SCHEDULE_WAIT.observe(wait, pipeline, lane)
+            self.recent_wait += WAIT_SMOOTHING * (wait - self.recent_wait)
+            stats.wait_seconds += wait
+            stats.max_wait_seconds = max(stats.max_wait_seconds, wait)
+            stats.started += 1
+            stats.running += 1
+            self._executor_running[executor] += width
+            self._pipeline_running[pipeline] = self._pipeline_running.get(pipeline, 0) + width
+
+            started_at = time.monotonic()
+            try:
+                execution = loop.run_in_executor(self.executors[executor], func, *args)
+            except Exception as e:
+                # the executor refused the call (eg. shut down), fail this run and keep scheduling
+                execution = loop.create_future()
+                execution.set_exception(e)
+            execution.add_done_callback(lambda done, lane=lane, pipeline=pipeline, executor=executor, width=width, future=future, started_at=started_at: self._finished(lane, pipeline, executor, width, future, started_at, done))
+
+    def _finished(self, lane, pipeline, executor, width, future, started_at, execution):
+        stats = self.stats[lane]
+        stats.running -= 1
+        stats.run_seconds += time.monotonic() - started_at
+        self._executor_running[executor] -= width
+        self._pipeline_running[pipeline] -= width
+
+        if execution.exception() is not None:
+            stats.failed += 1
+            if not future.done():
+                future.set_exception(execution.exception())
+        else:
+            stats.completed += 1
+            if not future.done():
+                future.set_result(execution.result())
+        self._schedule()
+
+    async def run(self, lane, pipeline, func, *args, executor=DEFAULT_EXECUTOR, width=1):
+        if lane not in self._lanes:
+            fallback = DEFAULT_LANE if DEFAULT_LANE in self._lanes else next(iter(self._lanes))
+            logging.warning(f"[ SCHEDULER ] unknown lane {lane} for {pipeline}, using {fallback}")
+            lane = fallback
+        if executor not in self.executors:
+            logging.warning(f"[ SCHEDULER ] unknown executor {executor} for {pipeline}, using {DEFAULT_EXECUTOR}")
+            executor = DEFAULT_EXECUTOR
+        future = asyncio.get_running_loop().create_future()
+        # never wider than its pipeline's cap or its executor, or the call could not be scheduled at all
+        width = self.width(pipeline, executor, width)
+        self._lanes[lane].append((future, pipeline, executor, func, args, time.monotonic(), width))
+        if width > 1:
+            self._overtaken[future] = [pipeline, executor, width, 0]
+        self.stats[lane].queued += 1
+        self._schedule()
+        return await future
+
+    def latency(self):
+        """Recent wait for a worker slot, the moving average or the age of the oldest waiting run if larger"""
+        now = time.monotonic()
+        oldest = max((now - queue[0][5] for queue in self._lanes.values() if queue), default=0.0)
+        return max(self.recent_wait, oldest)
+
+    def snapshot(self):
+        return {lane: stats.as_dict() for lane, stats in self.stats.items()}
+
+    def executor_snapshot(self):
+        return {name: {"running": self._executor_running[name], "capacity": self.capacity[name]} for name in self.executors}
@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class SqliteStore:
+    """Base of the stores kept in a local SQLite file
+
+    One connection is shared by the threads of the process behind a lock, in WAL mode so reads
+    do not block behind writes, in autocommit mode with explicit transactions where several
+    statements have to apply together. schema statements run on open and must be idempotent.
+    """
+
+    def __init__(self, path, *schema):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            self._conn.execute(statement)
+
+    def _columns(self, table):
+        return {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, a check-and-mark cannot interleave with another writer
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
@@ -0,0 +1,100 @@
+import logging
+import os
+import re
+
+from etl_shared.storage import read_object
+from etl_shared.summary_index import SUMMARY_KINDS, in_time_range, line_kind, line_timestamp, summary_index_record
+
+SUMMARY_BUCKET = os.getenv("SUMMARY_BUCKET", "logfisher-summaries")
+SUMMARY_SUFFIX = "_summary.txt"
+
+# full timestamps as written in the summaries, or a prefix of one ("2024-08-13 23:25"), "T" is accepted for the space
+_QUERY_TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}(?:[ T]\d{2}(?::\d{2}(?::\d{2}(?:\.\d+)?)?)?)?$")
+
+def parse_timestamp(value):
+    """Normalise a from/to query value to the summary timestamp format, ValueError when it is not one"""
+    if value is None:
+        return None
+    if not _QUERY_TIMESTAMP_PATTERN.match(value):
+        raise ValueError(f"invalid timestamp {value!r}, expected eg. 2024-08-13 23:25:00")
+    return value.replace("T", " ")
+
+def parse_kinds(value):
+    if not value:
+        return None
+    kinds = {kind.strip().upper() for kind in value.split(",") if kind.strip()}
+    unknown = kinds - set(SUMMARY_KINDS)
+    if unknown:
+        raise ValueError(f"unknown kind(s) {sorted(unknown)}, expected {', '.join(SUMMARY_KINDS)}")
+    return kinds
+
+def block_ranges(blocks, start=None, end=None, kinds=None):
+    """(offset, length, timestamp) byte ranges covering the index blocks that can hold matching lines, adjacent blocks merged
+
+    timestamp is the one the range starts under, the entry its leading continuation lines belong to.
+    """
+    ranges = []
+    for block in blocks:
+        if start is not None and block["last"] < start:
+            continue
+        if end is not None and block["first"][:len(end)] > end:
+            # blocks are in time order, nothing later matches
+            break
+        if kinds and not kinds.intersection(block["kinds"]):
+            continue
+        if ranges and ranges[-1][0] + ranges[-1][1] == block["offset"]:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + block["length"], ranges[-1][2])
+        else:
+            ranges.append((block["offset"], block["length"], block["first"]))
+    return ranges
+
+class SummaryReader:
+    """Time range and kind slices of logfisher summaries, read with ranged MinIO requests
+
+    The logfisher flow stores an offset index of every summary in Mongo when it writes it. Only
+    the index blocks overlapping the requested time range (and holding lines of the requested
+    kinds) are fetched, then filtered line by line. Summaries without an index, or whose index
+    belongs to an older version of the object, are read once in full to index them.
+    """
+
+    def __init__(self, minio_client, index_collection, bucket_name=SUMMARY_BUCKET):
+        self.minio_client = minio_client
+        self.index_collection = index_collection
+        self.bucket_name = bucket_name
+
+    def _index(self, object_name):
+        stat = self.minio_client.stat_object(self.bucket_name, object_name)
+        index = self.index_collection.find_one({"bucket": self.bucket_name, "object": object_name}, {"_id": 0})
+        if index is None or index["etag"] != stat.etag:
+            logging.info(f"[ SUMMARY ] indexing {self.bucket_name}/{object_name}")
+            data = read_object(self.minio_client, self.bucket_name, object_name)
+            index = summary_index_record(self.bucket_name, object_name, stat.etag, data)
+            self.index_collection.replace_one({"bucket": self.bucket_name, "object": object_name}, index, upsert=True)
+        return index
+
+    def _read_range(self, object_name, offset, length):
+        response = self.minio_client.get_object(self.bucket_name, object_name, offset, length)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def read(self, log, start=None, end=None, kinds=None):
+        """Matching lines of the log's summary and the number of summary bytes fetched for them"""
+        object_name = f"{log}{SUMMARY_SUFFIX}"
+        index = self._index(object_name)
+        lines = []
+        fetched = 0
+        for offset, length, timestamp in block_ranges(index["blocks"], start, end, kinds):
+            data = self._read_range(object_name, offset, length)
+            fetched += len(data)
+            for line in data.decode("utf-8", "replace").splitlines():
+                # continuation lines without a timestamp are in or out of the slice with the entry they belong to
+                timestamp = line_timestamp(line) or timestamp or ""
+                if not in_time_range(timestamp, start, end):
+                    continue
+                if kinds and line_kind(line) not in kinds:
+                    continue
+                lines.append(line)
+        return lines, fetched
@@ -0,0 +1,6 @@
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the API modules import each other by flat name, etl_shared is pip installed in the image but also importable from the tree
+sys.path[:0] = [BACKEND_DIR, os.path.join(BACKEND_DIR, "flows", "shared")]
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from dispatcher import BATCH_MAX_SIZE, BATCH_MIN_DEPTH, batch_size, claim_queued_jobs
+from job_queue import SqliteJobQueue
+
+@pytest.mark.parametrize("depth, workers, size", [
+    (0, 4, 1),
+    (BATCH_MIN_DEPTH - 1, 1, 1),
+    (BATCH_MIN_DEPTH, 4, BATCH_MIN_DEPTH // 4),
+    (120, 4, 30),
+    (10000, 4, BATCH_MAX_SIZE),
+    (BATCH_MIN_DEPTH, 0, BATCH_MIN_DEPTH),
+])
+def test_batch_size(depth, workers, size):
+    assert batch_size(depth, workers) == size
+
+@pytest.fixture
+def queue(tmp_path):
+    return SqliteJobQueue(str(tmp_path / "queue.sqlite3"))
+
+def test_without_a_window_workers_claim_their_share_of_the_backlog(queue):
+    for n in range(BATCH_MIN_DEPTH - 1):
+        queue.put({"n": n})
+    # a short queue is dispatched one event at a time
+    assert len(asyncio.run(claim_queued_jobs(queue, workers=2))) == 1
+    for n in range(60):
+        queue.put({"n": n})
+    assert len(asyncio.run(claim_queued_jobs(queue, workers=2))) == min(BATCH_MAX_SIZE, (BATCH_MIN_DEPTH - 2 + 60) // 2)
+
+def test_the_window_collects_events_arriving_during_the_storm(queue):
+    async def main():
+        queue.put({"n": 0})
+        claim = asyncio.ensure_future(claim_queued_jobs(queue, workers=4, coalesce_seconds=0.1, max_events=10))
+        await asyncio.sleep(0.02)
+        for n in range(1, 4):
+            queue.put({"n": n})
+        return await claim
+
+    jobs = asyncio.run(main())
+    assert [job.payload["n"] for job in jobs] == [0, 1, 2, 3]
+
+def test_the_window_stops_at_max_events(queue):
+    for n in range(15):
+        queue.put({"n": n})
+    jobs = asyncio.run(claim_queued_jobs(queue, workers=4, coalesce_seconds=5, max_events=10))
+    # a full batch is dispatched right away, without waiting out the window
+    assert [job.payload["n"] for job in jobs] == list(range(10))
+    assert queue.depth() == 5
+
+def test_an_empty_queue_does_not_wait_out_the_window(queue):
+    assert asyncio.run(asyncio.wait_for(claim_queued_jobs(queue, workers=4, coalesce_seconds=5), 1)) == []
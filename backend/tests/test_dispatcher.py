@@ -0,0 +1,71 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from config import BUCKET_CONFIGS, PipelineConfig
+from dispatcher import Dispatcher, dispatch_jobs, without_precompressed_copies
+from idempotency import IdempotencyStore
+from job_queue import SqliteJobQueue
+from router import PipelineRouter
+from scheduler import FairScheduler
+
+BUCKET = "alphabot-logs-bucket"
+
+class NoPrescans:
+    async def get(self, name):
+        return None
+
+    def invalidate(self, name):
+        pass
+
+def event(key):
+    return {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "eTag": "etag"}}}]}
+
+def test_jobs_with_a_failed_flow_are_retried_then_parked(tmp_path):
+    calls = {"flaky": 0, "steady": 0}
+
+    def flaky(*args):
+        calls["flaky"] += 1
+        raise ConnectionError("minio is down")
+
+    def steady(*args):
+        calls["steady"] += 1
+
+    configs = [
+        PipelineConfig("flaky", BUCKET, "plots", "_flaky.html", flaky, r"a\.txt", "*"),
+        PipelineConfig("steady", BUCKET, "plots", "_steady.html", steady, r"a\.txt", "*"),
+    ]
+
+    async def main():
+        queue = SqliteJobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=2)
+        dispatcher = Dispatcher(
+            PipelineRouter(configs, BUCKET_CONFIGS), NoPrescans(), None,
+            FairScheduler({"thread": (ThreadPoolExecutor(max_workers=4), 4)}),
+            IdempotencyStore(str(tmp_path / "idempotency.sqlite3")),
+        )
+        ok = queue.put(event("b.txt"))
+        queue.put(event("a.txt"))
+
+        failures = await dispatch_jobs(dispatcher, queue, queue.claim(2))
+        assert [(job.payload, status) for job, status, _ in failures] == [(event("a.txt"), "queued")]
+        assert isinstance(failures[0][2], ConnectionError)
+        # the job without a failed run is acked, the other one is back in the queue
+        assert queue.depth() == 1
+        assert ok not in [job.id for job in queue.claim(0)]
+
+        failures = await dispatch_jobs(dispatcher, queue, queue.claim(1))
+        assert [(job.attempts, status) for job, status, _ in failures] == [(2, "failed")]
+        assert queue.depth() == 0
+        # the retry only ran the pipeline that failed
+        assert calls == {"flaky": 2, "steady": 1}
+
+    asyncio.run(main())
+
+def test_records_of_precompressed_copies_are_dropped_before_the_queue():
+    summary = "logfisher-summaries", "alphabot_1_summary.txt"
+
+    def records(*keys):
+        return {"EventName": "s3:ObjectCreated:Put", "Records": [{"s3": {"bucket": {"name": summary[0]}, "object": {"key": key}}} for key in keys]}
+
+    assert without_precompressed_copies(records(summary[1])) == records(summary[1])
+    assert without_precompressed_copies(records(f"{summary[1]}.gz")) is None
+    assert without_precompressed_copies(records(f"{summary[1]}.br", summary[1], f"{summary[1]}.gz")) == records(summary[1])
@@ -0,0 +1,99 @@
+import gzip
+
+import pytest
+from minio.error import S3Error
+
+import downloads
+from downloads import (
+    RangeNotSatisfiable, accepted_encodings, compress_stream, encoded_etag, etag_matches, parse_range, precompressed_object,
+    stream_encoding,
+)
+from etl_shared.storage import SOURCE_ETAG_METADATA
+
+def test_parse_range_single_ranges():
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=90-500", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=-500", 100) == (0, 99)
+
+def test_parse_range_ignores_invalid_range_specs():
+    # last byte before the first is an invalid range-spec, served as a full 200 (RFC 9110 14.1.1)
+    assert parse_range("bytes=5-2", 100) is None
+    assert parse_range("bytes=500-2", 100) is None
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=-", 100) is None
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("items=0-1", 100) is None
+
+def test_parse_range_unsatisfiable():
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=100-", 100)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=100-200", 100)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=-0", 100)
+
+@pytest.mark.parametrize("accept_encoding, encodings", [
+    (None, []),
+    ("", []),
+    ("gzip, deflate, br", ["br", "gzip"]),
+    ("gzip", ["gzip"]),
+    ("br;q=0.5, gzip;q=0.8", ["gzip", "br"]),
+    ("gzip;q=1.0, br;q=1.0", ["br", "gzip"]),
+    ("*", ["br", "gzip"]),
+    ("*;q=0.3, gzip", ["gzip", "br"]),
+    ("br;q=0, *", ["gzip"]),
+    ("identity;q=0", []),
+    ("identity", []),
+    ("gzip;q=abc, br", ["br"]),
+])
+def test_accepted_encodings(accept_encoding, encodings):
+    assert accepted_encodings(accept_encoding) == encodings
+
+def test_on_the_fly_compression_falls_back_to_gzip_without_brotli(monkeypatch):
+    monkeypatch.setattr(downloads, "STREAM_ENCODINGS", ("br", "gzip"))
+    assert stream_encoding(["br", "gzip"]) == "br"
+    monkeypatch.setattr(downloads, "STREAM_ENCODINGS", ("gzip",))
+    assert stream_encoding(["br", "gzip"]) == "gzip"
+    assert stream_encoding(["br"]) is None
+
+def test_compress_stream_gzip():
+    chunks = iter([b"2024-08-13 23:25:00 move\n"] * 100)
+    compressed = b"".join(compress_stream((chunk for chunk in chunks), "gzip"))
+    assert gzip.decompress(compressed) == b"2024-08-13 23:25:00 move\n" * 100
+
+class Stat:
+    def __init__(self, etag, size=10, source_etag=None):
+        self.etag = etag
+        self.size = size
+        self.metadata = {f"x-amz-meta-{SOURCE_ETAG_METADATA}": source_etag} if source_etag else {}
+
+class FakeMinio:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def stat_object(self, bucket_name, object_name):
+        if object_name not in self.objects:
+            raise S3Error(code="NoSuchKey", message="missing", resource=object_name, request_id="", host_id="", response=None)
+        return self.objects[object_name]
+
+def test_precompressed_copies_are_only_served_for_the_version_they_were_made_from():
+    stat = Stat("v2")
+    client = FakeMinio({
+        # left over from the previous upload of the report
+        "report.html.br": Stat("br1", source_etag="v1"),
+        "report.html.gz": Stat("gz2", size=3, source_etag="v2"),
+    })
+    encoding, name, sibling = precompressed_object(client, "plots", "report.html", stat, ["br", "gzip"])
+    assert (encoding, name, sibling.size) == ("gzip", "report.html.gz", 3)
+    assert precompressed_object(client, "plots", "report.html", stat, ["br"]) is None
+    assert precompressed_object(client, "plots", "other.html", stat, ["br", "gzip"]) is None
+
+def test_etag_matches_the_encoded_representations():
+    assert etag_matches('"abc"', "abc")
+    assert etag_matches(f'W/"{encoded_etag("abc", "gzip")}"', "abc")
+    assert etag_matches('"x", "abc-br"', "abc")
+    assert etag_matches("*", "abc")
+    assert not etag_matches('"abd"', "abc")
+    assert not etag_matches(None, "abc")
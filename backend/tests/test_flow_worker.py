@@ -0,0 +1,21 @@
+import pytest
+
+from flow_worker import flow_parameters
+
+def motor_fault_detection_flow(source_bucket_name, source_object_name, dest_bucket_name, dest_object_name):
+    pass
+
+def fingerprints(bucket_name, object_name):
+    pass
+
+def test_parameters_are_named_after_the_flow_signature():
+    assert flow_parameters(motor_fault_detection_flow, ("logs", "a.txt", "plots", "a.html")) == {
+        "source_bucket_name": "logs",
+        "source_object_name": "a.txt",
+        "dest_bucket_name": "plots",
+        "dest_object_name": "a.html",
+    }
+
+def test_flows_that_do_not_take_the_arguments_are_rejected():
+    with pytest.raises(TypeError):
+        flow_parameters(fingerprints, ("logs", "a.txt", "plots", "a.html"))
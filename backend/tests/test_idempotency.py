@@ -0,0 +1,29 @@
+from idempotency import IdempotencyStore
+
+KEY = ("alphabot-logs-bucket", "alphabot_1.txt", "etag", "prescan_flow")
+
+def test_completed_runs_are_duplicates(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "idempotency.sqlite3"))
+    assert store.claim([KEY]) == ([KEY], [])
+    store.complete([KEY])
+    assert store.claim([KEY]) == ([], [])
+
+def test_in_progress_claims_lapse(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), claim_seconds=0)
+    assert store.claim([KEY]) == ([KEY], [])
+    # never completed nor renewed, eg. the dispatch was cancelled mid-run
+    assert store.claim([KEY]) == ([KEY], [])
+
+def test_released_and_recovered_claims_can_be_claimed_again(tmp_path):
+    path = str(tmp_path / "idempotency.sqlite3")
+    store = IdempotencyStore(path)
+    assert store.claim([KEY]) == ([KEY], [])
+    # held in progress, not done
+    assert store.claim([KEY]) == ([], [KEY])
+    store.release([KEY])
+    assert store.claim([KEY]) == ([KEY], [])
+
+    # a restart drops the claims of runs the previous process did not finish
+    restarted = IdempotencyStore(path)
+    assert restarted.recover() == 1
+    assert restarted.claim([KEY]) == ([KEY], [])
@@ -0,0 +1,93 @@
+import os
+import uuid
+
+import pytest
+
+import job_queue
+from job_queue import MongoJobQueue
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_queue, "time", clock)
+    return clock
+
+@pytest.fixture
+def collection():
+    # a real mongod when MONGO_TEST_URI is set (eg. mongodb://localhost:27017), else mongomock
+    uri = os.getenv("MONGO_TEST_URI")
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    else:
+        mongomock = pytest.importorskip("mongomock")
+        client = mongomock.MongoClient()
+    collection = client["etl_tests"][f"jobs_{uuid.uuid4().hex[:8]}"]
+    yield collection
+    collection.drop()
+
+def replicas(collection, count=2, **kwargs):
+    return [MongoJobQueue(collection, **kwargs) for _ in range(count)]
+
+def test_competing_replicas_claim_each_job_once_in_order(collection, clock):
+    first, second = replicas(collection)
+    ids = [first.put({"n": n}) for n in range(3)]
+
+    assert [job.id for job in first.claim(2)] == ids[:2]
+    assert [job.id for job in second.claim(2)] == ids[2:]
+    assert first.claim(1) == second.claim(1) == []
+    assert first.depth() == 0
+
+def test_an_expired_lease_is_claimed_by_another_replica(collection, clock):
+    first, second = replicas(collection, lease_seconds=60)
+    job_id = first.put({"n": 1})
+    assert [job.attempts for job in first.claim()] == [1]
+
+    clock.now += 30
+    assert second.claim() == []
+    clock.now += 31
+    [job] = second.claim()
+    assert (job.id, job.attempts) == (job_id, 2)
+
+    # the first replica lost its lease, its heartbeat and ack no longer apply
+    assert first.heartbeat(job_id) == []
+    first.ack(job_id)
+    assert collection.count_documents({}) == 1
+    assert second.heartbeat(job_id) == [job_id]
+    second.ack(job_id)
+    assert collection.count_documents({}) == 0
+
+def test_heartbeats_keep_the_lease(collection, clock):
+    first, second = replicas(collection, lease_seconds=60)
+    job_id = first.put({"n": 1})
+    first.claim()
+    for _ in range(3):
+        clock.now += 40
+        assert first.heartbeat(job_id) == [job_id]
+        assert second.claim() == []
+
+def test_jobs_whose_lease_keeps_expiring_are_parked(collection, clock):
+    first, second = replicas(collection, max_attempts=2, lease_seconds=60)
+    job_id = first.put({"n": 1})
+    first.claim()
+    clock.now += 61
+    assert [job.attempts for job in second.claim()] == [2]
+    clock.now += 61
+    assert first.claim() == []
+    doc = collection.find_one({})
+    assert (str(doc["_id"]), doc["status"]) == (job_id, "failed")
+    assert first.depth() == second.depth() == 0
+
+def test_failed_jobs_are_requeued_until_their_last_attempt(collection, clock):
+    [queue] = replicas(collection, count=1, max_attempts=2)
+    queue.put({"n": 1})
+    assert queue.fail(queue.claim()[0], "minio is down") == "queued"
+    assert queue.fail(queue.claim()[0], "minio is down") == "failed"
+    assert queue.claim() == []
@@ -0,0 +1,71 @@
+import asyncio
+from collections import namedtuple
+
+import load_shedding
+from load_shedding import SHED_RUNS, DeferredStore, LoadShedder
+
+Config = namedtuple('Config', ['prefect_flow'])
+Route = namedtuple('Route', ['config', 'src', 'object_name', 'etag'])
+PIPELINE = "logfisher_summary_to_move_events_plot_flow"
+
+def route(object_name, etag="etag"):
+    return Route(Config("command.move_event_flow:logfisher_summary_to_move_events_plot_flow"), "logfisher-summaries", object_name, etag)
+
+def test_replayed_runs_stay_until_removed(tmp_path):
+    store = DeferredStore(str(tmp_path / "deferred.sqlite3"))
+    store.add([route("a_summary.txt"), route("b_summary.txt")])
+    runs = store.oldest(10)
+    assert [run.object_key for run in runs] == ["a_summary.txt", "b_summary.txt"]
+    # nothing is lost until the replay reports the runs dispatched
+    assert store.oldest(10) == runs
+    store.remove([runs[0].id])
+    assert [run.object_key for run in store.oldest(10)] == ["b_summary.txt"]
+
+def test_runs_deferred_again_during_the_replay_are_kept(tmp_path):
+    store = DeferredStore(str(tmp_path / "deferred.sqlite3"))
+    store.add([route("a_summary.txt")])
+    runs = store.oldest(10)
+    # shed again while being replayed, or replaced by a newer upload
+    store.add([route("a_summary.txt", "newer")])
+    store.remove([run.id for run in runs])
+    assert [(run.object_key, run.etag) for run in store.oldest(10)] == [("a_summary.txt", "newer")]
+
+class NoWait:
+    def latency(self):
+        return 0.0
+
+class RedeferringDispatcher:
+    """Defers the first replay of b_summary.txt again, as if overload came back during the replay"""
+
+    def __init__(self, store):
+        self.store = store
+        self.dispatched = []
+
+    async def dispatch(self, records, pipelines=None, deferred=None):
+        [record] = records
+        if record.key == "b_summary.txt" and "b_summary.txt" not in self.dispatched:
+            self.store.add([route(record.key, record.etag)])
+            deferred.append(route(record.key, record.etag))
+        self.dispatched.append(record.key)
+        return {}
+
+def test_runs_deferred_again_are_not_counted_as_replayed(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_shedding, "SHED_REPLAY_INTERVAL", 0.01)
+    store = DeferredStore(str(tmp_path / "deferred.sqlite3"))
+    store.add([route("a_summary.txt"), route("b_summary.txt")])
+    shedder = LoadShedder(store, lambda: 0, NoWait())
+    dispatcher = RedeferringDispatcher(store)
+    replayed = SHED_RUNS._values.get((PIPELINE, "replayed"), 0)
+
+    async def main():
+        replay = asyncio.ensure_future(shedder.replay(dispatcher))
+        while len(dispatcher.dispatched) < 3:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        replay.cancel()
+
+    asyncio.run(main())
+    assert dispatcher.dispatched == ["a_summary.txt", "b_summary.txt", "b_summary.txt"]
+    assert store.count() == 0
+    # b counts once, when its second replay went through
+    assert SHED_RUNS._values.get((PIPELINE, "replayed"), 0) - replayed == 2
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+import pytest
+
+import prescan_cache
+from prescan_cache import PrescanCache, log_name
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class FakePrescans:
+    def __init__(self, records=None):
+        self.records = dict(records or {})
+        self.queries = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def find_one(self, query, sort=None):
+        self.release.wait(5)
+        self.queries.append(query["name"])
+        return self.records.get(query["name"])
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prescan_cache, "time", clock)
+    return clock
+
+def lookups(cache, *names):
+    async def main():
+        return [await cache.get(name) for name in names]
+    return asyncio.run(main())
+
+def test_log_name():
+    assert log_name("alphabot_1_2_3_4_5_6_7-data.csv") == "alphabot_1_2_3_4_5_6_7"
+    assert log_name("logs/alphabot_1_2_3_4_5_6_7.txt") == "alphabot_1_2_3_4_5_6_7"
+
+def test_records_are_cached_until_their_ttl(clock):
+    prescans = FakePrescans({"a": {"fatal_fault_code": "05_0E_00"}})
+    cache = PrescanCache(prescans, ttl=60, negative_ttl=5)
+    assert lookups(cache, "a", "a") == [{"fatal_fault_code": "05_0E_00"}] * 2
+    assert (prescans.queries, cache.hits, cache.misses) == (["a"], 1, 1)
+    clock.now += 61
+    lookups(cache, "a")
+    assert prescans.queries == ["a", "a"]
+
+def test_missing_records_expire_after_the_negative_ttl(clock):
+    prescans = FakePrescans()
+    cache = PrescanCache(prescans, ttl=60, negative_ttl=5)
+    assert lookups(cache, "a", "a") == [None, None]
+    assert prescans.queries == ["a"]
+    # prescan wrote the record meanwhile
+    prescans.records["a"] = {"fatal_fault_code": "05_0E_00"}
+    clock.now += 6
+    assert lookups(cache, "a") == [{"fatal_fault_code": "05_0E_00"}]
+
+def test_least_recently_used_records_are_evicted(clock):
+    prescans = FakePrescans({name: {"name": name} for name in "abc"})
+    cache = PrescanCache(prescans, maxsize=2)
+    lookups(cache, "a", "b", "a", "c")
+    # b was used least recently when c came in
+    lookups(cache, "a", "c", "b")
+    assert prescans.queries == ["a", "b", "c", "b"]
+
+def test_concurrent_lookups_share_one_query(clock):
+    prescans = FakePrescans({"a": {"name": "a"}})
+    prescans.release.clear()
+    cache = PrescanCache(prescans)
+
+    async def main():
+        lookups = [asyncio.ensure_future(cache.get("a")) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        prescans.release.set()
+        return await asyncio.gather(*lookups)
+
+    assert asyncio.run(main()) == [{"name": "a"}] * 5
+    assert prescans.queries == ["a"]
+
+def test_invalidate_drops_the_record_and_a_racing_read(clock):
+    prescans = FakePrescans()
+    cache = PrescanCache(prescans)
+    lookups(cache, "a")
+    prescans.records["a"] = {"name": "a"}
+    cache.invalidate("a")
+    assert lookups(cache, "a") == [{"name": "a"}]
+
+    prescans.release.clear()
+
+    async def main():
+        # a read started before prescan saved a newer record must not be cached
+        stale = asyncio.ensure_future(cache.get("b"))
+        await asyncio.sleep(0.05)
+        cache.invalidate("b")
+        prescans.release.set()
+        await stale
+        prescans.records["b"] = {"name": "b"}
+        return await cache.get("b")
+
+    assert asyncio.run(main()) == {"name": "b"}
+    assert prescans.queries == ["a", "a", "b", "b"]
@@ -0,0 +1,57 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from config import BUCKET_CONFIGS, PIPELINE_CONFIGS
+from reconcile import OutputIndex
+from router import PipelineRouter, pipeline_name
+
+SOURCE_BUCKET = "alphabot-logs-bucket"
+LOG = "alphabot_000277_2024_07_08_11_43_59"
+UPLOADED = datetime(2024, 7, 8, 12, 0)
+
+ListedObject = namedtuple('ListedObject', ['object_name', 'last_modified', 'is_dir'])
+
+class FakeMinio:
+    def __init__(self, objects):
+        # {bucket: {object name: last modified}}
+        self.objects = objects
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False):
+        return [ListedObject(name, modified, False) for name, modified in self.objects.get(bucket_name, {}).items() if name.startswith(prefix or "")]
+
+class FakePrescanCollection:
+    def __init__(self, names):
+        self.names = set(names)
+
+    def distinct(self, field, query):
+        return [name for name in query["name"]["$in"] if name in self.names]
+
+# what each configured flow actually writes for LOG
+WRITTEN = {
+    "logfisher-summaries": [f"{LOG}_summary.txt"],
+    "alphabot-logs-summary-bucket": [f"{LOG}_transformed.txt"],
+    "plots": [f"{LOG}-data-report.html", f"{LOG}-data-analysis.tar.gz", f"{LOG}-data_instability_plot.png"],
+}
+
+def routes(object_names):
+    router = PipelineRouter(PIPELINE_CONFIGS, BUCKET_CONFIGS)
+    return [route for object_name in object_names for route in router.route(SOURCE_BUCKET, object_name)]
+
+def output_index(written, prescanned=(LOG,)):
+    minio = FakeMinio({bucket: {name: UPLOADED + timedelta(minutes=5) for name in names} for bucket, names in written.items()})
+    return OutputIndex(minio, FakePrescanCollection(prescanned))
+
+def test_no_gaps_once_every_flow_wrote_its_outputs():
+    inputs = [f"{LOG}.txt", f"{LOG}-data.csv", "alphabot_snapstat_000277.txt"]
+    found = routes(inputs)
+    assert {pipeline_name(route.config) for route in found} >= {"controls_report_flow", "snapstat_fingerprints", "prescan_flow"}
+    assert output_index(WRITTEN).gaps(found, {name: UPLOADED for name in inputs}) == []
+
+def test_controls_report_gap_when_one_of_its_outputs_is_missing():
+    written = dict(WRITTEN, plots=[f"{LOG}-data-report.html", f"{LOG}-data_instability_plot.png"])
+    gaps = output_index(written).gaps(routes([f"{LOG}-data.csv"]), {f"{LOG}-data.csv": UPLOADED})
+    assert [pipeline_name(route.config) for route in gaps] == ["controls_report_flow"]
+
+def test_outputs_older_than_the_input_are_gaps():
+    gaps = output_index(WRITTEN, prescanned=()).gaps(routes([f"{LOG}.txt"]), {f"{LOG}.txt": UPLOADED + timedelta(hours=1)})
+    assert {pipeline_name(route.config) for route in gaps} == {"alphabot_log_to_logfisher_summary_flow", "minio_txt_to_minio", "prescan_flow"}
@@ -0,0 +1,98 @@
+import pytest
+
+from config import BUCKET_CONFIGS, PIPELINE_CONFIGS, PipelineConfig
+from router import PipelineRouter, compile_pipeline_configs, parse_faults_trigger, pipeline_name
+
+LOG = "alphabot_1_2_3_4_5_6_7"
+
+@pytest.fixture(scope="module")
+def router():
+    return PipelineRouter(PIPELINE_CONFIGS, BUCKET_CONFIGS)
+
+def routed(router, bucket, key):
+    return sorted(pipeline_name(route.config) for route in router.route(bucket, key))
+
+@pytest.mark.parametrize("bucket, key, pipelines", [
+    ("alphabot-logs-bucket", f"{LOG}.txt", ["alphabot_log_to_logfisher_summary_flow", "minio_txt_to_minio", "prescan_flow"]),
+    ("alphabot-logs-bucket", f"{LOG}-data.csv", ["controls_report_flow", "motor_fault_detection_flow"]),
+    ("alphabot-logs-bucket", "alphabot_snapstat_7.txt", ["snapstat_fingerprints"]),
+    ("logfisher-summaries", f"{LOG}_summary.txt", ["logfisher_summary_to_move_events_plot_flow"]),
+    # patterns must match the whole key, not a part of it
+    ("alphabot-logs-bucket", f"old/{LOG}.txt", []),
+    ("alphabot-logs-bucket", f"{LOG}.txt.bak", []),
+    # escaped extensions, "." no longer matches any character
+    ("alphabot-logs-bucket", f"{LOG}xtxt", []),
+    ("alphabot-logs-bucket", f"{LOG}-data_csv", []),
+    ("logfisher-summaries", f"{LOG}_summaryxtxt", []),
+    # precompressed siblings of artifacts are not inputs
+    ("logfisher-summaries", f"{LOG}_summary.txt.gz", []),
+    ("logfisher-summaries", f"{LOG}_summary.txt.br", []),
+    # no pipeline reads these buckets
+    ("plots", f"{LOG}.txt", []),
+    ("unknown-bucket", f"{LOG}.txt", []),
+    ("alphabot-logs-bucket", "", []),
+])
+def test_routes_of_the_real_configs(router, bucket, key, pipelines):
+    assert routed(router, bucket, key) == pipelines
+
+def test_disabled_pipelines_are_left_out_of_the_table(router):
+    disabled = {pipeline_name(config) for config in router.configs if config.faults_trigger == frozenset()}
+    assert disabled == {"minio_to_mongo", "minio_csv_to_minio"}
+    assert not disabled & set(routed(router, "alphabot-logs-bucket", f"{LOG}-data.csv"))
+
+def test_routes_carry_the_destination_and_output_name(router):
+    routes = {pipeline_name(route.config): route for route in router.route("alphabot-logs-bucket", f"{LOG}-data.csv", "etag")}
+    route = routes["controls_report_flow"]
+    assert (route.src, route.dest, route.dest_object_name, route.etag) == ("alphabot-logs-bucket", "plots", f"{LOG}-data_controls_report.html", "etag")
+
+def test_the_real_configs_compile_with_their_fixes(router):
+    configs = {pipeline_name(config): config for config in router.configs}
+    assert configs["controls_report_flow"].faults_trigger == frozenset({"05_12_00", "05_0E_00"})
+    assert configs["prescan_flow"].faults_trigger is None
+    # the csv template writes to the summary bucket, snapstat only to MongoDB
+    assert configs["minio_csv_to_minio"].dest == "alphabot-logs-summary-bucket"
+    assert (configs["snapstat_fingerprints"].dest, configs["snapstat_fingerprints"].output_suffixes) == ("mongo", None)
+    assert {config.stage for config in router.configs if config.lane == "critical"} == {0}
+
+@pytest.mark.parametrize("faults_trigger, expected", [
+    ("*", None),
+    ([], frozenset()),
+    ("05_0E_00", frozenset({"05_0E_00"})),
+    (["05_0E_00, 05_12_00", " 0C_0B_00 "], frozenset({"05_0E_00", "05_12_00", "0C_0B_00"})),
+])
+def test_parse_faults_trigger(faults_trigger, expected):
+    assert parse_faults_trigger(faults_trigger) == expected
+
+def flow(*args):
+    pass
+
+def config(**fields):
+    defaults = dict(desc="test", src="alphabot-logs-bucket", dest="plots", dest_obj_suffix="_x.html", prefect_flow="module:flow", regex_trigger=r"a\.txt", faults_trigger="*")
+    return PipelineConfig(**{**defaults, **fields})
+
+@pytest.mark.parametrize("configs, error", [
+    ([config(regex_trigger="alphabot_(")], "invalid regex_trigger"),
+    ([config(regex_trigger="")], "no regex_trigger"),
+    ([config(), config(desc="again")], "another pipeline has the same name"),
+    ([config(executor="gpu")], "executor 'gpu' is not one of"),
+    ([config(orchestration="dag")], "orchestration 'dag' is not one of"),
+    ([config(faults_trigger=["5_E_0"])], "faults_trigger"),
+    ([config(src="missing-bucket")], "source bucket missing-bucket is not in BUCKET_CONFIGS"),
+    ([config(dest="missing-bucket")], "destination bucket missing-bucket is not in BUCKET_CONFIGS"),
+    ([config(prefect_flow="module.flow")], "is not a \"module:attribute\" import path"),
+    ([config(stage=-1)], "stage -1"),
+    ([config(max_concurrency=0)], "max_concurrency 0"),
+    ([config(output_suffixes="-report.html")], "output_suffixes"),
+    ([config(dest="mongo", output_suffixes=("-report.html",))], "writes to MongoDB"),
+])
+def test_invalid_configs_fail_startup(configs, error):
+    with pytest.raises(ValueError, match="invalid PIPELINE_CONFIGS") as raised:
+        compile_pipeline_configs(configs, BUCKET_CONFIGS)
+    assert error in str(raised.value)
+
+def test_all_errors_are_reported_at_once():
+    with pytest.raises(ValueError) as raised:
+        compile_pipeline_configs([config(executor="gpu", stage=-1), config(prefect_flow=flow, regex_trigger="(")], BUCKET_CONFIGS)
+    message = str(raised.value)
+    assert "flow: invalid regex_trigger" in message
+    assert "executor 'gpu'" in message and "stage -1" in message
@@ -0,0 +1,51 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import scheduler as scheduler_module
+from scheduler import FairScheduler
+
+def test_batch_width_is_charged_to_the_pipeline_and_the_executor():
+    async def main():
+        release = threading.Event()
+        scheduler = FairScheduler({"thread": (ThreadPoolExecutor(max_workers=8), 4)}, {"standard": 1})
+        scheduler.set_limit("report", 3)
+        # wider than the pipeline's cap, the batch gets 3 slots
+        assert scheduler.width("report", "thread", 8) == 3
+
+        batch = asyncio.ensure_future(scheduler.run("standard", "report", release.wait, width=8))
+        single = asyncio.ensure_future(scheduler.run("standard", "report", lambda: "single"))
+        other = asyncio.ensure_future(scheduler.run("standard", "prescan", lambda: "other"))
+        assert await other == "other"
+        await asyncio.sleep(0.05)
+        # the batch holds all the slots of its pipeline
+        assert not single.done()
+        assert scheduler.executor_snapshot()["thread"]["running"] == 3
+        release.set()
+        assert await batch is True
+        assert await single == "single"
+        assert scheduler.executor_snapshot()["thread"]["running"] == 0
+
+    asyncio.run(main())
+
+def test_a_wide_batch_is_not_starved_by_a_stream_of_single_runs(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "SCHEDULE_MAX_OVERTAKES", 3)
+
+    async def main():
+        finished = []
+
+        def work(name):
+            time.sleep(0.01)
+            finished.append(name)
+
+        scheduler = FairScheduler({"thread": (ThreadPoolExecutor(max_workers=2), 2)}, {"standard": 1})
+        runs = [scheduler.run("standard", "prescan", work, "single-0")]
+        runs.append(scheduler.run("standard", "report", work, "batch", width=2))
+        runs += [scheduler.run("standard", "prescan", work, f"single-{n}") for n in range(1, 40)]
+        await asyncio.gather(*runs)
+        # without a reservation the batch would only fit once the stream of single runs dried up
+        assert finished.index("batch") < 10
+        assert scheduler.executor_snapshot()["thread"]["running"] == 0
+
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+import pytest
+
+from etl_shared.summary_index import build_summary_index
+from summaries import SummaryReader, block_ranges, parse_kinds, parse_timestamp
+
+KINDS = ["[FAULT] 05_0E_00 motor fault | x", "[TOTE] pick left | G1", "a:1.1 -> b:2.2 | ok"]
+
+def summary(minutes=10):
+    lines = [f"2024-08-13 23:{minute:02d}:{second:02d}.000 {KINDS[second % 3]}" for minute in range(minutes) for second in range(0, 60, 2)]
+    return ("\n".join(lines) + "\n").encode()
+
+class Stat:
+    def __init__(self, etag):
+        self.etag = etag
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+class FakeMinio:
+    def __init__(self, data, etag="v1"):
+        self.data = data
+        self.etag = etag
+        self.reads = []
+
+    def stat_object(self, bucket_name, object_name):
+        return Stat(self.etag)
+
+    def get_object(self, bucket_name, object_name, offset=0, length=0):
+        self.reads.append((offset, length))
+        return Response(self.data[offset:offset + length] if length else self.data)
+
+class FakeIndexCollection:
+    def __init__(self):
+        self.doc = None
+        self.writes = 0
+
+    def find_one(self, query, projection=None):
+        return self.doc
+
+    def replace_one(self, query, doc, upsert=False):
+        self.doc = doc
+        self.writes += 1
+
+def test_block_ranges_merge_adjacent_blocks_in_the_time_range():
+    blocks = build_summary_index(summary(), block_lines=30)
+    assert len(blocks) == 10
+    # one block per minute, 23:03 to 23:05 are contiguous
+    assert block_ranges(blocks, "2024-08-13 23:03", "2024-08-13 23:05") == [
+        (blocks[3]["offset"], sum(block["length"] for block in blocks[3:6]), "2024-08-13 23:03:00.000"),
+    ]
+    assert block_ranges(blocks) == [(0, len(summary()), "2024-08-13 23:00:00.000")]
+    assert block_ranges(blocks, "2024-08-14") == []
+
+def test_block_ranges_skip_blocks_without_the_requested_kinds():
+    data = b"".join(
+        f"2024-08-13 23:{minute:02d}:00.000 {KINDS[0] if minute == 1 else KINDS[2]}\n".encode() for minute in range(3)
+    )
+    blocks = build_summary_index(data, block_lines=1)
+    assert block_ranges(blocks, kinds={"FAULT"}) == [(blocks[1]["offset"], blocks[1]["length"], "2024-08-13 23:01:00.000")]
+
+def test_reads_fetch_only_the_blocks_of_the_slice():
+    data = summary(60)
+    client = FakeMinio(data)
+    reader = SummaryReader(client, FakeIndexCollection())
+    lines, fetched = reader.read("alphabot_1", "2024-08-13 23:04:30", "2024-08-13 23:05", {"FAULT"})
+    assert lines and all("[FAULT]" in line for line in lines)
+    assert lines[0].startswith("2024-08-13 23:04:30") and lines[-1].startswith("2024-08-13 23:05:54")
+    assert fetched < len(data) // 4
+
+def test_continuation_lines_go_with_their_entry_in_a_slice_within_a_block():
+    data = (
+        "2024-08-13 23:00:00.000 [FAULT] 05_0E_00 motor fault | x\n  trace of 23:00:00\n"
+        "2024-08-13 23:00:10.000 [FAULT] 05_12_00 drive fault | y\n  trace of 23:00:10\n  more of 23:00:10\n"
+        "2024-08-13 23:00:20.000 [FAULT] 05_0E_00 motor fault | z\n  trace of 23:00:20\n"
+    ).encode()
+    reader = SummaryReader(FakeMinio(data), FakeIndexCollection())
+    # one block holds the whole summary, the slice starts and ends inside it
+    lines, _ = reader.read("alphabot_1", "2024-08-13 23:00:05", "2024-08-13 23:00:15")
+    assert lines == ["2024-08-13 23:00:10.000 [FAULT] 05_12_00 drive fault | y", "  trace of 23:00:10", "  more of 23:00:10"]
+    lines, _ = reader.read("alphabot_1", end="2024-08-13 23:00:05")
+    assert lines == ["2024-08-13 23:00:00.000 [FAULT] 05_0E_00 motor fault | x", "  trace of 23:00:00"]
+
+def test_continuation_lines_opening_a_block_belong_to_the_entry_before_it():
+    data = (
+        "2024-08-13 23:00:00.000 a:1.1 -> b:2.2 | ok\n"
+        "2024-08-13 23:00:10.000 [FAULT] 05_12_00 drive fault | y\n  trace of 23:00:10\n"
+        "2024-08-13 23:00:20.000 [FAULT] 05_0E_00 motor fault | z\n"
+    ).encode()
+    blocks = build_summary_index(data, block_lines=2)
+    index = FakeIndexCollection()
+    index.doc = {"etag": "v1", "blocks": blocks}
+    reader = SummaryReader(FakeMinio(data), index)
+    # the second block starts with the trace of the 23:00:10 entry, which is before the slice
+    lines, _ = reader.read("alphabot_1", "2024-08-13 23:00:15")
+    assert lines == ["2024-08-13 23:00:20.000 [FAULT] 05_0E_00 motor fault | z"]
+    lines, _ = reader.read("alphabot_1", "2024-08-13 23:00:05", "2024-08-13 23:00:15")
+    assert lines == ["2024-08-13 23:00:10.000 [FAULT] 05_12_00 drive fault | y", "  trace of 23:00:10"]
+
+def test_a_stale_index_is_rebuilt_from_the_new_version():
+    client = FakeMinio(summary(2))
+    index = FakeIndexCollection()
+    reader = SummaryReader(client, index)
+    reader.read("alphabot_1", "2024-08-13 23:01")
+    assert (index.writes, index.doc["etag"]) == (1, "v1")
+    reader.read("alphabot_1", "2024-08-13 23:01")
+    assert index.writes == 1
+
+    # the summary was regenerated with more lines, the old offsets no longer apply
+    client.data = summary(5)
+    client.etag = "v2"
+    lines, _ = reader.read("alphabot_1", "2024-08-13 23:04")
+    assert (index.writes, index.doc["etag"], index.doc["size"]) == (2, "v2", len(client.data))
+    assert len(lines) == 30 and lines[0].startswith("2024-08-13 23:04:00")
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("2024-08-13", "2024-08-13"),
+    ("2024-08-13T23:25", "2024-08-13 23:25"),
+    ("2024-08-13 23:25:00.123", "2024-08-13 23:25:00.123"),
+])
+def test_parse_timestamp(value, expected):
+    assert parse_timestamp(value) == expected
+
+def test_invalid_queries_are_rejected():
+    with pytest.raises(ValueError):
+        parse_timestamp("yesterday")
+    with pytest.raises(ValueError):
+        parse_kinds("fault,alarm")
+    assert parse_kinds("fault, move") == {"FAULT", "MOVE"}
@@ -0,0 +1,117 @@
+from collections import namedtuple
+
+from minio.notificationconfig import NotificationConfig, QueueConfig
+
+from webhooks import WebhookReconciler, parse_webhook_targets, target_arn, webhook_arns
+
+Bucket = namedtuple('Bucket', ['name', 'notify_webhooks'])
+
+CONFIG_TEXT = """notify_webhook enable=off endpoint= auth_token= queue_limit="0" queue_dir= client_cert= client_key=
+notify_webhook:logs_0 endpoint="http://flowsapi:8000/trigger-etl" auth_token= queue_limit="0" queue_dir= client_cert= client_key=
+notify_webhook:stale_0 endpoint="http://old:8000/trigger-etl" auth_token= queue_limit="0"
+"""
+
+class FakeAdmin:
+    def __init__(self, targets, failing=()):
+        self.targets = dict(targets)
+        self.failing = set(failing)
+        self.calls = []
+
+    def config_get(self, key):
+        return "notify_webhook enable=off endpoint=\n" + "".join(f'{key}:{name} endpoint="{url}" queue_limit="0"\n' for name, url in self.targets.items())
+
+    def config_set(self, key, settings):
+        name = key.partition(":")[2]
+        if name in self.failing:
+            raise RuntimeError("config set failed")
+        self.targets[name] = settings["endpoint"]
+        self.calls.append(("set", name))
+
+    def config_reset(self, key, name):
+        del self.targets[name]
+        self.calls.append(("reset", name))
+
+    def service_restart(self):
+        self.calls.append("restart")
+
+class FakeClient:
+    def __init__(self, notifications, missing=()):
+        self.notifications = dict(notifications)
+        self.missing = set(missing)
+        self.calls = []
+
+    def bucket_exists(self, bucket_name):
+        return bucket_name not in self.missing
+
+    def make_bucket(self, bucket_name):
+        self.missing.discard(bucket_name)
+        self.calls.append(("make", bucket_name))
+
+    def get_bucket_notification(self, bucket_name):
+        return self.notifications.get(bucket_name, NotificationConfig())
+
+    def set_bucket_notification(self, bucket_name, notification):
+        self.notifications[bucket_name] = notification
+        self.calls.append(("notify", bucket_name, sorted(webhook_arns(notification))))
+
+    def list_buckets(self):
+        return []
+
+def subscribed(*names):
+    return NotificationConfig(queue_config_list=[QueueConfig(queue=target_arn(name), events=["s3:ObjectCreated:*"]) for name in names])
+
+BUCKETS = [Bucket("logs", ["http://flowsapi:8000/trigger-etl", "http://flowsapi:8000/trigger-etl2"]), Bucket("plots", [""])]
+
+def test_parse_webhook_targets():
+    assert parse_webhook_targets(CONFIG_TEXT) == {
+        "logs_0": "http://flowsapi:8000/trigger-etl",
+        "stale_0": "http://old:8000/trigger-etl",
+    }
+
+def test_nothing_is_applied_when_minio_is_in_sync():
+    admin = FakeAdmin({"logs_0": "http://flowsapi:8000/trigger-etl", "logs_1": "http://flowsapi:8000/trigger-etl2"})
+    client = FakeClient({"logs": subscribed("logs_0", "logs_1")})
+    plan = WebhookReconciler(client, admin, BUCKETS).reconcile()
+    assert not any(plan)
+    assert admin.calls == client.calls == []
+
+def test_minio_restarts_once_and_only_when_targets_change():
+    admin = FakeAdmin({"logs_0": "http://flowsapi:8000/trigger-etl", "stale_0": "http://old:8000/trigger-etl"})
+    client = FakeClient({"logs": subscribed("logs_0", "stale_0")}, missing={"plots"})
+    WebhookReconciler(client, admin, BUCKETS).reconcile()
+    assert admin.calls == [("set", "logs_1"), ("reset", "stale_0"), "restart"]
+    # the removed target is unsubscribed before the restart, the new one after it
+    assert client.calls == [
+        ("notify", "logs", [target_arn("logs_0")]),
+        ("make", "plots"),
+        ("notify", "logs", [target_arn("logs_0"), target_arn("logs_1")]),
+    ]
+
+    # buckets and notifications apply without a restart
+    admin.calls.clear()
+    client.calls.clear()
+    client.notifications["logs"] = subscribed("logs_0")
+    WebhookReconciler(client, admin, BUCKETS).reconcile()
+    assert admin.calls == []
+    assert client.calls == [("notify", "logs", [target_arn("logs_0"), target_arn("logs_1")])]
+
+def test_dry_run_applies_nothing():
+    admin = FakeAdmin({})
+    client = FakeClient({})
+    plan = WebhookReconciler(client, admin, BUCKETS).reconcile(dry_run=True)
+    assert sorted(plan.set_targets) == ["logs_0", "logs_1"]
+    assert admin.calls == client.calls == []
+
+def test_buckets_are_not_subscribed_to_targets_that_could_not_be_set():
+    admin = FakeAdmin({}, failing={"logs_1"})
+    client = FakeClient({})
+    WebhookReconciler(client, admin, BUCKETS).reconcile()
+    assert admin.calls == [("set", "logs_0"), "restart"]
+    assert client.calls == [("notify", "logs", [target_arn("logs_0")])]
+
+def test_no_restart_when_every_target_change_failed():
+    admin = FakeAdmin({}, failing={"logs_0", "logs_1"})
+    client = FakeClient({})
+    WebhookReconciler(client, admin, BUCKETS).reconcile()
+    assert admin.calls == []
+    assert client.calls == []
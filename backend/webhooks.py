@@ -0,0 +1,188 @@
+import argparse
+import logging
+import os
+import shlex
+import time
+from collections import namedtuple
+
+from minio.notificationconfig import NotificationConfig, QueueConfig
+
+WEBHOOK_CONFIG_KEY = "notify_webhook"
+# bucket events sent to the webhooks, what `mc event add --event put` subscribed to
+WEBHOOK_EVENTS = ["s3:ObjectCreated:*"]
+# how long to wait for MinIO to answer again after the restart
+MINIO_RESTART_TIMEOUT = float(os.getenv("MINIO_RESTART_TIMEOUT", "60"))
+
+# set_targets: {target name: endpoint} to create or update, reset_targets: target names to remove,
+# create_buckets: missing buckets, notifications: {bucket: (current NotificationConfig, webhook ARNs wanted)}
+WebhookPlan = namedtuple('WebhookPlan', ['set_targets', 'reset_targets', 'create_buckets', 'notifications'])
+
+def target_name(bucket_name, index):
+    return f"{bucket_name}_{index}"
+
+def target_arn(name):
+    return f"arn:minio:sqs::{name}:webhook"
+
+def is_webhook_arn(arn):
+    return arn.endswith(":webhook")
+
+def desired_targets(bucket_configs):
+    """{bucket name: {target name: endpoint}} of BUCKET_CONFIGS, empty webhook URLs are skipped"""
+    return {
+        config.name: {target_name(config.name, index): url for index, url in enumerate(config.notify_webhooks) if url}
+        for config in bucket_configs
+    }
+
+def parse_webhook_targets(config_text):
+    """{target name: endpoint} from the output of the admin config get of notify_webhook
+
+    Lines look like `notify_webhook:name endpoint="http://..." auth_token= queue_limit="0" ...`,
+    the line without a name holds the defaults and is not a target.
+    """
+    targets = {}
+    for line in config_text.splitlines():
+        line = line.strip()
+        if not line.startswith(f"{WEBHOOK_CONFIG_KEY}:"):
+            continue
+        key, *pairs = shlex.split(line)
+        settings = dict(pair.partition("=")[::2] for pair in pairs)
+        targets[key.partition(":")[2]] = settings.get("endpoint", "")
+    return targets
+
+def webhook_arns(notification):
+    return {queue.queue for queue in notification.queue_config_list if is_webhook_arn(queue.queue)}
+
+def with_webhooks(notification, arns):
+    """Notification config with its webhook subscriptions replaced by arns, other targets kept"""
+    queues = [queue for queue in notification.queue_config_list if not is_webhook_arn(queue.queue)]
+    queues += [QueueConfig(queue=arn, events=WEBHOOK_EVENTS) for arn in sorted(arns)]
+    return NotificationConfig(
+        cloud_func_config_list=notification.cloud_func_config_list,
+        queue_config_list=queues,
+        topic_config_list=notification.topic_config_list,
+    )
+
+class WebhookReconciler:
+    """Brings MinIO's webhook targets, buckets and bucket notifications in line with BUCKET_CONFIGS
+
+    The current state is read once (one admin config read, one notification read per bucket)
+    and only the differences are applied. Webhook targets are server config that MinIO loads
+    at startup, so all target changes are made first and followed by a single restart, and only
+    when a target actually changed; buckets and bucket notifications apply without a restart.
+    Webhook targets not in BUCKET_CONFIGS are removed, as the old reset did.
+    """
+
+    def __init__(self, client, admin, bucket_configs):
+        self.client = client
+        self.admin = admin
+        self.bucket_configs = bucket_configs
+
+    def plan(self):
+        current = parse_webhook_targets(self.admin.config_get(WEBHOOK_CONFIG_KEY))
+        desired = desired_targets(self.bucket_configs)
+        wanted = {name: url for targets in desired.values() for name, url in targets.items()}
+        create_buckets = [config.name for config in self.bucket_configs if not self.client.bucket_exists(config.name)]
+
+        notifications = {}
+        for bucket_name, targets in desired.items():
+            notification = NotificationConfig() if bucket_name in create_buckets else self.client.get_bucket_notification(bucket_name)
+            arns = {target_arn(name) for name in targets}
+            if webhook_arns(notification) != arns:
+                notifications[bucket_name] = (notification, arns)
+
+        return WebhookPlan(
+            set_targets={name: url for name, url in wanted.items() if current.get(name) != url},
+            reset_targets=sorted(set(current) - set(wanted)),
+            create_buckets=create_buckets,
+            notifications=notifications,
+        )
+
+    def _set_notification(self, bucket_name, notification):
+        try:
+            self.client.set_bucket_notification(bucket_name, notification)
+        except Exception as e:
+            logging.error(f"[ WEBHOOKS ] failed to set the notifications of {bucket_name}: {e}")
+
+    def _wait_until_ready(self):
+        deadline = time.monotonic() + MINIO_RESTART_TIMEOUT
+        while True:
+            try:
+                self.client.list_buckets()
+                return
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(1)
+
+    def apply(self, plan):
+        removed_arns = {target_arn(name) for name in plan.reset_targets}
+        if removed_arns:
+            # stop referencing removed targets before the restart drops them
+            for bucket_name, (notification, _) in plan.notifications.items():
+                if webhook_arns(notification) & removed_arns:
+                    self._set_notification(bucket_name, with_webhooks(notification, webhook_arns(notification) - removed_arns))
+
+        changed = False
+        failed_arns = set()
+        for name, url in plan.set_targets.items():
+            try:
+                self.admin.config_set(
+                    f"{WEBHOOK_CONFIG_KEY}:{name}",
+                    {"endpoint": url, "auth_token": "", "queue_limit": "0", "queue_dir": "", "client_cert": "", "client_key": ""},
+                )
+                logging.info(f"[ WEBHOOKS ] set target {name} -> {url}")
+                changed = True
+            except Exception as e:
+                logging.error(f"[ WEBHOOKS ] failed to set target {name} -> {url}: {e}")
+                failed_arns.add(target_arn(name))
+        for name in plan.reset_targets:
+            try:
+                self.admin.config_reset(WEBHOOK_CONFIG_KEY, name)
+                logging.info(f"[ WEBHOOKS ] removed target {name}")
+                changed = True
+            except Exception as e:
+                logging.error(f"[ WEBHOOKS ] failed to remove target {name}: {e}")
+
+        if changed:
+            logging.info("[ WEBHOOKS ] restarting MinIO to load the webhook targets")
+            self.admin.service_restart()
+            self._wait_until_ready()
+
+        for bucket_name in plan.create_buckets:
+            self.client.make_bucket(bucket_name)
+            logging.info(f"[ WEBHOOKS ] created bucket {bucket_name}")
+        for bucket_name, (notification, arns) in plan.notifications.items():
+            # MinIO rejects subscriptions to targets it does not have, keep only those a bucket already used
+            skipped = (arns & failed_arns) - webhook_arns(notification)
+            if skipped:
+                logging.error(f"[ WEBHOOKS ] {bucket_name} not subscribed to {sorted(skipped)}, their targets could not be set")
+                arns = arns - skipped
+                if arns == webhook_arns(notification):
+                    continue
+            self._set_notification(bucket_name, with_webhooks(notification, arns))
+            logging.info(f"[ WEBHOOKS ] {bucket_name} notifies {sorted(arns) or 'no webhook'}")
+
+    def reconcile(self, dry_run=False):
+        plan = self.plan()
+        if not any(plan):
+            logging.info("[ WEBHOOKS ] MinIO already matches BUCKET_CONFIGS")
+            return plan
+        logging.info(
+            f"[ WEBHOOKS ] targets to set {sorted(plan.set_targets)}, to remove {plan.reset_targets}, "
+            f"buckets to create {plan.create_buckets}, notifications to update {sorted(plan.notifications)}"
+        )
+        if not dry_run:
+            self.apply(plan)
+        return plan
+
+def main():
+    from config import BUCKET_CONFIGS, minio_admin, minio_client
+
+    parser = argparse.ArgumentParser(description="Apply BUCKET_CONFIGS to MinIO: buckets, webhook targets and bucket notifications")
+    parser.add_argument("--dry-run", action="store_true", help="only print the changes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    WebhookReconciler(minio_client(), minio_admin(), BUCKET_CONFIGS).reconcile(dry_run=args.dry_run)
+
+if __name__ == "__main__":
+    main()